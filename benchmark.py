@@ -0,0 +1,272 @@
+'''Benchmark of the load pipeline on a synthetic sf.com export
+
+Generates CSV data files that look like a sf.com backup, with record Ids,
+lookups, picklists, timestamps, long text areas and nulls, then times each
+stage of loading them into a database:
+
+    get_data_filenames, file_reader, df_column_dtypes,
+    pdtype2sqltype_default and write_sqltables
+
+The results are written as JSON so runs of different versions can be
+compared.  By default the tables are written to a throwaway SQLite database,
+use --db-uri for e.g. a scratch PostgreSQL database.
+
+    python benchmark.py --objects 3 --rows 100000 --output bench.json
+'''
+import os
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import sqlalchemy
+import logging
+
+logger = logging.getLogger('main.benchmark')
+
+# Key prefixes of the sf.com objects the synthetic tables are named after
+OBJECT_PREFIXES = [
+    ('Account', '001'),
+    ('Contact', '003'),
+    ('Opportunity', '006'),
+    ('Lead', '00Q'),
+    ('Case', '500'),
+    ('Task', '00T'),
+]
+PICKLIST_VALUES = ['Prospecting', 'Qualification', 'Needs Analysis',
+                   'Closed Won', 'Closed Lost']
+# Kinds of the extra Field_N__c columns added for --width
+EXTRA_COLUMN_KINDS = ['text', 'picklist', 'number', 'lookup', 'timestamp',
+                      'checkbox']
+
+
+def sfids(prefix, numbers):
+    '''Returns 18 character sf.com style record ids for the numbers.'''
+    return pd.Series(numbers).map(
+        lambda n: '{}2A{:010d}AAA'.format(prefix, n))
+
+
+def timestamps(rng, rows):
+    '''Returns sf.com formatted UTC timestamps spread over five years.'''
+    seconds = rng.integers(1388534400, 1546300800, rows)
+    stamps = pd.to_datetime(seconds, unit='s')
+    return pd.Series(stamps.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+
+def long_text(rng, rows):
+    '''Returns long text area values, mostly short but up to a few
+    thousand characters, with the commas, quotes and line breaks CSV quoting
+    has to handle.'''
+    words = np.array(['lorem', 'ipsum', 'dolor,', 'sit', 'amet', '"quoted"',
+                      'line\nbreak', 'consectetur', 'adipiscing', 'elit.'])
+    lengths = np.minimum(rng.geometric(1 / 40, rows), 400)
+    picks = rng.integers(0, len(words), int(lengths.sum()))
+    text = words[picks]
+    bounds = np.cumsum(lengths)[:-1]
+    return pd.Series([' '.join(w) for w in np.split(text, bounds)])
+
+
+def synthetic_object(rng, prefix, rows, width, null_ratio):
+    '''Returns a dataframe of rows synthetic records of one sf.com object.
+
+    There are 11 standard columns plus width extra custom columns.
+    Optional columns are null with probability null_ratio.
+    '''
+    numbers = np.arange(1, rows + 1)
+    columns = {
+        'Id': sfids(prefix, numbers),
+        'IsDeleted': pd.Series(rng.random(rows) < 0.01).map(
+            {True: 'true', False: 'false'}),
+        'Name': pd.Series(numbers).map('Record {}'.format),
+        'OwnerId': sfids('005', rng.integers(1, 200, rows)),
+        'StageName': pd.Series(rng.choice(PICKLIST_VALUES, rows)),
+        'Amount': pd.Series(rng.integers(0, 10 ** 8, rows) / 100),
+        'NumberOfEmployees': pd.Series(rng.integers(1, 100000, rows)),
+        'CloseDate': timestamps(rng, rows).str[:10],
+        'Description': long_text(rng, rows),
+        'CreatedDate': timestamps(rng, rows),
+        'SystemModstamp': timestamps(rng, rows),
+    }
+    for i in range(width):
+        kind = EXTRA_COLUMN_KINDS[i % len(EXTRA_COLUMN_KINDS)]
+        if kind == 'text':
+            values = pd.Series(rng.integers(0, 10 ** 6, rows)).map(
+                'Value {}'.format)
+        elif kind == 'picklist':
+            values = pd.Series(rng.choice(PICKLIST_VALUES, rows))
+        elif kind == 'number':
+            values = pd.Series(rng.normal(1000, 250, rows).round(2))
+        elif kind == 'lookup':
+            values = sfids('001', rng.integers(1, rows + 1, rows))
+        elif kind == 'timestamp':
+            values = timestamps(rng, rows)
+        else:
+            values = pd.Series(rng.random(rows) < 0.5).map(
+                {True: 'true', False: 'false'})
+        columns['Field_{}__c'.format(i + 1)] = values
+    contents = pd.DataFrame(columns)
+    optional = [c for c in contents.columns
+                if c not in ('Id', 'IsDeleted', 'Name', 'CreatedDate',
+                             'SystemModstamp')]
+    for c in optional:
+        contents[c] = contents[c].mask(rng.random(rows) < null_ratio)
+    return contents
+
+
+def generate_export(export_dir, objects, rows, width=0, null_ratio=0.2,
+                    seed=0):
+    '''Writes one CSV data file per synthetic sf.com object to export_dir
+    and returns their file names.'''
+    if objects > len(OBJECT_PREFIXES):
+        raise ValueError('At most {} objects can be generated'.format(
+            len(OBJECT_PREFIXES)))
+    rng = np.random.default_rng(seed)
+    path_filenames = []
+    for name, prefix in OBJECT_PREFIXES[:objects]:
+        path_filename = os.path.join(export_dir, name + '.csv')
+        contents = synthetic_object(rng, prefix, rows, width, null_ratio)
+        contents.to_csv(path_filename, index=False, encoding='utf-8')
+        logger.debug('Generated %s rows in %s', rows, path_filename)
+        path_filenames.append(path_filename)
+    return path_filenames
+
+
+def git_version():
+    '''Returns the git commit of the code being benchmarked, None if it is
+    not a git checkout.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(stage_times, stage, func, *args):
+    '''Calls func with args, adding its duration in seconds to
+    stage_times[stage], and returns its result.'''
+    start = time.perf_counter()
+    result = func(*args)
+    stage_times[stage] = (stage_times.get(stage, 0) +
+                          time.perf_counter() - start)
+    return result
+
+
+def run_benchmark(f, d, export_dir):
+    '''Loads every data file under export_dir with the FileInfo, f, and
+    DataProc, d, and returns the timing results as a dict.'''
+    f.DATA_FILES = export_dir
+    totals = {}
+    path_filenames = timed(totals, 'get_data_filenames',
+                           f.get_data_filenames)
+    tables = []
+    for fn in sorted(path_filenames):
+        table_name = fn.split('/')[-1].lower().split('.')[0]
+        stages = {}
+        contents = timed(stages, 'file_reader', f.file_reader, fn)
+        pdtype_dict = timed(stages, 'df_column_dtypes', f.df_column_dtypes,
+                            contents)
+        sqltype_val_dict = timed(stages, 'pdtype2sqltype_default',
+                                 d.pdtype2sqltype_default, pdtype_dict)
+        sqltype_dict = {k: d.sqltype_from_name(v[0])
+                        for k, v in sqltype_val_dict.items()}
+        rows = timed(stages, 'write_sqltables', d.write_sqltables,
+                     table_name, contents, sqltype_dict)
+        elapsed = sum(stages.values())
+        tables.append({
+            'table': table_name,
+            'rows': rows,
+            'columns': len(contents.columns) + 1,
+            'bytes': os.path.getsize(fn),
+            'seconds': stages,
+            'total_seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else None,
+        })
+        for stage, seconds in stages.items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    rows = sum(t['rows'] for t in tables)
+    elapsed = sum(totals.values())
+    return {
+        'tables': tables,
+        'totals': {
+            'rows': rows,
+            'bytes': sum(t['bytes'] for t in tables),
+            'seconds': totals,
+            'total_seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else None,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading a synthetic sf.com export.')
+    parser.add_argument('--objects', type=int, default=3,
+                        help='number of sf.com objects (data files)')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows per object')
+    parser.add_argument('--width', type=int, default=20,
+                        help='extra custom columns per object')
+    parser.add_argument('--null-ratio', type=float, default=0.2,
+                        help='share of null values in optional columns')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-uri', help='database to write the tables to, '
+                        'a throwaway SQLite database by default')
+    parser.add_argument('--output', help='JSON results file, printed to '
+                        'stdout if not given')
+    args = parser.parse_args(argv)
+    # Config reads these from the environment, which may have no .env
+    os.environ.setdefault('DEBUG', '0')
+    os.environ.setdefault('DATAFILE_EXTS', '["csv"]')
+    from file_processor import FileInfo
+    from db_processor import DataProc
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_dir = os.path.join(tmp_dir, 'export') + '/'
+        os.mkdir(export_dir)
+        start = time.perf_counter()
+        generate_export(export_dir, args.objects, args.rows, args.width,
+                        args.null_ratio, args.seed)
+        generate_seconds = time.perf_counter() - start
+        f = FileInfo()
+        d = DataProc()
+        f.DATAFILE_EXTS = ['csv']
+        d.TYPE_JSON_PATH = tmp_dir + '/'
+        d.LOAD_MODE = 'replace'
+        d.SQLALCHEMY_DATABASE_URI = (args.db_uri or
+                                     'sqlite:///{}/benchmark.db'.format(
+                                         tmp_dir))
+        try:
+            results = run_benchmark(f, d, export_dir)
+        finally:
+            d.dispose_engine()
+    results.update({
+        'version': git_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'dialect': sqlalchemy.engine.url.make_url(
+            d.SQLALCHEMY_DATABASE_URI).get_backend_name(),
+        'writer': d.DB_WRITER,
+        'chunk_size': f.CHUNK_SIZE,
+        'csv_engine': f.CSV_ENGINE,
+        'parameters': vars(args),
+        'generate_seconds': generate_seconds,
+    })
+    # The database password is not part of the results
+    results['parameters']['db_uri'] = None if args.db_uri is None else \
+        repr(sqlalchemy.engine.url.make_url(args.db_uri))
+    report = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as json_f:
+            json_f.write(report)
+    else:
+        print(report)
+    return results
+
+
+if __name__ == '__main__':
+    main()
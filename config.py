@@ -1,14 +1,22 @@
 import os
+import re
 import json
-from sqlalchemy import Integer, String, Boolean, DateTime, Numeric, \
-    Float, Unicode
+import hashlib
 import logging
+from fnmatch import fnmatchcase
+from schema_registry import SchemaRegistry, TYPE_JSON_SUFFIX
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 logger = logging.getLogger('main.config')
 
 
 class Config():
+    # Settings are logged by the first instance only, main.py creates a
+    # Config, a FileInfo and a DataProc.
+    is_logged = False
+    # Built by the sql_types property on first use
+    _sql_types = None
+
     def __init__(self):
         self.DEBUG = int(os.environ.get('DEBUG'))
         self.SQLALCHEMY_DATABASE_URI = '{}://{}:{}@localhost/{}'.format(
@@ -19,25 +27,294 @@ class Config():
         )
         self.SQLALCHEMY_TRACK_MODIFICATIONS = bool(os.environ.get(
             'SQLALCHEMY_TRACK_MODIFICATIONS'))
+        # Connection pool of the single engine DataProc uses for the run
+        self.DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+        self.DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+        self.DB_POOL_PRE_PING = bool(int(os.environ.get('DB_POOL_PRE_PING',
+                                                        1)))
+        self.DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600))
+        # "replace" rebuilds every table, "incremental" upserts changed rows
+        # and "swap" loads a staging table and renames it over the table
+        self.LOAD_MODE = os.environ.get('LOAD_MODE', 'replace')
+        # Table writer, 'auto' picks COPY for postgresql and executemany for
+        # other dialects. See db_writers.writers for the names.
+        self.DB_WRITER = os.environ.get('DB_WRITER', 'auto')
         self.DATA_FILES = os.environ.get('DATA_FILES')
+        # Rows per chunk when streaming data files. 0 reads whole files.
+        self.CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 0))
+        # CSV parser, "pandas" or "arrow" for the multithreaded Arrow reader,
+        # see FileInfo.arrow_csv_chunks
+        self.CSV_ENGINE = os.environ.get('CSV_ENGINE', 'pandas')
+        # Commit each chunk of a table on its own and record it in the run
+        # journal so --resume continues a partially loaded table, see
+        # run_journal.  0 writes each table in one transaction.
+        self.CHECKPOINT_CHUNKS = bool(int(os.environ.get('CHECKPOINT_CHUNKS',
+                                                         0)))
+        # Chunks read ahead by a thread while a chunk is written, 0 reads
+        # them in turn. Only used with CHUNK_SIZE.
+        self.PREFETCH_CHUNKS = int(os.environ.get('PREFETCH_CHUNKS', 0))
+        # Worker processes loading tables in parallel. 1 loads serially.
+        self.LOAD_WORKERS = int(os.environ.get('LOAD_WORKERS', 1))
+        # Worker processes loading byte range shards of one CSV file of at
+        # least SHARD_MIN_MB into its table at once, see
+        # main.load_sharded_file. 1 loads each file in one piece.
+        self.SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', 1))
+        self.SHARD_MIN_MB = int(os.environ.get('SHARD_MIN_MB', 1024))
         self.DATAFILE_EXTS = json.loads(os.environ['DATAFILE_EXTS'])
+        # Sheet read from xlsx, xls and ods files, the first if not set
+        self.SPREADSHEET_SHEET = os.environ.get('SPREADSHEET_SHEET', '')
         self.TYPE_JSON_PATH = os.environ.get('TYPE_JSON_PATH')
+        # SQLite file keeping the type names of all tables in place of the
+        # type JSON files, empty to use the files, see schema_registry
+        self.SCHEMA_REGISTRY = os.environ.get('SCHEMA_REGISTRY', '')
+        self.registry = None
+        # Open the registry read only, without importing the type JSON
+        # files, for plan.py
+        self.registry_read_only = False
+        # Read only the columns listed in a table's type JSON file
+        self.TYPE_JSON_USECOLS = bool(int(os.environ.get('TYPE_JSON_USECOLS',
+                                                         0)))
+        # Infer confident types from a sample of rows so only ambiguous
+        # columns need the interactive session
+        self.INFER_TYPES = bool(int(os.environ.get('INFER_TYPES', 1)))
+        self.INFER_SAMPLE_ROWS = int(os.environ.get('INFER_SAMPLE_ROWS',
+                                                    10000))
+        # JSON file of column type rules applied before the type JSON, see
+        # DataProc.read_type_rules
+        self.TYPE_RULES_FILE = os.environ.get('TYPE_RULES_FILE', '')
+        # Leave out columns with no values in the whole data file, recorded
+        # per table, and columns matching COLUMN_EXCLUDE, a JSON list of
+        # "table.column" fnmatch patterns, see FileInfo.pruned_columns
+        self.PRUNE_EMPTY_COLUMNS = bool(int(os.environ.get(
+            'PRUNE_EMPTY_COLUMNS', 0)))
+        self.COLUMN_EXCLUDE = json.loads(os.environ.get('COLUMN_EXCLUDE',
+                                                        '[]'))
+        # Rows of an Id already written, "error" fails the load and
+        # "keep_latest" keeps the newest row, "off" does not check, see
+        # id_tracker
+        self.DUPLICATE_IDS = os.environ.get('DUPLICATE_IDS', 'error')
+        # Skip data files unchanged since their last load to the same
+        # database with the same LOAD_MODE, see FileInfo.file_fingerprint
+        self.SKIP_UNCHANGED = bool(int(os.environ.get('SKIP_UNCHANGED', 0)))
+        # Directory caching parsed data files as Parquet, empty for no cache,
+        # and its size cap, see FileInfo.parquet_cached_chunks
+        self.PARQUET_CACHE_PATH = os.environ.get('PARQUET_CACHE_PATH', '')
+        self.PARQUET_CACHE_MAX_MB = int(os.environ.get('PARQUET_CACHE_MAX_MB',
+                                                       10240))
+        # Index the reference (lookup) columns of loaded tables, see
+        # DataProc.build_reference_indexes. INDEX_INCLUDE and INDEX_EXCLUDE
+        # are JSON lists of "table.column" fnmatch patterns.
+        self.BUILD_INDEXES = bool(int(os.environ.get('BUILD_INDEXES', 0)))
+        self.INDEX_INCLUDE = json.loads(os.environ.get('INDEX_INCLUDE', '[]'))
+        self.INDEX_EXCLUDE = json.loads(os.environ.get('INDEX_EXCLUDE', '[]'))
+        self.INDEX_WORKERS = int(os.environ.get('INDEX_WORKERS', 4))
+        # Time each stage of each table and save a run report, see
+        # instrumentation.Instrumentation
+        self.INSTRUMENT = bool(int(os.environ.get('INSTRUMENT', 0)))
+        self.RUN_REPORT_PATH = os.environ.get('RUN_REPORT_PATH', 'logs/')
+        if not Config.is_logged:
+            self.log_settings()
+
+    def log_settings(self):
+        '''Logs the settings read from the environment.'''
+        Config.is_logged = True
         logger.info('Config initialized')
         logger.info('DEBUG = %s', self.DEBUG)
         logger.info('SQLALCHEMY_DATABASE_URI = %s',
                     self.SQLALCHEMY_DATABASE_URI)
         logger.info('SQLALCHEMY_TRACK_MODIFICATIONS = %s',
                     self.SQLALCHEMY_TRACK_MODIFICATIONS)
+        logger.info('DB_POOL_SIZE = %s', self.DB_POOL_SIZE)
+        logger.info('DB_MAX_OVERFLOW = %s', self.DB_MAX_OVERFLOW)
+        logger.info('DB_POOL_PRE_PING = %s', self.DB_POOL_PRE_PING)
+        logger.info('DB_POOL_RECYCLE = %s', self.DB_POOL_RECYCLE)
+        logger.info('LOAD_MODE = %s', self.LOAD_MODE)
+        logger.info('DB_WRITER = %s', self.DB_WRITER)
         logger.info('DATA_FILES = %s', self.DATA_FILES)
+        logger.info('CHUNK_SIZE = %s', self.CHUNK_SIZE)
+        logger.info('CSV_ENGINE = %s', self.CSV_ENGINE)
+        logger.info('CHECKPOINT_CHUNKS = %s', self.CHECKPOINT_CHUNKS)
+        logger.info('PREFETCH_CHUNKS = %s', self.PREFETCH_CHUNKS)
+        logger.info('LOAD_WORKERS = %s', self.LOAD_WORKERS)
+        logger.info('SHARD_WORKERS = %s', self.SHARD_WORKERS)
+        logger.info('SHARD_MIN_MB = %s', self.SHARD_MIN_MB)
         logger.info('DATAFILE_EXTS = %s', self.DATAFILE_EXTS)
-        # Non-environment constants
-        # Used for manual selection of type and updates from JSON
-        self.sql_types = {
-            'String': String,
-            'Unicode': Unicode,
-            'DateTime': DateTime,
-            'Integer': Integer,
-            'Float': Float,
-            'Numeric': Numeric,
-            'Boolean': Boolean,
-        }
+        logger.info('SPREADSHEET_SHEET = %s', self.SPREADSHEET_SHEET)
+        logger.info('TYPE_JSON_PATH = %s', self.TYPE_JSON_PATH)
+        logger.info('SCHEMA_REGISTRY = %s', self.SCHEMA_REGISTRY)
+        logger.info('TYPE_JSON_USECOLS = %s', self.TYPE_JSON_USECOLS)
+        logger.info('INFER_TYPES = %s', self.INFER_TYPES)
+        logger.info('INFER_SAMPLE_ROWS = %s', self.INFER_SAMPLE_ROWS)
+        logger.info('TYPE_RULES_FILE = %s', self.TYPE_RULES_FILE)
+        logger.info('PRUNE_EMPTY_COLUMNS = %s', self.PRUNE_EMPTY_COLUMNS)
+        logger.info('COLUMN_EXCLUDE = %s', self.COLUMN_EXCLUDE)
+        logger.info('DUPLICATE_IDS = %s', self.DUPLICATE_IDS)
+        logger.info('SKIP_UNCHANGED = %s', self.SKIP_UNCHANGED)
+        logger.info('PARQUET_CACHE_PATH = %s', self.PARQUET_CACHE_PATH)
+        logger.info('PARQUET_CACHE_MAX_MB = %s', self.PARQUET_CACHE_MAX_MB)
+        logger.info('BUILD_INDEXES = %s', self.BUILD_INDEXES)
+        logger.info('INDEX_INCLUDE = %s', self.INDEX_INCLUDE)
+        logger.info('INDEX_EXCLUDE = %s', self.INDEX_EXCLUDE)
+        logger.info('INDEX_WORKERS = %s', self.INDEX_WORKERS)
+        logger.info('INSTRUMENT = %s', self.INSTRUMENT)
+        logger.info('RUN_REPORT_PATH = %s', self.RUN_REPORT_PATH)
+
+    @property
+    def sql_types(self):
+        '''Non-environment constants used for manual selection of type and
+        updates from JSON.  sqlalchemy is imported on first use, so Config
+        can be used without it, e.g. by plan.py.'''
+        if Config._sql_types is None:
+            from sqlalchemy import Integer, String, Boolean, Date, \
+                DateTime, Numeric, Float, Unicode
+            Config._sql_types = {
+                'String': String,
+                'Unicode': Unicode,
+                'Date': Date,
+                'DateTime': DateTime,
+                'Integer': Integer,
+                'Float': Float,
+                'Numeric': Numeric,
+                'Boolean': Boolean,
+            }
+        return Config._sql_types
+
+    def sqltype_from_name(self, type_name):
+        '''Returns the sqlalchemy type for a type name from sql_types.
+
+        The name may carry arguments, e.g. "String(18)" or "Numeric(18, 2)",
+        in which case an instance of the type is created with them.
+        '''
+        match = re.fullmatch(r'(\w+)\s*(?:\((.*)\))?', type_name.strip())
+        if match is None or match.group(1) not in self.sql_types:
+            raise ValueError('Unknown sql type "{}"'.format(type_name))
+        sql_type = self.sql_types[match.group(1)]
+        if match.group(2) is None:
+            return sql_type
+        args = [int(a) for a in match.group(2).split(',')]
+        return sql_type(*args)
+
+    def type_json_file(self, table_name):
+        '''Returns the full path of the JSON file storing the sqlalchemy type
+        names of the table.'''
+        return self.TYPE_JSON_PATH + table_name + TYPE_JSON_SUFFIX
+
+    def schema_registry(self):
+        '''Returns the SchemaRegistry of SCHEMA_REGISTRY, None if it is not
+        set.  It is opened on first use, importing the type JSON files of
+        tables not in it yet.  With registry_read_only on, nothing is
+        imported and None is returned while the registry does not exist, so
+        the type JSON files are read instead.'''
+        if not self.SCHEMA_REGISTRY:
+            return None
+        if self.registry is None and self.registry_read_only:
+            if not os.path.isfile(self.SCHEMA_REGISTRY):
+                return None
+            self.registry = SchemaRegistry(self.SCHEMA_REGISTRY,
+                                           read_only=True)
+        elif self.registry is None:
+            self.registry = SchemaRegistry(self.SCHEMA_REGISTRY)
+            self.registry.import_type_json_files(self.TYPE_JSON_PATH)
+        return self.registry
+
+    def read_type_json(self, json_file, columns=None):
+        '''Returns the dict of sqlalchemy type names by column stored in
+        the JSON file or None if there is no file.
+
+        With SCHEMA_REGISTRY set the table named by the JSON file is read
+        from the registry instead.  Given the columns of the data, the
+        version stored for exactly those columns is looked up by their
+        hash, otherwise, or if there is none, the current version is read.
+        '''
+        registry = self.schema_registry()
+        if registry is not None:
+            table_name = self.registry_table(json_file)
+            sqltype_names = None
+            if columns is not None:
+                sqltype_names = registry.match(table_name, columns)
+            if sqltype_names is None:
+                sqltype_names = registry.read(table_name)
+            return sqltype_names
+        if not os.path.isfile(json_file):
+            return None
+        with open(json_file, "r") as json_f:
+            return json.load(json_f)
+
+    def write_type_json(self, json_file, sqltype_names):
+        '''Stores the dict of sqlalchemy type names by column in the JSON
+        file, or as a new version of the table in the registry with
+        SCHEMA_REGISTRY set.'''
+        registry = self.schema_registry()
+        if registry is not None:
+            version = registry.save(self.registry_table(json_file),
+                                    sqltype_names)
+            logger.debug('Saved version %s of %s to the schema registry',
+                         version, json_file)
+            return
+        with open(json_file, "w") as json_f:
+            json_f.write(json.dumps(sqltype_names, indent=4))
+        logger.debug('Wrote to JSON file %s', json_file)
+
+    def type_json_hash(self, json_file):
+        '''Returns the sha256 hex digest of the type names stored for the
+        JSON file, None if there are none, for data file fingerprints.'''
+        sqltype_names = self.read_type_json(json_file)
+        if sqltype_names is None:
+            return None
+        return hashlib.sha256(json.dumps(sqltype_names, sort_keys=True)
+                              .encode('utf-8')).hexdigest()
+
+    def registry_table(self, json_file):
+        '''Returns the table name of the type JSON file, its key in the
+        schema registry.'''
+        table_name = os.path.basename(json_file)
+        if table_name.endswith(TYPE_JSON_SUFFIX):
+            table_name = table_name[:-len(TYPE_JSON_SUFFIX)]
+        return table_name
+
+    def pruned_json_file(self, table_name):
+        '''Returns the full path of the JSON file listing the columns of
+        the table found empty and pruned, kept with its type JSON file.'''
+        return self.TYPE_JSON_PATH + table_name + '_pruned.json'
+
+    def read_pruned_json(self, table_name):
+        '''Returns the list of empty columns pruned from the table, None if
+        they were not recorded yet.'''
+        pruned_file = self.pruned_json_file(table_name)
+        if not os.path.isfile(pruned_file):
+            return None
+        with open(pruned_file, 'r') as json_f:
+            return json.load(json_f)
+
+    def write_pruned_json(self, table_name, columns):
+        '''Records the list of empty columns pruned from the table.'''
+        pruned_file = self.pruned_json_file(table_name)
+        with open(pruned_file, 'w') as json_f:
+            json_f.write(json.dumps(sorted(columns), indent=4))
+        logger.info('Recorded %s pruned columns in %s', len(columns),
+                    pruned_file)
+
+    def column_rule_match(self, rules, table_name, column):
+        '''Returns True if "table.column" matches one of the fnmatch
+        patterns in rules, e.g. "*.OwnerId" or "task.*".  Table names are
+        matched in lower case.'''
+        name = '{}.{}'.format(table_name.lower(), column)
+        return any(fnmatchcase(name, rule) for rule in rules)
+
+    def manifest_file(self):
+        '''Returns the full path of the JSON manifest of loaded data files,
+        kept with the type JSON files.'''
+        return self.TYPE_JSON_PATH + 'load_manifest.json'
+
+    def load_target(self):
+        '''Returns the database URI, without the password, and LOAD_MODE
+        the data files are loaded with, the key of their fingerprints in
+        the load manifest.'''
+        uri = re.sub(r'^([^:/]+://[^:@/]*):[^@/]*@', r'\1@',
+                     self.SQLALCHEMY_DATABASE_URI)
+        return '{} {}'.format(uri, self.LOAD_MODE)
+
+    def journal_file(self):
+        '''Returns the full path of the SQLite run journal, kept with the
+        load manifest.'''
+        return self.TYPE_JSON_PATH + 'run_journal.db'
@@ -0,0 +1,308 @@
+'''Finding and opening data files
+
+The functions here only use the standard library, so data files can be
+listed and sampled, e.g. by plan.py, without importing pandas.
+'''
+import io
+import os
+import sys
+import gzip
+import zipfile
+from contextlib import contextmanager, ExitStack
+import logging
+
+logger = logging.getLogger('main.data_files')
+
+# Data files are read straight out of zip archives, e.g. the sf.com weekly
+# export WE_*.zip files, and out of gzip compressed files.
+ARCHIVE_EXT = 'zip'
+COMPRESSED_EXT = 'gz'
+# Bytes read at a time when scanning a CSV file for record boundaries
+SCAN_BLOCK_SIZE = 1 << 24
+
+
+def iter_3sample(an_iterable):
+    '''Accepts a list, tuple or any indexed iterable and returns a tuple with
+    the length of the iterable, first, middle and last item in the iterable.
+    '''
+    length = len(an_iterable)
+    if length >= 3:
+        sample = (length, an_iterable[0], an_iterable[length//2],
+                  an_iterable[length-1])
+    elif length == 2:
+        sample = (length, an_iterable[0], an_iterable[1])
+    elif length == 1:
+        sample = (length, an_iterable[0])
+    else:
+        sample = (length)
+    return sample
+
+
+def table_name_for(path_filename):
+    '''Returns the table name for the data file, its lower case file
+    name without extensions.'''
+    filename = path_filename.split('/')[-1].lower()
+    return filename.split('.')[0]
+
+
+def count_csv_records(data):
+    '''Returns the number of complete CSV records in the bytes, data, and
+    the offset just after the last one.
+
+    A record ends at a line break outside double quotes, so line breaks in
+    quoted values, e.g. of long text areas, do not end a record.  The bytes
+    must start at the beginning of a record.
+    '''
+    records = 0
+    end = 0
+    offset = 0
+    # Even parts are outside quotes, an escaped "" gives an empty odd part
+    for i, part in enumerate(data.split(b'"')):
+        if i % 2 == 0:
+            line_breaks = part.count(b'\n')
+            if line_breaks:
+                records += line_breaks
+                end = offset + part.rindex(b'\n') + 1
+        offset += len(part) + 1
+    return records, end
+
+
+def next_record_start(data, start, in_quotes):
+    '''Returns the offset in the bytes, data, just after the first line
+    break outside double quotes from offset start, where in_quotes tells
+    whether start is inside a quoted value.  Returns None and whether the
+    end of data is inside a quoted value if there is no such line break.
+    '''
+    i = start
+    while True:
+        quote = data.find(b'"', i)
+        if in_quotes:
+            # An escaped "" leaves and enters the quoted value again
+            if quote < 0:
+                return None, True
+            i = quote + 1
+            in_quotes = False
+            continue
+        line_break = data.find(b'\n', i)
+        if line_break >= 0 and (quote < 0 or line_break < quote):
+            return line_break + 1, False
+        if quote < 0:
+            return None, False
+        i = quote + 1
+        in_quotes = True
+
+
+def csv_record_boundaries(path_filename, offsets,
+                          block_size=SCAN_BLOCK_SIZE):
+    '''Returns the offset of the first record starting after each of the
+    sorted byte offsets into the plain CSV file, or the file size if no
+    record does.
+
+    Whether an offset is inside a quoted value, where a line break does
+    not end the record, depends on every double quote before it, so the
+    file is read from the start counting them in blocks of block_size.
+    Counting runs at about the speed of reading the file.
+    '''
+    boundaries = []
+    in_quotes = False
+    block_start = 0
+    with open(path_filename, 'rb') as file_obj:
+        block = file_obj.read(block_size)
+        # Offset in block up to which the quotes are counted
+        i = 0
+        for offset in offsets:
+            while block and offset - block_start > len(block):
+                in_quotes ^= block.count(b'"', i) % 2 == 1
+                block_start += len(block)
+                block = file_obj.read(block_size)
+                i = 0
+            if block and offset - block_start > i:
+                in_quotes ^= block.count(b'"', i, offset - block_start) \
+                    % 2 == 1
+                i = offset - block_start
+            while block:
+                found, in_quotes = next_record_start(block, i, in_quotes)
+                if found is not None:
+                    i = found
+                    break
+                block_start += len(block)
+                block = file_obj.read(block_size)
+                i = 0
+            boundaries.append(block_start + i)
+    return boundaries
+
+
+def csv_shard_ranges(path_filename, n_shards, block_size=SCAN_BLOCK_SIZE):
+    '''Splits the records of the plain CSV file, after its header, into
+    at most n_shards (start, end) byte ranges of about equal size.  Each
+    range is a whole number of records, so quoted values with line breaks
+    are never split, see csv_record_boundaries.
+    '''
+    size = os.path.getsize(path_filename)
+    header_end = csv_record_boundaries(path_filename, [0], block_size)[0]
+    offsets = [header_end + (size - header_end) * i // n_shards
+               for i in range(1, n_shards)]
+    bounds = [header_end] + csv_record_boundaries(
+        path_filename, offsets, block_size) + [size]
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if end > start]
+
+
+class ByteRange(io.RawIOBase):
+    '''Read only binary file of the bytes from start to end of the open
+    file, file_obj.'''
+    def __init__(self, file_obj, start, end):
+        super().__init__()
+        self.file_obj = file_obj
+        self.file_obj.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        n_read = self.file_obj.readinto(memoryview(buffer)[:size])
+        self.remaining -= n_read
+        return n_read
+
+
+@contextmanager
+def open_byte_range(path_filename, start, end):
+    '''Opens the bytes from start to end of the plain data file, e.g. a
+    shard from csv_shard_ranges, as a binary file object.'''
+    with open(path_filename, 'rb') as file_obj:
+        yield io.BufferedReader(ByteRange(file_obj, start, end))
+
+
+def split_archive_path(path_filename):
+    '''Splits the name of a data file in a zip archive into the archive
+    file name and the member name, e.g. "data/WE_1.zip/Account.csv" into
+    ("data/WE_1.zip", "Account.csv").  The member is None for a data file
+    that is not in an archive.'''
+    parts = path_filename.split('/')
+    for i, part in enumerate(parts[:-1]):
+        if part.lower().endswith('.' + ARCHIVE_EXT):
+            archive = '/'.join(parts[:i + 1])
+            if os.path.isfile(archive):
+                return archive, '/'.join(parts[i + 1:])
+    return path_filename, None
+
+
+def data_file_ext(path_filename):
+    '''Returns the extension of the data file name, the one before ".gz"
+    for a compressed file, e.g. "csv" for "Account.csv.gz".'''
+    parts = path_filename.split('/')[-1].split('.')
+    if len(parts) > 2 and parts[-1].lower() == COMPRESSED_EXT:
+        return parts[-2]
+    return parts[-1]
+
+
+@contextmanager
+def open_data_file(path_filename):
+    '''Opens the data file for reading as a binary file object.
+
+    Members of zip archives and gzip compressed files are decompressed as
+    they are read, nothing is extracted to disk.
+    '''
+    archive, member = split_archive_path(path_filename)
+    with ExitStack() as stack:
+        if member is None:
+            file_obj = stack.enter_context(open(archive, 'rb'))
+        else:
+            zip_file = stack.enter_context(zipfile.ZipFile(archive))
+            file_obj = stack.enter_context(zip_file.open(member))
+        if path_filename.lower().endswith('.' + COMPRESSED_EXT):
+            file_obj = stack.enter_context(gzip.GzipFile(fileobj=file_obj))
+        yield file_obj
+
+
+def data_file_stat(path_filename):
+    '''Returns the size and mtime of the data file.
+
+    For a member of a zip archive these are its uncompressed size and the
+    mtime of the archive.  For a gzip compressed file the size is the
+    compressed size.
+    '''
+    archive, member = split_archive_path(path_filename)
+    stat = os.stat(archive)
+    if member is None:
+        return stat.st_size, stat.st_mtime
+    with zipfile.ZipFile(archive) as zip_file:
+        return zip_file.getinfo(member).file_size, stat.st_mtime
+
+
+def data_file_size(path_filename):
+    '''Returns the size of the data file as given by data_file_stat.'''
+    return data_file_stat(path_filename)[0]
+
+
+def find_data_files(root_dir, file_extensions):
+    '''Recursively walks through a *ix system file directory and returns
+    a list of file names having file extensions found in the iterable,
+    file_extensions.
+
+    Zip archives are listed as directories, a data file in an archive
+    being named "<archive>.zip/<member>".  Gzip compressed files are
+    matched on the extension before ".gz".
+
+    Arguments:
+    root_dir is the full path as a String where the recursive walk using
+    os.walk starts.
+
+    file_extensions is an iterable of Strings, where each string is a
+    desired file extension with no leading "."  e.g. "csv" not ".csv"
+    Though these are stripped in any case.
+    '''
+    logger.info('Using %s to retrieve data file names', root_dir)
+    logger.debug('File ext before stripping "." is %s', file_extensions)
+    file_extensions = [f.strip(".") for f in file_extensions]
+    logger.info(
+        'Filtering file names that have one of these extensions: %s',
+        file_extensions,
+    )
+    logger.warning('File extension strings containg a "." has '
+                   'been removed')
+
+    def is_valid_ext(filename):
+        '''Determines if a filename has extension a valid extension
+
+        A file name and an iterable of acceptable extensions are passed to
+        the function and returns True if the file has an extension and is
+        a member of the acceptable extensions.
+        '''
+        return (data_file_ext(filename) in file_extensions and
+                len(filename.split('.')) > 1)
+
+    def archive_members(path_filename):
+        '''Returns the file names of the members of a zip archive, or
+        the file name itself if it is not an archive.'''
+        if not path_filename.lower().endswith('.' + ARCHIVE_EXT):
+            return [path_filename]
+        with zipfile.ZipFile(path_filename) as zip_file:
+            return [path_filename + '/' + m for m in zip_file.namelist()
+                    if not m.endswith('/')]
+    # list comprehension of candidate file names
+    path_files = [m for p, d, fs in os.walk(root_dir) for f in fs
+                  for m in archive_members(
+                      str(p).rstrip('/') + '/' + str(f))]
+    logger.debug(
+        'Sample candidate file names are %s. Total, 1st, middle and last',
+        iter_3sample(path_files))
+    # filter only file names with a file extension in file extensions
+    filtered_path_files = list(filter(is_valid_ext, path_files))
+    logger.debug(
+        'Sample filtered file names are %s. Total, 1st, middle and last',
+        iter_3sample(filtered_path_files))
+    # Ensuring there are no duplicate file names in data file directory
+    # structure
+    filenames_pathremoved = [x.split('/')[-1] for x in filtered_path_files]
+    reduced_filenames = list(set(filenames_pathremoved))
+    if len(filenames_pathremoved) != len(reduced_filenames):
+        print('\nThere are one more data files with the same name in the '
+              'directory structure under "{}".'.format(root_dir))
+        print('\nPlease inspect the data file structure for duplicate '
+              'file names.')
+        sys.exit('and correct so all data files are named uniquely. '
+                 'Exiting.')
+    return filtered_path_files
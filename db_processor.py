@@ -1,26 +1,41 @@
 '''DB processing intro'''
-import os
 import json
-from sqlalchemy import create_engine
+import time
+import itertools
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import create_engine, event, inspect, Boolean, Integer, \
+    Date, DateTime
 #     Numeric, Float, Unicode
 from config import Config
+from db_writers import writer_for_uri
+from type_inference import infer_frame_types, SFID_PATTERN
+from id_tracker import IdTracker, DuplicateIdError
 import logging
 
 logger = logging.getLogger('main.db_processor')
 
+# Text of boolean values in sf.com exports
+BOOLEAN_TEXT = {'true': True, 'false': False, '1': True, '0': False}
+
 
 class DataProc(Config):
     def __init__(self):
         Config.__init__(self)
-        logger.info('DataProc initialized with Config inheritance')
-        logger.info('DEBUG = %s', self.DEBUG)
-        logger.info('SQLALCHEMY_DATABASE_URI = %s',
-                    self.SQLALCHEMY_DATABASE_URI)
-        logger.info('SQLALCHEMY_TRACK_MODIFICATIONS = %s',
-                    self.SQLALCHEMY_TRACK_MODIFICATIONS)
-        logger.info('DATA_FILES = %s', self.DATA_FILES)
-        logger.info('DATAFILE_EXTS = %s', self.DATAFILE_EXTS)
-        logger.info('self.sql_types = %s', self.sql_types)
+        # The settings are logged once, by Config.log_settings
+        logger.debug('DataProc initialized with Config inheritance')
+        # The engine is created on first use and shared by every table
+        self.engine = None
+        # Read from TYPE_RULES_FILE on first use
+        self.type_rules = None
+        # Columns recording when a sf.com record last changed, in order of
+        # preference for incremental loads.
+        self.modstamp_columns = ['SystemModstamp', 'LastModifiedDate']
 
     def pdtype2sqltype_default(self, pdtype_dict):
         '''Creates a dict of default mapping from pandas dtype to sqlalchemy
@@ -37,21 +52,113 @@ class DataProc(Config):
         '''
         default_type_map = {
                     'bool': 'Boolean',
+                    'boolean': 'Boolean',
                     'datetime64': 'DateTime',
                     'timedelta64': 'DateTime',
                     'int64': 'Integer',
+                    'Int64': 'Integer',
                     'float64': 'Float',
                     'category': 'String',
                     'object': 'String',
         }
         logger.info('-- Begin default mapping from pd types to sql types --')
         logger.debug('pdtype_dict=> %s', pdtype_dict)
-        sqltype_val_dict = {k: (default_type_map[v[0]], v[1])
+        # Drop the unit of datetime dtypes, e.g. datetime64[ns]
+        sqltype_val_dict = {k: (default_type_map[v[0].split('[')[0]], v[1])
                             for k, v in pdtype_dict.items()}
         logger.debug('sqltype_val_dict=> %s', sqltype_val_dict)
         logger.info('-- End default mapping from pd types to sql types --')
         return sqltype_val_dict
 
+    def pdtype2sqltype_infer(self, contents, pdtype_dict, is_complete=True):
+        '''Creates a dict of sqlalchemy types with typical values like
+        pdtype2sqltype_default but with types inferred from a sample of the
+        data, see type_inference.infer_frame_types.
+
+        Accepts the dataframe and its dict from FileInfo.df_column_profile.
+        is_complete is False when the dataframe is only the first chunk of
+        the file.  Returns the type dict and the set of columns whose
+        inferred type is ambiguous and should be confirmed interactively.
+        '''
+        logger.info('-- Begin inferring sql types from data sample --')
+        type_names, ambiguous = infer_frame_types(
+            contents, pdtype_dict, self.INFER_SAMPLE_ROWS, is_complete)
+        sqltype_val_dict = {k: (type_names[k], v[1])
+                            for k, v in pdtype_dict.items()}
+        logger.debug('sqltype_val_dict=> %s', sqltype_val_dict)
+        logger.info('%s of %s columns have ambiguous types', len(ambiguous),
+                    len(sqltype_val_dict))
+        logger.info('-- End inferring sql types from data sample --')
+        return sqltype_val_dict, ambiguous
+
+    def read_type_rules(self):
+        '''Returns the type rules of TYPE_RULES_FILE, read on first use,
+        as a dict with the global "rules" list and a "tables" dict of
+        per-table rule lists.  There are no rules without a file.
+
+        A rule is a dict with the type name, "type", and a "column"
+        fnmatch pattern, e.g. "*Id", a "values" regular expression all
+        values of the column must match, or both.  For example,
+            {"rules": [{"column": "Is*", "type": "Boolean"}],
+             "tables": {"account": [{"column": "Site",
+                                     "type": "String(80)"}]}}
+        Raises ValueError for a rule without a type name from sql_types.
+        '''
+        if self.type_rules is not None:
+            return self.type_rules
+        type_rules = {'rules': [], 'tables': {}}
+        if self.TYPE_RULES_FILE:
+            with open(self.TYPE_RULES_FILE, 'r') as json_f:
+                type_rules.update(json.load(json_f))
+        all_rules = list(type_rules['rules'])
+        for rules in type_rules['tables'].values():
+            all_rules += rules
+        for rule in all_rules:
+            if 'column' not in rule and 'values' not in rule:
+                raise ValueError('Type rule {} has neither a column nor a '
+                                 'values pattern'.format(rule))
+            self.sqltype_from_name(rule.get('type', ''))
+        logger.info('Read %s type rules from %s', len(all_rules),
+                    self.TYPE_RULES_FILE)
+        self.type_rules = type_rules
+        return type_rules
+
+    def apply_type_rules(self, table_name, contents, sqltype_val_dict):
+        '''Sets the types of the columns matching a type rule, see
+        read_type_rules.
+
+        The table's own rules are tried before the global rules and the
+        first matching rule sets the type.  Values are checked on the first
+        INFER_SAMPLE_ROWS non-null values of the column in the dataframe,
+        contents.  Returns the updated copy of sqltype_val_dict and the set
+        of columns set by a rule, which need no interactive session.
+        '''
+        type_rules = self.read_type_rules()
+        rules = (type_rules['tables'].get(table_name, []) +
+                 type_rules['rules'])
+        sqltype_val_dict = dict(sqltype_val_dict)
+        ruled = set()
+        if not rules:
+            return sqltype_val_dict, ruled
+        for c, (type_name, typical_val) in sqltype_val_dict.items():
+            values = None
+            for rule in rules:
+                if 'column' in rule and not fnmatchcase(c, rule['column']):
+                    continue
+                if 'values' in rule:
+                    if values is None:
+                        values = contents[c].dropna().head(
+                            self.INFER_SAMPLE_ROWS).astype(str)
+                    if values.empty or \
+                            not values.str.fullmatch(rule['values']).all():
+                        continue
+                sqltype_val_dict[c] = (rule['type'], typical_val)
+                ruled.add(c)
+                break
+        logger.debug('Type rules set columns %s of table %s', ruled,
+                     table_name)
+        return sqltype_val_dict, ruled
+
     def type_update_interactive(self, sqltype_val_dict):
         '''A terminal iteractive session to update a verbose version of a dict
         to use with sqlalchemy for creating tables.
@@ -160,15 +267,12 @@ class DataProc(Config):
         for future updates.
         '''
         logger.info('- Entering make_sqltype_dict function -')
-        sqltype_dict = {k: self.sql_types[v[0]] for k, v in
+        sqltype_dict = {k: self.sqltype_from_name(v[0]) for k, v in
                         sqltype_val_dict.items()}
         sqltype_dict_json = {k: v[0] for k, v in sqltype_val_dict.items()}
         logger.debug('Current sqltype dict is %s', sqltype_dict)
         logger.debug('Current sqltype dict for JSON is %s', sqltype_dict_json)
-        sqltype_json = json.dumps(sqltype_dict_json, indent=4)
-        with open(json_file, "w") as json_f:
-            json_f.write(sqltype_json)
-        logger.debug('Wrote to JSON file %s', json_file)
+        self.write_type_json(json_file, sqltype_dict_json)
         logger.debug('Created sqltype_dict for sqlalchemy table create %s',
                      sqltype_dict)
         logger.info('- Leaving make_sqltype_dict function -')
@@ -190,11 +294,10 @@ class DataProc(Config):
          Both above conditions can be used to trigger an interactive session.
         '''
         logger.info('- Entering make_sqltype_dict_json function -')
-        file_exists = os.path.isfile(json_file)
+        sqltype_dict_json = self.read_type_json(json_file, sqltype_val_dict)
+        file_exists = sqltype_dict_json is not None
         logger.info('JSON file exist is %s', file_exists)
         if file_exists:
-            with open(json_file, "r") as json_f:
-                sqltype_dict_json = json.load(json_f)
             logger.debug('sqltype_dict_json read in is %s', sqltype_dict_json)
             cols_default = set(list(sqltype_val_dict.keys()))
             cols_json = set(list(sqltype_dict_json.keys()))
@@ -208,7 +311,7 @@ class DataProc(Config):
         if cols_match:
             # Create sqltype_dict with type object
             # Will be used for SQL table create
-            sqltype_dict = {k: self.sql_types[v] for k, v in
+            sqltype_dict = {k: self.sqltype_from_name(v) for k, v in
                             sqltype_dict_json.items()}
             is_sql_ready = True
             logger.info('sqltype_dict made in cols_match == True')
@@ -232,13 +335,556 @@ class DataProc(Config):
         logger.info('- Leaving make_sqltype_dict_json function -')
         return sqltype_dict, is_sql_ready
 
-    def write_sqltables(self, table_name, contents, sqltype_dict):
-        # make connection to the database
-        engine = create_engine(self.SQLALCHEMY_DATABASE_URI)
+    def get_engine(self):
+        '''Returns the engine for SQLALCHEMY_DATABASE_URI, creating it on
+        the first call.
+
+        The one engine and its connection pool is reused for every table
+        written during the run.  Call dispose_engine when finished.
+        SQLite does not pool connections so the pool size settings are only
+        passed for other dialects.
+        '''
+        if self.engine is None:
+            engine_kwargs = {
+                'pool_pre_ping': self.DB_POOL_PRE_PING,
+                'pool_recycle': self.DB_POOL_RECYCLE,
+            }
+            dialect = make_url(self.SQLALCHEMY_DATABASE_URI).get_backend_name()
+            if dialect != 'sqlite':
+                engine_kwargs['pool_size'] = self.DB_POOL_SIZE
+                engine_kwargs['max_overflow'] = self.DB_MAX_OVERFLOW
+            logger.debug('Creating engine with %s', engine_kwargs)
+            self.engine = create_engine(self.SQLALCHEMY_DATABASE_URI,
+                                        **engine_kwargs)
+            if dialect == 'sqlite':
+                # pysqlite does not begin transactions before DDL, so let
+                # sqlalchemy emit BEGIN itself to make table replacement
+                # transactional like on postgresql.
+                @event.listens_for(self.engine, 'connect')
+                def sqlite_connect(dbapi_connection, connection_record):
+                    dbapi_connection.isolation_level = None
+
+                @event.listens_for(self.engine, 'begin')
+                def sqlite_begin(con):
+                    con.exec_driver_sql('BEGIN')
+        return self.engine
+
+    def dispose_engine(self, close=True):
+        '''Closes the pooled connections of the engine, if one was
+        created.
+
+        A forked process disposes the engine it inherited with close False,
+        which drops the pool without closing its connections, as they are
+        the parent's.
+        '''
+        if self.engine is not None:
+            self.engine.dispose(close=close)
+            self.engine = None
+            logger.info('Database engine disposed')
+
+    def add_primary_key(self, con, table_name):
+        '''Adds the primary key, in sf.com this is always "Id", to the
+        table.
+
+        SQLite cannot add a primary key to an existing table, so a unique
+        index on "Id" stands in for it there.
+        '''
+        if con.dialect.name == 'sqlite':
+            con.execute('create unique index "{0}_pkey" on "{0}" ("Id")'
+                        .format(table_name))
+        else:
+            con.execute('alter table "{}" add primary key("Id")'.format(
+                table_name))
+
+    def rename_primary_key(self, con, old_table, table_name):
+        '''Renames the primary key index added by add_primary_key to
+        old_table after the table was renamed to table_name.
+
+        SQLite cannot rename indexes, so there it is dropped and created
+        again under the new name.
+        '''
+        if con.dialect.name == 'sqlite':
+            con.execute('drop index "{}_pkey"'.format(old_table))
+            self.add_primary_key(con, table_name)
+        else:
+            con.execute('alter index "{}_pkey" rename to "{}_pkey"'.format(
+                old_table, table_name))
+
+    def coerce_chunk(self, chunk, sqltype_dict):
+        '''Converts columns whose pandas dtype does not fit the sqlalchemy
+        type they are written as.
+
+        - Boolean columns of "true"/"false" text or python bools become
+          booleans
+        - Integer columns read as float, because of nulls, become Int64
+        - Date and DateTime columns of ISO-8601 text become datetimes
+        Returns a converted copy of the chunk and raises ValueError if a
+        value cannot be converted.
+        '''
+        converted_cols = {}
+        for c, sql_type in sqltype_dict.items():
+            if c not in chunk.columns:
+                continue
+            column = chunk[c]
+            sql_class = sql_type if isinstance(sql_type, type) \
+                else type(sql_type)
+            if issubclass(sql_class, Boolean) and column.dtype == object:
+                converted = column.map(
+                    lambda v: v if isinstance(v, (bool, np.bool_))
+                    else BOOLEAN_TEXT.get(str(v).strip().lower()),
+                    na_action='ignore')
+                if converted.isna().sum() != column.isna().sum():
+                    raise ValueError('Column "{}" has non boolean values'
+                                     .format(c))
+                converted_cols[c] = converted.astype('boolean')
+            elif issubclass(sql_class, Integer) and column.dtype == float:
+                try:
+                    converted_cols[c] = column.astype('Int64')
+                except TypeError:
+                    raise ValueError('Column "{}" has non integer values'
+                                     .format(c))
+            elif issubclass(sql_class, (Date, DateTime)) and \
+                    column.dtype == object:
+                converted = pd.to_datetime(column, format='ISO8601',
+                                           utc=True).dt.tz_convert(None)
+                if issubclass(sql_class, Date):
+                    converted = converted.dt.date
+                converted_cols[c] = converted
+        if converted_cols:
+            logger.debug('Converted columns %s', list(converted_cols))
+            chunk = chunk.assign(**converted_cols)
+        return chunk
+
+    def write_sqltables(self, table_name, contents, sqltype_dict,
+                        checkpoint=None, resume_rows=0):
+        '''Writes the contents to the database table, table_name, using the
+        sqlalchemy types in sqltype_dict.
+
+        contents is either a pandas dataframe or an iterable of dataframe
+        chunks, e.g. from FileInfo.file_chunk_reader.  With LOAD_MODE
+        "replace" the table is rebuilt, with "incremental" only changed rows
+        are upserted, see upsert_sqltable, and with "swap" a staging table
+        is loaded and swapped in, see swap_sqltable.
+        Rows are sent with the writer from db_writers selected by DB_WRITER
+        and the dialect of the database.  Each chunk's Ids are checked for
+        duplicates before it is written, see id_tracker.  Returns the number
+        of rows written.
+
+        With checkpoint, a function, replace and swap loads commit each
+        chunk on its own and call checkpoint with the rows committed so
+        far.  resume_rows is the number of rows, from committed_rows, a
+        resumed load already committed.  contents is then the rest of the
+        rows, which are appended to them.
+        '''
+        if isinstance(contents, pd.DataFrame):
+            contents = [contents]
+        contents = (self.coerce_chunk(chunk, sqltype_dict)
+                    for chunk in contents)
+        tracker = self.id_tracker(table_name, resume_rows)
+        contents = (tracker.check(chunk) for chunk in contents)
+        start = time.perf_counter()
+        if self.LOAD_MODE == 'incremental':
+            rows = self.upsert_sqltable(table_name, contents, sqltype_dict)
+        elif self.LOAD_MODE == 'swap':
+            rows = self.swap_sqltable(table_name, contents, sqltype_dict,
+                                      checkpoint, resume_rows)
+        else:
+            rows = self.replace_sqltable(table_name, contents, sqltype_dict,
+                                         checkpoint, resume_rows)
+        elapsed = time.perf_counter() - start
+        tracker.log_summary()
+        logger.info('Wrote %s rows to table %s in %.2f s (%.0f rows/sec)',
+                    rows, table_name, elapsed,
+                    rows / elapsed if elapsed else 0)
+        return rows
+
+    def id_tracker(self, table_name, resume_rows=0):
+        '''Returns the IdTracker of a load of the table with the
+        DUPLICATE_IDS policy.  When resume_rows were committed before, the
+        Ids of those rows are read back into it.'''
+        tracker = IdTracker(table_name, self.DUPLICATE_IDS,
+                            self.modstamp_columns)
+        if not resume_rows or self.DUPLICATE_IDS == 'off':
+            return tracker
+        if self.LOAD_MODE == 'swap':
+            table_name = table_name + '__staging'
+        engine = self.get_engine()
+        table_cols = [c['name'] for c in
+                      inspect(engine).get_columns(table_name)]
+        cols = ['Id'] + [c for c in self.modstamp_columns
+                         if c in table_cols][:1]
+        sql = 'select {} from "{}"'.format(
+            ', '.join('"{}"'.format(c) for c in cols), table_name)
+        if self.CHUNK_SIZE:
+            committed = pd.read_sql(sql, engine, index_col='Id',
+                                    chunksize=self.CHUNK_SIZE)
+        else:
+            committed = [pd.read_sql(sql, engine, index_col='Id')]
+        for chunk in committed:
+            tracker.check(chunk)
+        logger.debug('Read %s committed Ids of table %s', len(tracker.seen),
+                     table_name)
+        return tracker
+
+    def delete_superseded(self, con, table_name, chunk):
+        '''Deletes the rows written to the table from earlier chunks whose
+        Ids have newer rows in the chunk, listed by IdTracker.check.'''
+        ids = chunk.attrs.get('superseded_ids')
+        if not ids:
+            return
+        superseded_table = table_name + '__superseded'
+        pd.DataFrame(index=pd.Index(ids, name='Id')).to_sql(
+            superseded_table, con=con, if_exists='replace')
+        con.execute('delete from "{0}" where "Id" in (select "Id" from '
+                    '"{1}")'.format(table_name, superseded_table))
+        con.execute('drop table "{}"'.format(superseded_table))
+        logger.debug('Deleted older rows of %s Ids from table %s', len(ids),
+                     table_name)
+
+    @contextmanager
+    def chunk_transactions(self, checkpoint=None):
+        '''Context manager of a connection in a transaction for writing
+        chunks, committed at the end or rolled back on an error.
+
+        It yields the connection and a function to call with the rows
+        written after each chunk.  With checkpoint that function commits
+        the chunk, calls checkpoint with the rows and begins a new
+        transaction, otherwise it does nothing.
+        '''
+        with self.get_engine().connect() as con:
+            transaction = [con.begin()]
+
+            def chunk_written(rows):
+                if checkpoint is None:
+                    return
+                transaction[0].commit()
+                checkpoint(rows)
+                transaction[0] = con.begin()
+            try:
+                yield con, chunk_written
+            except BaseException:
+                transaction[0].rollback()
+                raise
+            transaction[0].commit()
+
+    def committed_rows(self, table_name):
+        '''Returns the rows a replace or swap load of the table committed
+        before it was interrupted, counted in the table or its staging
+        table.  Returns 0 when there is no such table or for incremental
+        loads, which start again.'''
+        if self.LOAD_MODE == 'swap':
+            table_name = table_name + '__staging'
+        elif self.LOAD_MODE == 'incremental':
+            return 0
+        engine = self.get_engine()
+        if not inspect(engine).has_table(table_name):
+            return 0
+        with engine.connect() as con:
+            return con.execute('select count(*) from "{}"'.format(
+                table_name)).scalar()
+
+    def replace_sqltable(self, table_name, chunks, sqltype_dict,
+                         checkpoint=None, resume_rows=0):
+        '''Drops and recreates the table from the dataframe chunks.
+
+        The first chunk creates or replaces the table and later chunks are
+        appended to it, all of them to the rows already committed when
+        resume_rows is set.  Returns the number of rows written.
+        '''
+        writer = writer_for_uri(self.SQLALCHEMY_DATABASE_URI, self.DB_WRITER)
+        rows = 0
         # create table and write to database.
         # if_exists='replace' drops table and adds
-        contents.to_sql(table_name, con=engine, if_exists='replace',
-                        dtype=sqltype_dict)
-        # Add primary key and in sf.com this is always "Id", if new table
-        engine.execute('alter table "{}" add primary key("Id")'.format(
-            table_name))
+        if_exists = 'append' if resume_rows else 'replace'
+        # One transaction per table so a failed load leaves the table as it
+        # was before, unless each chunk is committed for checkpoint.
+        with self.chunk_transactions(checkpoint) as (con, chunk_written):
+            for chunk in chunks:
+                self.delete_superseded(con, table_name, chunk)
+                chunk.to_sql(table_name, con=con, if_exists=if_exists,
+                             dtype=sqltype_dict, method=writer)
+                logger.debug('Wrote %s rows to table %s', len(chunk),
+                             table_name)
+                rows += len(chunk)
+                if_exists = 'append'
+                chunk_written(resume_rows + rows)
+            self.add_primary_key(con, table_name)
+        return rows
+
+    def swap_sqltable(self, table_name, chunks, sqltype_dict,
+                      checkpoint=None, resume_rows=0):
+        '''Loads the dataframe chunks into a staging table and swaps it in
+        for the table.
+
+        The staging table has no indexes while the rows are written, and on
+        postgresql it is UNLOGGED, so the bulk insert skips index upkeep and
+        WAL.  The primary key is built on the staging table, which is then
+        made LOGGED again.  Only then are the old table dropped and the
+        staging table renamed in one short transaction, so readers see the
+        old table until the new one is complete.
+        With checkpoint each chunk is committed to the staging table, which
+        a resumed load with resume_rows appends the rest of the rows to.
+        Returns the number of rows written.
+        '''
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None and not resume_rows:
+            return 0
+        writer = writer_for_uri(self.SQLALCHEMY_DATABASE_URI, self.DB_WRITER)
+        staging_table = table_name + '__staging'
+        engine = self.get_engine()
+        is_postgresql = engine.dialect.name == 'postgresql'
+        rows = 0
+        if first is not None:
+            chunks = itertools.chain([first], chunks)
+        # Id is written as a plain column, as pandas would otherwise index
+        # it while the rows are inserted.
+        with self.chunk_transactions(checkpoint) as (con, chunk_written):
+            if not resume_rows:
+                self.create_staging_table(con, table_name, first,
+                                          sqltype_dict)
+            for chunk in chunks:
+                self.delete_superseded(con, staging_table, chunk)
+                chunk.reset_index().to_sql(
+                    staging_table, con=con, if_exists='append', index=False,
+                    dtype=sqltype_dict, method=writer)
+                logger.debug('Wrote %s rows to table %s', len(chunk),
+                             staging_table)
+                rows += len(chunk)
+                chunk_written(resume_rows + rows)
+            self.add_primary_key(con, staging_table)
+            if is_postgresql:
+                con.execute('alter table "{}" set logged'.format(
+                    staging_table))
+        self.swap_in(table_name)
+        return rows
+
+    def create_staging_table(self, con, table_name, first, sqltype_dict):
+        '''Creates the empty staging table of the table with the columns of
+        the dataframe, first, UNLOGGED on postgresql.  Returns its name.'''
+        staging_table = table_name + '__staging'
+        first.head(0).reset_index().to_sql(
+            staging_table, con=con, if_exists='replace', index=False,
+            dtype=sqltype_dict)
+        if con.dialect.name == 'postgresql':
+            con.execute('alter table "{}" set unlogged'.format(
+                staging_table))
+        return staging_table
+
+    def swap_in(self, table_name):
+        '''Drops the table and renames its loaded staging table, which has
+        the primary key, to it in one short transaction.'''
+        staging_table = table_name + '__staging'
+        logger.info('Loaded staging table %s, swapping it in for %s',
+                    staging_table, table_name)
+        with self.get_engine().begin() as con:
+            con.execute('drop table if exists "{}"'.format(table_name))
+            con.execute('alter table "{}" rename to "{}"'.format(
+                staging_table, table_name))
+            self.rename_primary_key(con, staging_table, table_name)
+
+    def write_shard(self, table_name, chunks, sqltype_dict):
+        '''Appends the dataframe chunks of one shard of a data file to the
+        staging table of the table in one transaction.  Returns the number
+        of rows written.
+
+        Shards are written by several processes at once, see
+        main.load_sharded_file, so the staging table is created before
+        and the primary key added after, by finish_sharded_load.  Each
+        shard checks its own Ids for duplicates.
+        '''
+        writer = writer_for_uri(self.SQLALCHEMY_DATABASE_URI, self.DB_WRITER)
+        staging_table = table_name + '__staging'
+        tracker = self.id_tracker(table_name)
+        rows = 0
+        with self.chunk_transactions() as (con, _):
+            for chunk in chunks:
+                chunk = tracker.check(self.coerce_chunk(chunk, sqltype_dict))
+                chunk.reset_index().to_sql(
+                    staging_table, con=con, if_exists='append', index=False,
+                    dtype=sqltype_dict, method=writer)
+                logger.debug('Wrote %s rows to table %s', len(chunk),
+                             staging_table)
+                rows += len(chunk)
+        return rows
+
+    def finish_sharded_load(self, table_name):
+        '''Adds the primary key to the staging table written by write_shard
+        and swaps it in for the table.
+
+        An Id in more than one shard fails the primary key, the duplicate
+        Ids are then listed in a DuplicateIdError and the staging table is
+        left for inspection.
+        '''
+        staging_table = table_name + '__staging'
+        engine = self.get_engine()
+        try:
+            with engine.begin() as con:
+                self.add_primary_key(con, staging_table)
+                if con.dialect.name == 'postgresql':
+                    con.execute('alter table "{}" set logged'.format(
+                        staging_table))
+        except IntegrityError as e:
+            duplicated = pd.read_sql(
+                'select "Id" from "{}" group by "Id" having count(*) > 1'
+                .format(staging_table), engine)['Id']
+            raise DuplicateIdError(table_name, sorted(
+                duplicated.astype(str))) from e
+        self.swap_in(table_name)
+
+    def upsert_sqltable(self, table_name, chunks, sqltype_dict):
+        '''Applies only the changes in the dataframe chunks to the existing
+        table.
+
+        Rows are matched on the "Id" primary key.  New rows and rows whose
+        SystemModstamp, or LastModifiedDate, is newer than the stored value
+        are written to a delta table and then replace the stored rows.
+        Stored rows whose Id is no longer in the file are deleted.
+        Falls back to replace_sqltable when the table does not exist, has
+        no modstamp column or its columns differ from the file.
+        Returns the number of rows inserted or updated.
+        '''
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
+            return 0
+        chunks = itertools.chain([first], chunks)
+        engine = self.get_engine()
+        stamp_cols = [c for c in self.modstamp_columns if c in first.columns]
+        inspector = inspect(engine)
+        if stamp_cols and inspector.has_table(table_name):
+            table_cols = {c['name'] for c in
+                          inspector.get_columns(table_name)}
+            is_upsertable = table_cols == set(first.columns) | {'Id'}
+        else:
+            is_upsertable = False
+        if not is_upsertable:
+            logger.info('Table %s cannot be loaded incrementally, '
+                        'replacing it', table_name)
+            return self.replace_sqltable(table_name, chunks, sqltype_dict)
+        stamp_col = stamp_cols[0]
+        writer = writer_for_uri(self.SQLALCHEMY_DATABASE_URI, self.DB_WRITER)
+        delta_table = table_name + '__delta'
+        deleted_table = table_name + '__deleted'
+        cols = ', '.join('"{}"'.format(c)
+                         for c in ['Id'] + list(first.columns))
+        rows = 0
+        with engine.begin() as con:
+            stored = pd.read_sql(
+                'select "Id", "{}" from "{}"'.format(stamp_col, table_name),
+                con, index_col='Id')
+            stored_stamps = pd.to_datetime(stored[stamp_col], utc=True,
+                                           errors='coerce')
+            seen = np.zeros(len(stored), dtype=bool)
+            if_exists = 'replace'
+            for chunk in chunks:
+                positions = stored.index.get_indexer(chunk.index)
+                seen[positions[positions >= 0]] = True
+                new_stamps = pd.to_datetime(chunk[stamp_col], utc=True,
+                                            errors='coerce')
+                old_stamps = stored_stamps.reindex(chunk.index)
+                changed = (old_stamps.isna() | (new_stamps > old_stamps))
+                delta = chunk[changed.values]
+                self.delete_superseded(con, delta_table, chunk)
+                delta.to_sql(delta_table, con=con, if_exists=if_exists,
+                             dtype=sqltype_dict, method=writer)
+                if_exists = 'append'
+                rows += len(delta)
+            deleted = pd.DataFrame(index=stored.index[~seen])
+            deleted.to_sql(deleted_table, con=con, if_exists='replace')
+            con.execute('delete from "{0}" where "Id" in (select "Id" from '
+                        '"{1}") or "Id" in (select "Id" from "{2}")'.format(
+                            table_name, delta_table, deleted_table))
+            con.execute('insert into "{0}" ({1}) select {1} from "{2}"'
+                        .format(table_name, cols, delta_table))
+            con.execute('drop table "{}"'.format(delta_table))
+            con.execute('drop table "{}"'.format(deleted_table))
+        logger.info('Upserted %s rows and deleted %s rows in table %s',
+                    rows, len(deleted), table_name)
+        return rows
+
+    def reference_columns(self, table_name, sample_rows=100):
+        '''Returns the reference (lookup) columns of the table.
+
+        Reference columns are named like "AccountId", "OwnerId" or a
+        custom "Account__c" and a sample of their values are all sf.com
+        record ids.  Columns matching INDEX_INCLUDE are references
+        regardless, columns matching INDEX_EXCLUDE never are.
+        '''
+        engine = self.get_engine()
+        columns = [c['name'] for c in inspect(engine).get_columns(table_name)
+                   if c['name'] != 'Id']
+        references = []
+        for column in columns:
+            if self.column_rule_match(self.INDEX_EXCLUDE, table_name, column):
+                continue
+            if self.column_rule_match(self.INDEX_INCLUDE, table_name, column):
+                references.append(column)
+                continue
+            if not (column.endswith('Id') or column.endswith('__c')):
+                continue
+            sample = pd.read_sql(
+                'select "{0}" from "{1}" where "{0}" is not null limit {2}'
+                .format(column, table_name, sample_rows), engine)[column]
+            values = sample.astype(str)
+            if (not values.empty and values.str.fullmatch(SFID_PATTERN).all()
+                    and values.str.contains(r'\d').all()):
+                references.append(column)
+        logger.debug('Reference columns of %s are %s', table_name,
+                     references)
+        return references
+
+    def create_index(self, table_name, column):
+        '''Creates the index "ix_<table>_<column>" on the column unless it
+        exists.  Returns the index name.
+
+        On postgresql the index is built CONCURRENTLY, outside a
+        transaction, so the table stays readable and writable while it is
+        built.  An invalid index left by a failed build is dropped.
+        '''
+        # postgresql truncates identifiers to 63 characters
+        index_name = 'ix_{}_{}'.format(table_name, column.lower())[:63]
+        engine = self.get_engine()
+        if engine.dialect.name == 'postgresql':
+            sql = 'create index concurrently if not exists "{}" on "{}" ' \
+                '("{}")'.format(index_name, table_name, column)
+            with engine.connect().execution_options(
+                    isolation_level='AUTOCOMMIT') as con:
+                try:
+                    con.execute(sql)
+                except Exception:
+                    con.execute('drop index concurrently if exists "{}"'
+                                .format(index_name))
+                    raise
+        else:
+            with engine.begin() as con:
+                con.execute('create index if not exists "{}" on "{}" ("{}")'
+                            .format(index_name, table_name, column))
+        logger.info('Created index %s', index_name)
+        return index_name
+
+    def build_reference_indexes(self, table_names):
+        '''Creates indexes on the reference columns of the tables, see
+        reference_columns, after they are loaded.
+
+        On postgresql INDEX_WORKERS indexes are built at once, SQLite builds
+        them one at a time.  A failed index is logged and the others are
+        still built.  Returns the names of the indexes created.
+        '''
+        jobs = [(t, c) for t in table_names for c in self.reference_columns(t)]
+        workers = self.INDEX_WORKERS
+        if self.get_engine().dialect.name == 'sqlite':
+            workers = 1
+        logger.info('Building %s reference column indexes with %s workers',
+                    len(jobs), workers)
+        created = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.create_index, t, c): (t, c)
+                       for t, c in jobs}
+            for future in as_completed(futures):
+                try:
+                    created.append(future.result())
+                except Exception:
+                    logger.exception('Index on %s.%s failed',
+                                     *futures[future])
+        return sorted(created)
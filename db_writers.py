@@ -0,0 +1,78 @@
+'''Table writers used by DataProc.write_sqltables
+
+Each writer is a callable with the signature pandas expects for the method
+argument of DataFrame.to_sql, i.e. writer(pd_table, conn, keys, data_iter).
+pandas still creates the table with the sqlalchemy types, the writer only
+decides how the rows are sent to the database.
+'''
+import csv
+import io
+import itertools
+from sqlalchemy.engine.url import make_url
+import logging
+
+logger = logging.getLogger('main.db_writers')
+
+# Rows per executemany round trip
+EXECUTEMANY_BATCH = 10000
+
+
+def copy_writer(pd_table, conn, keys, data_iter):
+    '''Writes rows with PostgreSQL COPY FROM STDIN.
+
+    The rows are CSV encoded into an in-memory buffer, which is streamed to
+    the server through the psycopg2 cursor of the connection pandas is
+    using, so the copy takes part in the same transaction.
+    '''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+    columns = ', '.join('"{}"'.format(k) for k in keys)
+    if pd_table.schema:
+        table_name = '"{}"."{}"'.format(pd_table.schema, pd_table.name)
+    else:
+        table_name = '"{}"'.format(pd_table.name)
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table_name, columns)
+    logger.debug('Running %s', sql)
+    dbapi_conn = conn.connection
+    with dbapi_conn.cursor() as cursor:
+        cursor.copy_expert(sql=sql, file=buffer)
+
+
+def executemany_writer(pd_table, conn, keys, data_iter):
+    '''Writes rows with a multi-row executemany insert for any dialect.
+
+    Rows are sent in batches of EXECUTEMANY_BATCH so only one batch of
+    parameter dicts is built at a time.
+    '''
+    insert = pd_table.table.insert()
+    while True:
+        batch = [dict(zip(keys, row))
+                 for row in itertools.islice(data_iter, EXECUTEMANY_BATCH)]
+        if not batch:
+            break
+        conn.execute(insert, batch)
+
+
+# Writer names that can be used for DB_WRITER.  'default' leaves the insert
+# method to pandas.
+writers = {
+    'copy': copy_writer,
+    'executemany': executemany_writer,
+    'default': None,
+}
+
+
+def writer_for_uri(database_uri, writer_name='auto'):
+    '''Returns the writer callable for the database URI.
+
+    With writer_name 'auto' the writer is picked from the dialect of the
+    URI, COPY for postgresql and executemany for everything else.  Any other
+    writer_name must be a key of writers.
+    '''
+    if writer_name == 'auto':
+        dialect = make_url(database_uri).get_backend_name()
+        writer_name = 'copy' if dialect == 'postgresql' else 'executemany'
+    logger.debug('Using table writer %s', writer_name)
+    return writers[writer_name]
@@ -1,144 +1,831 @@
 '''Introduction of file processor'''
 import os
-import sys
+import json
+import queue
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from config import Config
+from data_files import iter_3sample, data_file_ext, open_data_file, \
+    data_file_stat, data_file_size, find_data_files, split_archive_path, \
+    table_name_for, open_byte_range, COMPRESSED_EXT
+from spreadsheet_readers import spreadsheet_readers
 import logging
 
 logger = logging.getLogger('main.file_processor')
 
+# Column statistics from FileInfo.df_column_profile.  The first two items,
+# dtype and typical value, are what DataProc.pdtype2sqltype_default reads.
+ColumnProfile = namedtuple('ColumnProfile', ['dtype', 'typical_value',
+                                             'null_ratio', 'max_length',
+                                             'n_distinct'])
+# Rows the distinct value counts of a column profile are estimated from
+PROFILE_SAMPLE_ROWS = 10000
 
-def iter_3sample(an_iterable):
-    '''Accepts a list, tuple or any indexed iterable and returns a tuple with
-    the length of the iterable, first, middle and last item in the iterable.
+# Arrow CSV reader settings giving the values pd.read_csv gives, see
+# FileInfo.arrow_csv_chunks.  NA_VALUES are the pandas default NA strings.
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+             '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN',
+             'None', 'n/a', 'nan', 'null']
+TRUE_VALUES = ['True', 'TRUE', 'true']
+FALSE_VALUES = ['False', 'FALSE', 'false']
+# Bytes of the file parsed per Arrow block, the first block sets the types
+ARROW_BLOCK_SIZE = 1 << 24
+# Rows per chunk when scanning a CSV file for empty columns
+SCAN_CHUNK_ROWS = 100000
+
+
+def naive_utc_dates(contents):
+    '''Converts the timezone aware datetime columns of the dataframe, e.g.
+    parsed from sf.com "2018-05-09T18:10:39.000Z" values, to naive UTC.'''
+    for c in contents.columns:
+        if isinstance(contents[c].dtype, pd.DatetimeTZDtype):
+            contents[c] = contents[c].dt.tz_convert(None)
+    return contents
+
+
+def skip_rows(chunks, n_rows):
+    '''Yields the dataframe chunks without their first n_rows rows.'''
+    for chunk in chunks:
+        if n_rows >= len(chunk):
+            n_rows -= len(chunk)
+            continue
+        yield chunk.iloc[n_rows:]
+        n_rows = 0
+
+
+def prefetch_chunks(chunks, depth):
+    '''Yields the chunks of the chunks iterable, which are read ahead by a
+    thread into a queue of at most depth chunks.
+
+    The next chunks are parsed while the current one is written to the
+    database, with at most depth + 2 chunks in memory.  An exception raised
+    reading the chunks is raised here, after the chunks read before it.
+    When the consumer stops early the thread stops and closes chunks.
+    '''
+    chunk_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        '''Puts the item on the queue unless stop is set first.'''
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_ahead():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    break
+            else:
+                put((None, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    reader = threading.Thread(target=read_ahead, name='prefetch_chunks',
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk, error = chunk_queue.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def max_str_length(values):
+    '''Returns the length of the longest of the non-null values of an
+    object column, as text.'''
+    try:
+        # Lengths of strings without creating a series of them
+        return max(map(len, values))
+    except TypeError:
+        # Values other than strings, e.g. Python bools, are measured as text
+        return max(map(len, map(str, values)))
+
+
+def estimate_distinct(sample, n_values):
+    '''Returns the estimated number of distinct values of a column from a
+    sample of it.  n_values is the number of non-null values of the whole
+    column.
+
+    The estimate is the Chao1 estimator, the distinct values of the sample
+    plus those expected to be unseen, from the values seen once and twice.
+    It is exact when the sample is the whole column.
     '''
-    length = len(an_iterable)
-    if length >= 3:
-        sample = (length, an_iterable[0], an_iterable[length//2],
-                  an_iterable[length-1])
-    elif length == 2:
-        sample = (length, an_iterable[0], an_iterable[1])
-    elif length == 1:
-        sample = (length, an_iterable[0])
-    else:
-        sample = (length)
-    return sample
+    counts = sample.value_counts()
+    n_sampled = int(counts.sum())
+    if n_sampled >= n_values:
+        return len(counts)
+    once = int((counts == 1).sum())
+    twice = int((counts == 2).sum())
+    estimate = len(counts) + once * (once - 1) / (2 * (twice + 1))
+    return int(min(round(estimate), n_values))
 
 
 class FileInfo(Config):
     def __init__(self):
         Config.__init__(self)
-        logger.info('FileInfo initialized with Config inheritance')
-        logger.info('DEBUG = %s', self.DEBUG)
-        logger.info('SQLALCHEMY_DATABASE_URI = %s',
-                    self.SQLALCHEMY_DATABASE_URI)
-        logger.info('SQLALCHEMY_TRACK_MODIFICATIONS = %s',
-                    self.SQLALCHEMY_TRACK_MODIFICATIONS)
-        logger.info('DATA_FILES = %s', self.DATA_FILES)
-        logger.info('DATAFILE_EXTS = %s', self.DATAFILE_EXTS)
-        logger.info('self.sql_types = %s', self.sql_types)
+        # The settings are logged once, by Config.log_settings
+        logger.debug('FileInfo initialized with Config inheritance')
+        # pandas dtypes to parse columns of each sql type with.  Date and
+        # DateTime columns are parsed as dates instead.
+        self.pd_dtypes = {
+            'String': str,
+            'Unicode': str,
+            'Integer': 'Int64',
+            'Float': 'float64',
+            'Numeric': 'float64',
+            'Boolean': 'boolean',
+        }
 
     def get_data_filenames(self):
-        '''Recursively walks through a *ix system file directory and returns
-        a list of file names having file extensions found in the iterable,
-        file_extensions.
+        '''Returns the data files under DATA_FILES having one of the
+        DATAFILE_EXTS extensions, see data_files.find_data_files.'''
+        return find_data_files(self.DATA_FILES, self.DATAFILE_EXTS)
 
-        Arguments:
-        root_dir is the full path as a String where the recursive walk using
-        os.walk starts.
+    def df_column_profile(self, pd_df):
+        '''Accepts a pandas dataframe and returns a dict of ColumnProfile
+        tuples by column name.
 
-        file_extensions is an iterable of Strings, where each string is a
-        desired file extension with no leading "."  e.g. "csv" not ".csv"
-        Though these are stripped in any case.
+        Each profile starts with the pd dtype and a typical value, the first
+        non-null value or 'None' for an all null column, so the dict can be
+        passed straight to DataProc.pdtype2sqltype_default.  It also carries
+        the null ratio, the maximum string length of object columns and the
+        number of distinct values, estimated from PROFILE_SAMPLE_ROWS rows by
+        estimate_distinct.  The other statistics are computed column-wise
+        on the whole dataframe rather than by iterating over rows.
         '''
-        root_dir = self.DATA_FILES
-        file_extensions = self.DATAFILE_EXTS
-        logger.info('Using %s to retrieve data file names', root_dir)
-        logger.debug('File ext before stripping "." is %s', file_extensions)
-        file_extensions = [f.strip(".") for f in file_extensions]
-        logger.info(
-            'Filtering file names that have one of these extensions: %s',
-            file_extensions,
-        )
-        logger.warning('File extension strings containg a "." has '
-                       'been removed')
-
-        def is_valid_ext(filename):
-            '''Determines if a filename has extension a valid extension
-
-            A file name and an iterable of acceptable extensions are passed to
-            the function and returns True if the file has an extension and is
-            a member of the acceptable extensions.
-            '''
-            return (filename.split('.')[-1] in file_extensions and
-                    len(filename.split('.')) > 1)
-        # list comprehension of candidate file names
-        path_files = [str(p).rstrip('/') + '/' + str(f)
-                      for p, d, fs in os.walk(root_dir) for f in fs]
+        col_names = list(pd_df.columns.values)
         logger.debug(
-            'Sample candidate file names are %s. Total, 1st, middle and last',
-            iter_3sample(path_files))
-        # filter only file names with a file extension in file extensions
-        filtered_path_files = list(filter(is_valid_ext, path_files))
+            'Sample df column names are %s. Total, 1st, middle and last',
+            iter_3sample(col_names))
+        n_rows = len(pd_df)
+        notna = pd_df.notna()
+        non_null_counts = notna.sum().values
+        # Row position of the first non-null value of each column
+        first_positions = notna.values.argmax(axis=0) if n_rows else []
+        if n_rows > PROFILE_SAMPLE_ROWS:
+            sample = pd_df.sample(PROFILE_SAMPLE_ROWS, random_state=0)
+        else:
+            sample = pd_df
+        profile = {}
+        for i, c in enumerate(col_names):
+            column = pd_df.iloc[:, i]
+            if non_null_counts[i]:
+                typical_val = str(column.iat[first_positions[i]])
+            else:
+                typical_val = 'None'
+            if column.dtype.name == 'object' and non_null_counts[i]:
+                max_length = max_str_length(
+                    column.values[notna.values[:, i]])
+            else:
+                max_length = None
+            null_ratio = (1 - non_null_counts[i] / n_rows) if n_rows else 1.0
+            profile[c] = ColumnProfile(
+                column.dtype.name, typical_val, float(null_ratio), max_length,
+                estimate_distinct(sample.iloc[:, i], non_null_counts[i]))
         logger.debug(
-            'Sample filtered file names are %s. Total, 1st, middle and last',
-            iter_3sample(filtered_path_files))
-        # Ensuring there are no duplicate file names in data file directory
-        # structure
-        filenames_pathremoved = [x.split('/')[-1] for x in filtered_path_files]
-        reduced_filenames = list(set(filenames_pathremoved))
-        if len(filenames_pathremoved) != len(reduced_filenames):
-            print('\nThere are one more data files with the same name in the '
-                  'directory structure under "{}".'.format(root_dir))
-            print('\nPlease inspect the data file structure for duplicate '
-                  'file names.')
-            sys.exit('and correct so all data files are named uniquely. '
-                     'Exiting.')
-        return filtered_path_files
+            'Sample column profiles are %s. Total, 1st, middle and last',
+            iter_3sample(list(profile.items())))
+        return profile
 
     def df_column_dtypes(self, pd_df):
         '''Accepts a pandas dataframe and returns a dict of pd dtypes with
         a typical value for each column.'''
-        # column names from df
-        col_names = list(pd_df.columns.values)
-        logger.debug(
-            'Sample df column names are %s. Total, 1st, middle and last',
-            iter_3sample(col_names))
-        # for each column find a typical value
-        col_typical_vals = []
-        for c in col_names:
-            vals = list(pd_df[c])
-            for v in vals:
-                if v == 'nan':
-                    typical_val = 'None'
-                    pass
-                else:
-                    typical_val = str(v)
-                    break
-            col_typical_vals.append(typical_val)
-        logger.debug(
-            'Sample typical df values per column are %s. Total, 1st, '
-            'middle and last', iter_3sample(col_typical_vals))
-        # create a single list of tuples (column name, typical value)
-        r = range(len(col_names))
-        col_names_vals = [(col_names[i], col_typical_vals[i]) for i in r]
-        logger.debug(
-            'Sample (column name, typical value) are %s. Total, 1st, '
-            'middle and last', iter_3sample(col_names_vals))
         # return a dict with column name: (dtype, typical value)
-        return {k[0]: (pd_df[k[0]].dtype.name, k[1])
-                for k in col_names_vals}
-
-    def file_reader(self, path_filename):
-            ext = path_filename.split('.')[-1]
-            if ext == 'csv':
-                contents = pd.read_csv(path_filename, index_col='Id',
-                                       encoding='utf-8')
+        return {k: (v.dtype, v.typical_value)
+                for k, v in self.df_column_profile(pd_df).items()}
+
+    def csv_read_kwargs(self, path_filename, sqltype_names=None):
+        '''Returns the keyword arguments for pd.read_csv of the data file.
+
+        sqltype_names is the dict of type names from the table's type JSON.
+        If its columns match the header of the file, explicit dtypes and
+        date columns are passed so pandas does not infer them.  With
+        TYPE_JSON_USECOLS on, columns of the file missing from the type JSON
+        are not read at all.  Otherwise the types are not used.
+        Columns pruned from the table, see pruned_columns, are not read.
+        '''
+        kwargs = {'index_col': 'Id', 'encoding': 'utf-8'}
+        is_pruning = self.PRUNE_EMPTY_COLUMNS or self.COLUMN_EXCLUDE
+        if not sqltype_names and not is_pruning:
+            return kwargs
+        with open_data_file(path_filename) as file_obj:
+            header = list(pd.read_csv(file_obj, nrows=0,
+                                      encoding='utf-8').columns)
+        if is_pruning:
+            pruned = self.pruned_columns(path_filename, header)
+            if pruned:
+                header = [c for c in header if c not in pruned]
+                kwargs['usecols'] = header
+                logger.info('Leaving out columns %s of %s', sorted(pruned),
+                            path_filename)
+        if not sqltype_names:
+            return kwargs
+        file_cols = set(header) - {'Id'}
+        if self.SCHEMA_REGISTRY:
+            # The version of the table stored for the file's columns
+            sqltype_names = self.read_type_json(
+                self.type_json_file(table_name_for(path_filename)),
+                file_cols)
+        json_cols = set(sqltype_names)
+        if self.TYPE_JSON_USECOLS and json_cols <= file_cols:
+            kwargs['usecols'] = [c for c in header
+                                 if c in json_cols or c == 'Id']
+            logger.debug('Not reading columns %s of %s missing from the '
+                         'type JSON', file_cols - json_cols, path_filename)
+        elif json_cols != file_cols:
+            logger.info('Columns of %s do not match the type JSON, letting '
+                        'pandas infer types', path_filename)
+            return kwargs
+        dtype = {'Id': str}
+        parse_dates = []
+        for c, type_name in sqltype_names.items():
+            base_name = type_name.split('(')[0].strip()
+            if base_name in ('Date', 'DateTime'):
+                parse_dates.append(c)
             else:
-                print("\nFile extension {} not yet implemented".format(ext))
-                print('Continuing with other file types.')
-                contents = None
-            return contents
+                dtype[c] = self.pd_dtypes[base_name]
+        kwargs.update(dtype=dtype, parse_dates=parse_dates,
+                      date_format='ISO8601')
+        return kwargs
+
+    def pruned_columns(self, path_filename, header):
+        '''Returns the set of columns of the data file, whose header is
+        the list of column names, to leave out of its table.
+
+        They are the columns matching COLUMN_EXCLUDE and, with
+        PRUNE_EMPTY_COLUMNS on, the columns with no values.  The empty
+        columns are found by empty_columns at the first load of the table
+        and recorded with write_pruned_json.  Later loads leave out the
+        recorded columns, so the table keeps its columns even when a column
+        gets values.  Delete the table's _pruned.json file to find the
+        empty columns again.  "Id" is never left out.
+        '''
+        table_name = table_name_for(path_filename)
+        pruned = {c for c in header if self.column_rule_match(
+            self.COLUMN_EXCLUDE, table_name, c)}
+        if self.PRUNE_EMPTY_COLUMNS:
+            empty = self.read_pruned_json(table_name)
+            if empty is None:
+                empty = self.empty_columns(path_filename, header)
+                self.write_pruned_json(table_name, empty)
+            pruned.update(c for c in empty if c in header)
+        pruned.discard('Id')
+        return pruned
+
+    def empty_columns(self, path_filename, header):
+        '''Returns the set of columns of the data file, whose header is
+        the list of column names, with no value in any row.
+
+        The whole file is read, in chunks of SCAN_CHUNK_ROWS rows for a CSV
+        file without converting the values, and the scan stops once every
+        column was found to have a value.
+        '''
+        empty = set(header) - {'Id'}
+        ext = data_file_ext(path_filename)
+        if ext == 'csv':
+            with open_data_file(path_filename) as file_obj, \
+                    pd.read_csv(file_obj, dtype=str, encoding='utf-8',
+                                chunksize=SCAN_CHUNK_ROWS) as reader:
+                for chunk in reader:
+                    empty -= set(chunk.columns[chunk.notna().any()])
+                    if not empty:
+                        break
+        elif ext in spreadsheet_readers:
+            read_rows = spreadsheet_readers[ext]
+            with open_data_file(path_filename) as file_obj:
+                rows = read_rows(file_obj, self.SPREADSHEET_SHEET or None)
+                next(rows, None)
+                positions = [i for i, c in enumerate(header) if c in empty]
+                for row in rows:
+                    positions = [i for i in positions
+                                 if i >= len(row) or row[i] is None]
+                    if not positions:
+                        break
+                empty = {header[i] for i in positions}
+        logger.info('Found %s empty columns in %s', len(empty),
+                    path_filename)
+        return empty
+
+    def csv_chunks(self, path_filename, sqltype_names=None, chunksize=None):
+        '''Yields the CSV data file as pandas dataframes indexed on "Id" of
+        at most chunksize rows, or the whole file if chunksize is None.
+
+        With CSV_ENGINE "arrow" the file is parsed by arrow_csv_chunks.  If
+        Arrow cannot parse it like pandas would, the file is read by
+        pandas_csv_chunks instead, from the first row not yet yielded.
+        '''
+        if self.CSV_ENGINE != 'arrow':
+            yield from self.pandas_csv_chunks(path_filename, sqltype_names,
+                                              chunksize)
+            return
+        n_rows = 0
+        try:
+            for chunk in self.arrow_csv_chunks(path_filename, sqltype_names,
+                                               chunksize):
+                n_rows += len(chunk)
+                yield chunk
+            return
+        except ImportError:
+            logger.warning('pyarrow is not installed, reading %s with '
+                           'pandas', path_filename)
+        except (ValueError, TypeError, NotImplementedError) as e:
+            # pyarrow.ArrowInvalid is a ValueError
+            logger.warning('Arrow could not parse %s (%s), reading it with '
+                           'pandas from row %s', path_filename, e, n_rows)
+        yield from skip_rows(self.pandas_csv_chunks(
+            path_filename, sqltype_names, chunksize), n_rows)
+
+    def pandas_csv_chunks(self, path_filename, sqltype_names=None,
+                          chunksize=None):
+        '''Yields the CSV data file as csv_chunks does, parsed by the
+        pandas C parser.
+
+        The dtypes come from sqltype_names when it fits the file, see
+        csv_read_kwargs.  If the first chunk cannot be parsed with those
+        types the file is read again with types inferred by pandas.
+        The file is streamed through open_data_file.
+        '''
+        kwargs = self.csv_read_kwargs(path_filename, sqltype_names)
+        is_first = True
+        try:
+            with open_data_file(path_filename) as file_obj, \
+                    pd.read_csv(file_obj, iterator=True,
+                                chunksize=chunksize, **kwargs) as reader:
+                for chunk in reader:
+                    is_first = False
+                    yield naive_utc_dates(chunk)
+        except ValueError:
+            if not is_first or 'dtype' not in kwargs:
+                raise
+            logger.warning('Could not parse %s with the type JSON types, '
+                           'letting pandas infer types', path_filename)
+            kwargs = self.csv_read_kwargs(path_filename)
+            with open_data_file(path_filename) as file_obj, \
+                    pd.read_csv(file_obj, iterator=True,
+                                chunksize=chunksize, **kwargs) as reader:
+                for chunk in reader:
+                    yield chunk
+
+    def is_shardable(self, path_filename):
+        '''Returns True if the data file is a plain CSV file of at least
+        SHARD_MIN_MB, which can be read in byte range shards, see
+        shard_chunks.'''
+        return (self.SHARD_WORKERS > 1 and
+                data_file_ext(path_filename) == 'csv' and
+                split_archive_path(path_filename)[1] is None and
+                not path_filename.lower().endswith('.' + COMPRESSED_EXT) and
+                data_file_size(path_filename) >= self.SHARD_MIN_MB << 20)
+
+    def shard_chunks(self, path_filename, start, end, sqltype_names=None,
+                     chunksize=None):
+        '''Yields the rows in the byte range start to end of the CSV data
+        file, a shard from data_files.csv_shard_ranges, as csv_chunks
+        does.
+
+        The shard has no header, the column names are read from the start
+        of the file.  Shards are always parsed by pandas, with the types of
+        sqltype_names when they fit the file, see csv_read_kwargs.
+        '''
+        kwargs = self.csv_read_kwargs(path_filename, sqltype_names)
+        with open_data_file(path_filename) as file_obj:
+            header = list(pd.read_csv(file_obj, nrows=0,
+                                      encoding='utf-8').columns)
+        with open_byte_range(path_filename, start, end) as file_obj, \
+                pd.read_csv(file_obj, header=None, names=header,
+                            iterator=True, chunksize=chunksize,
+                            **kwargs) as reader:
+            for chunk in reader:
+                yield naive_utc_dates(chunk)
+
+    @contextmanager
+    def arrow_source(self, path_filename):
+        '''Context manager of the data file as a source for the Arrow CSV
+        reader, memory mapped unless it is compressed or in an archive.'''
+        import pyarrow as pa
+        if split_archive_path(path_filename)[1] is None and \
+                not path_filename.lower().endswith('.' + COMPRESSED_EXT):
+            with pa.memory_map(path_filename) as source:
+                yield source
+        else:
+            with open_data_file(path_filename) as source:
+                yield source
+
+    def arrow_csv_chunks(self, path_filename, sqltype_names=None,
+                         chunksize=None):
+        '''Yields the CSV data file as pandas_csv_chunks does, parsed by the
+        multithreaded Arrow CSV reader.
+
+        The dataframes are those pandas gives.  Types are inferred by Arrow
+        but date and timestamp columns are kept as text, as pandas keeps
+        them, unless they are Date or DateTime columns of sqltype_names.
+        The whole file is read in one go, with its types inferred from all
+        of it.  Chunks are streamed with the types of the first block of
+        the file, a column empty there being converted in each chunk.
+        Raises ValueError, e.g. pyarrow.ArrowInvalid, for values the types
+        do not fit, and ImportError without pyarrow.
+        '''
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+        kwargs = self.csv_read_kwargs(path_filename, sqltype_names)
+        read_options = pa_csv.ReadOptions(use_threads=True,
+                                          block_size=ARROW_BLOCK_SIZE)
+        # Long text areas have line breaks in quoted values
+        parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+        convert_args = {
+            'null_values': NA_VALUES,
+            'strings_can_be_null': True,
+            'true_values': TRUE_VALUES,
+            'false_values': FALSE_VALUES,
+            'include_columns': kwargs.get('usecols', []),
+        }
+        parse_dates = kwargs.get('parse_dates', [])
+        types_mapper = None
+        # Columns typed from an empty first block, converted per chunk
+        loose_cols = set()
+        if 'dtype' in kwargs:
+            arrow_types = {str: pa.string(), 'Int64': pa.int64(),
+                           'float64': pa.float64(), 'boolean': pa.bool_()}
+            column_types = {c: arrow_types[t]
+                            for c, t in kwargs['dtype'].items()}
+            column_types.update((c, pa.string()) for c in parse_dates)
+            types_mapper = {pa.int64(): pd.Int64Dtype(),
+                            pa.bool_(): pd.BooleanDtype()}.get
+        else:
+            with self.arrow_source(path_filename) as source:
+                schema = pa_csv.open_csv(
+                    source, read_options=read_options,
+                    parse_options=parse_options,
+                    convert_options=pa_csv.ConvertOptions(
+                        **convert_args)).schema
+            column_types = {}
+            for field in schema:
+                if pa.types.is_temporal(field.type):
+                    column_types[field.name] = pa.string()
+                elif pa.types.is_null(field.type) and chunksize:
+                    column_types[field.name] = pa.string()
+                    loose_cols.add(field.name)
+        convert_options = pa_csv.ConvertOptions(column_types=column_types,
+                                                **convert_args)
+
+        def make_frame(table):
+            # pandas has NaN, not None, in object columns
+            nan_cols = []
+            for i, field in enumerate(table.schema):
+                if pa.types.is_string(field.type) or (
+                        pa.types.is_boolean(field.type) and
+                        types_mapper is None):
+                    if table.column(i).null_count:
+                        nan_cols.append(field.name)
+                elif pa.types.is_date32(field.type):
+                    # Inferred past the first block, the text is YYYY-MM-DD
+                    table = table.set_column(i, field.name, table.column(
+                        i).cast(pa.string()))
+                elif pa.types.is_temporal(field.type):
+                    raise ValueError('Column {} was parsed as {}'.format(
+                        field.name, field.type))
+                elif pa.types.is_null(field.type):
+                    table = table.set_column(i, field.name, table.column(
+                        i).cast(pa.float64()))
+            contents = table.to_pandas(types_mapper=types_mapper)
+            for c in nan_cols:
+                contents[c] = contents[c].where(contents[c].notna(), np.nan)
+            for c in loose_cols:
+                if contents[c].isna().all():
+                    contents[c] = contents[c].astype('float64')
+                else:
+                    try:
+                        contents[c] = pd.to_numeric(contents[c])
+                    except (ValueError, TypeError):
+                        pass
+            for c in parse_dates:
+                contents[c] = pd.to_datetime(contents[c], format='ISO8601')
+            return naive_utc_dates(contents.set_index('Id'))
+        with self.arrow_source(path_filename) as source:
+            if not chunksize:
+                yield make_frame(pa_csv.read_csv(
+                    source, read_options=read_options,
+                    parse_options=parse_options,
+                    convert_options=convert_options))
+                return
+            reader = pa_csv.open_csv(source, read_options=read_options,
+                                     parse_options=parse_options,
+                                     convert_options=convert_options)
+            batches = []
+            n_rows = 0
+            for batch in reader:
+                batches.append(batch)
+                n_rows += batch.num_rows
+                while n_rows >= chunksize:
+                    table = pa.Table.from_batches(batches, reader.schema)
+                    yield make_frame(table.slice(0, chunksize))
+                    table = table.slice(chunksize)
+                    batches = table.to_batches()
+                    n_rows = table.num_rows
+            if n_rows:
+                yield make_frame(pa.Table.from_batches(batches,
+                                                       reader.schema))
+
+    def spreadsheet_chunks(self, path_filename, chunksize=None):
+        '''Yields one sheet of an xlsx, xls or ods data file as pandas
+        dataframes indexed on "Id" of at most chunksize rows, or the whole
+        sheet if chunksize is None.
+
+        The sheet is SPREADSHEET_SHEET or the first sheet.  Rows are
+        streamed from the reader in spreadsheet_readers, the first row being
+        the header, and only one chunk of them is held at a time.  Empty
+        rows are skipped and nothing is yielded for an empty sheet.
+        '''
+        read_rows = spreadsheet_readers[data_file_ext(path_filename)]
+
+        def make_frame(rows):
+            contents = pd.DataFrame.from_records(rows, columns=header)
+            return contents.infer_objects().set_index('Id')
+        with open_data_file(path_filename) as file_obj:
+            rows = read_rows(file_obj, self.SPREADSHEET_SHEET or None)
+            header = next(rows, None)
+            while header and header[-1] is None:
+                header.pop()
+            if not header:
+                logger.info('No data in sheet of %s', path_filename)
+                return
+            keep = None
+            if self.PRUNE_EMPTY_COLUMNS or self.COLUMN_EXCLUDE:
+                pruned = self.pruned_columns(path_filename, header)
+                if pruned:
+                    keep = [i for i, c in enumerate(header)
+                            if c not in pruned]
+                    logger.info('Leaving out columns %s of %s',
+                                sorted(pruned), path_filename)
+            n_cols = len(header)
+            if keep is not None:
+                header = [header[i] for i in keep]
+            batch = []
+            for row in rows:
+                if all(v is None for v in row):
+                    continue
+                row = row[:n_cols]
+                row = row + [None] * (n_cols - len(row))
+                if keep is not None:
+                    row = [row[i] for i in keep]
+                batch.append(row)
+                if chunksize and len(batch) == chunksize:
+                    yield make_frame(batch)
+                    batch = []
+            if batch:
+                yield make_frame(batch)
+
+    def file_reader(self, path_filename, sqltype_names=None):
+        '''Reads the whole data file into a pandas dataframe indexed on
+        "Id", using the optional type JSON names as in csv_read_kwargs.
+        Returns None for file types that are not implemented or when there
+        is no data in a spreadsheet.'''
+        ext = data_file_ext(path_filename)
+        if ext == 'csv':
+            contents = next(self.csv_chunks(path_filename, sqltype_names))
+        elif ext in spreadsheet_readers:
+            contents = next(self.spreadsheet_chunks(path_filename), None)
+        else:
+            print("\nFile extension {} not yet implemented".format(ext))
+            print('Continuing with other file types.')
+            contents = None
+        return contents
+
+    def file_chunk_reader(self, path_filename, sqltype_names=None,
+                          fingerprint=None):
+        '''Generator version of file_reader that yields the file contents as
+        pandas dataframes of at most CHUNK_SIZE rows.
+
+        Only one chunk is held in memory at a time, so peak memory depends on
+        CHUNK_SIZE and not on the size of the file.  If CHUNK_SIZE is 0 the
+        whole file is yielded as a single dataframe.  Nothing is yielded for
+        file types that are not implemented.
+        With PARQUET_CACHE_PATH set the parsed file is cached, see
+        parquet_cached_chunks.  fingerprint is the data file's fingerprint
+        from file_fingerprint, if it is already known.  With PREFETCH_CHUNKS
+        set the next chunks are read while the caller writes the current
+        one, see prefetch_chunks.
+        '''
+        ext = data_file_ext(path_filename)
+        if ext == 'csv':
+            logger.debug('Reading %s in chunks of %s rows', path_filename,
+                         self.CHUNK_SIZE)
+            chunks = self.csv_chunks(path_filename, sqltype_names,
+                                     self.CHUNK_SIZE or None)
+        elif ext in spreadsheet_readers:
+            chunks = self.spreadsheet_chunks(path_filename,
+                                             self.CHUNK_SIZE or None)
+        else:
+            print("\nFile extension {} not yet implemented".format(ext))
+            print('Continuing with other file types.')
+            return
+        if self.PARQUET_CACHE_PATH:
+            chunks = self.parquet_cached_chunks(path_filename, sqltype_names,
+                                                chunks, fingerprint)
+        if self.PREFETCH_CHUNKS and self.CHUNK_SIZE:
+            chunks = prefetch_chunks(chunks, self.PREFETCH_CHUNKS)
+        for chunk in chunks:
+            yield chunk
+
+    def parquet_cache_file(self, path_filename, sqltype_names=None,
+                           fingerprint=None):
+        '''Returns the name of the Parquet cache file of the parsed data
+        file.
+
+        The name is keyed by the content hash of the data file and the type
+        names it is parsed with, so a changed file or type JSON gets a new
+        cache file.
+        '''
+        if fingerprint is None or fingerprint['sha256'] is None:
+            sha256 = self.file_hash(path_filename)
+        else:
+            sha256 = fingerprint['sha256']
+        key = [sha256, sqltype_names, self.TYPE_JSON_USECOLS,
+               self.SPREADSHEET_SHEET]
+        if self.PRUNE_EMPTY_COLUMNS or self.COLUMN_EXCLUDE:
+            # The columns left out of the table, see pruned_columns
+            key += [self.COLUMN_EXCLUDE, self.read_pruned_json(
+                table_name_for(path_filename))]
+        key = json.dumps(key, sort_keys=True)
+        key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        name = path_filename.split('/')[-1].split('.')[0].lower()
+        return os.path.join(self.PARQUET_CACHE_PATH,
+                            '{}_{}.parquet'.format(name, key_hash))
+
+    def parquet_cached_chunks(self, path_filename, sqltype_names, chunks,
+                              fingerprint=None):
+        '''Yields the chunks of the data file from its Parquet cache file
+        if there is one, otherwise from chunks, the parsing generator, while
+        writing them to a new cache file.
+
+        The cache file is memory mapped and read in batches of CHUNK_SIZE
+        rows.  A new cache file is only kept once all chunks were read, and
+        is not written when pyarrow is missing or the chunks cannot be
+        stored with one schema, e.g. a column inferred as different dtypes.
+        '''
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logger.warning('pyarrow is not installed, not caching %s',
+                           path_filename)
+            yield from chunks
+            return
+        cache_file = self.parquet_cache_file(path_filename, sqltype_names,
+                                             fingerprint)
+        if os.path.isfile(cache_file):
+            logger.info('Reading %s from cache %s', path_filename,
+                        cache_file)
+            # mtime marks the last use for evict_parquet_cache
+            os.utime(cache_file)
+            parquet_file = pq.ParquetFile(cache_file, memory_map=True)
+            if not self.CHUNK_SIZE:
+                yield parquet_file.read().to_pandas()
+                return
+            schema = parquet_file.schema_arrow
+            for batch in parquet_file.iter_batches(self.CHUNK_SIZE):
+                # The schema carries the pandas index and dtypes
+                yield pa.Table.from_batches([batch], schema).to_pandas()
+            return
+        tmp_file = cache_file + '.tmp'
+        cache = {'writer': None, 'is_cacheable': True}
+
+        def cache_chunk(chunk):
+            '''Appends the chunk to the temporary cache file.'''
+            if not cache['is_cacheable']:
+                return
+            try:
+                if cache['writer'] is None:
+                    table = pa.Table.from_pandas(chunk)
+                    cache['writer'] = pq.ParquetWriter(tmp_file,
+                                                       table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk,
+                                                 cache['writer'].schema)
+                cache['writer'].write_table(table)
+            except (pa.ArrowInvalid, pa.ArrowTypeError,
+                    pa.ArrowNotImplementedError) as e:
+                logger.warning('Not caching %s: %s', path_filename, e)
+                cache['is_cacheable'] = False
+
+        def finish_cache():
+            '''Moves the complete temporary cache file into place.'''
+            if cache['writer'] is None or not cache['is_cacheable']:
+                return
+            cache['writer'].close()
+            cache['writer'] = None
+            os.replace(tmp_file, cache_file)
+            logger.info('Cached %s in %s', path_filename, cache_file)
+            self.evict_parquet_cache(cache_file)
+        try:
+            for chunk in chunks:
+                cache_chunk(chunk)
+                if not self.CHUNK_SIZE:
+                    # The only chunk, cache it before the table is written
+                    # so a failed write is re-run from the cache
+                    finish_cache()
+                yield chunk
+            finish_cache()
+        finally:
+            if cache['writer'] is not None:
+                cache['writer'].close()
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def evict_parquet_cache(self, keep=None):
+        '''Removes the least recently used cache files until the cache is
+        no larger than PARQUET_CACHE_MAX_MB.  The cache file keep, e.g. the
+        one just written, is never removed.'''
+        cache_files = [os.path.join(self.PARQUET_CACHE_PATH, fn)
+                       for fn in os.listdir(self.PARQUET_CACHE_PATH)
+                       if fn.endswith('.parquet')]
+        stats = sorted((os.stat(fn).st_mtime, os.stat(fn).st_size, fn)
+                       for fn in cache_files)
+        total = sum(size for mtime, size, fn in stats)
+        max_bytes = self.PARQUET_CACHE_MAX_MB * 1024 * 1024
+        for mtime, size, fn in stats:
+            if total <= max_bytes:
+                break
+            if fn == keep:
+                continue
+            os.remove(fn)
+            total -= size
+            logger.info('Evicted cache file %s', fn)
+
+    def file_hash(self, path_filename):
+        '''Returns the sha256 hex digest of the file contents, read in
+        blocks so large files are not held in memory.  Data files in
+        archives are hashed on their decompressed contents.'''
+        sha = hashlib.sha256()
+        with open_data_file(path_filename) as file_obj:
+            for block in iter(lambda: file_obj.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def file_fingerprint(self, path_filename, json_file, previous=None,
+                         content_hash=True):
+        '''Returns a dict of the size, mtime and content hash of the data
+        file plus the hash of its type JSON file, None if there is none.
+
+        previous is the fingerprint recorded at the last load.  If size and
+        mtime are unchanged its content hash is reused rather than reading
+        the whole file again.  With content_hash False the file is not
+        hashed and the content hash is None.
+        '''
+        size, mtime = data_file_stat(path_filename)
+        fingerprint = {'size': size, 'mtime': mtime}
+        if not content_hash:
+            fingerprint['sha256'] = None
+        elif (previous and previous['sha256'] and
+                previous['size'] == fingerprint['size'] and
+                previous['mtime'] == fingerprint['mtime']):
+            fingerprint['sha256'] = previous['sha256']
+        else:
+            fingerprint['sha256'] = self.file_hash(path_filename)
+        fingerprint['type_json_sha256'] = self.type_json_hash(json_file)
+        return fingerprint
+
+    def read_manifest(self):
+        '''Returns the manifest of data file fingerprints recorded at their
+        last successful load to the database and with the LOAD_MODE of
+        load_target, keyed by data file name.'''
+        manifest_file = self.manifest_file()
+        if not os.path.isfile(manifest_file):
+            return {}
+        with open(manifest_file, 'r') as json_f:
+            return json.load(json_f).get(self.load_target(), {})
+
+    def write_manifest(self, manifest):
+        '''Saves the manifest of load_target, keeping those of other
+        targets, and replaces the previous file atomically so an
+        interrupted run cannot leave a partial file.'''
+        manifest_file = self.manifest_file()
+        targets = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as json_f:
+                targets = json.load(json_f)
+        targets[self.load_target()] = manifest
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as json_f:
+            json_f.write(json.dumps(targets, indent=4))
+        os.replace(tmp_file, manifest_file)
+        logger.debug('Wrote manifest %s', manifest_file)
 
 
 if __name__ == '__main__':
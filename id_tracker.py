@@ -0,0 +1,198 @@
+'''Duplicate record Id detection while a data file is written
+
+A sf.com export can list a record twice, e.g. when a partial re-export is
+appended to it.  The "Id" primary key is only added once all the rows of a
+table are written, so without a check a duplicate fails the load at the
+very end.  IdTracker checks each chunk as it is written instead, against
+the Ids of the earlier chunks, and either fails at once or keeps the newest
+row of each Id, as set by DUPLICATE_IDS:
+
+    error        raise DuplicateIdError listing the duplicate Ids
+    keep_latest  keep the row with the latest SystemModstamp, or
+                 LastModifiedDate, the first of rows with the same stamp
+    off          no check
+
+The Ids seen are kept as 64 bit hashes in sorted numpy arrays, 8 bytes per
+Id, plus 8 for its modstamp with keep_latest, rather than a set of strings.
+Two different Ids have the same hash with a chance of about n ** 2 / 2 ** 65
+for n rows, 3e-6 for 10 million rows.
+'''
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger('main.id_tracker')
+
+DUPLICATE_ID_POLICIES = ('error', 'keep_latest', 'off')
+# Duplicate Ids shown in log messages and errors
+SHOWN_IDS = 10
+
+
+class DuplicateIdError(ValueError):
+    '''A data file has more than one row of the Ids.'''
+    def __init__(self, table_name, ids):
+        self.table_name = table_name
+        self.ids = ids
+        super().__init__('{} duplicate Ids in table {}: {}{}'.format(
+            len(ids), table_name, ', '.join(ids[:SHOWN_IDS]),
+            ' ...' if len(ids) > SHOWN_IDS else ''))
+
+
+def id_hashes(ids):
+    '''Returns the 64 bit hashes of the Ids as a numpy uint64 array.'''
+    return pd.util.hash_array(np.asarray(ids, dtype=object),
+                              categorize=False)
+
+
+def stamp_values(column):
+    '''Returns the modstamps of the column, datetimes or ISO-8601 text, as
+    a numpy int64 array of nanoseconds.  Missing stamps are the lowest
+    value, so any stamp is newer.'''
+    stamps = pd.to_datetime(column, utc=True, errors='coerce')
+    return stamps.dt.tz_convert(None).to_numpy().view('int64')
+
+
+class IdHashSet():
+    '''Set of Id hashes, each with a modstamp if with_stamps.
+
+    The hashes are kept in sorted runs, each at most half the size of the
+    one before, so a run is merged about log2(n) times and a lookup is a
+    binary search of each of the log2(n) runs.
+    '''
+    def __init__(self, with_stamps=False):
+        self.with_stamps = with_stamps
+        # (hashes, stamps) pairs, stamps None without with_stamps
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(hashes) for hashes, _ in self.runs)
+
+    def add(self, hashes, stamps=None):
+        '''Adds the hashes, which must not be in the set yet, with their
+        stamps.'''
+        if not len(hashes):
+            return
+        self.runs.append(self.sorted_run(hashes, stamps))
+        while len(self.runs) > 1 and \
+                len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            last_hashes, last_stamps = self.runs.pop()
+            hashes, stamps = self.runs.pop()
+            self.runs.append(self.sorted_run(
+                np.concatenate([hashes, last_hashes]),
+                None if stamps is None else
+                np.concatenate([stamps, last_stamps])))
+
+    def sorted_run(self, hashes, stamps):
+        order = np.argsort(hashes, kind='stable')
+        if not self.with_stamps:
+            return hashes[order], None
+        return hashes[order], stamps[order]
+
+    def positions(self, run_hashes, hashes):
+        '''Returns which of the hashes are in the run and their positions
+        in it.'''
+        positions = np.minimum(np.searchsorted(run_hashes, hashes),
+                               len(run_hashes) - 1)
+        return run_hashes[positions] == hashes, positions
+
+    def lookup(self, hashes):
+        '''Returns a boolean array of which hashes are in the set and an
+        array of their stamps.'''
+        found = np.zeros(len(hashes), dtype=bool)
+        stamps = np.zeros(len(hashes), dtype='int64')
+        for run_hashes, run_stamps in self.runs:
+            is_in, positions = self.positions(run_hashes, hashes)
+            found |= is_in
+            if run_stamps is not None:
+                stamps[is_in] = run_stamps[positions[is_in]]
+        return found, stamps
+
+    def update(self, hashes, stamps):
+        '''Sets the stamps of the hashes, which must be in the set.'''
+        for run_hashes, run_stamps in self.runs:
+            is_in, positions = self.positions(run_hashes, hashes)
+            run_stamps[positions[is_in]] = stamps[is_in]
+
+
+class IdTracker():
+    '''Checks the Id index of the chunks of the table, table_name, for
+    duplicates with the DUPLICATE_IDS policy.  stamp_columns are the
+    modstamp columns keep_latest compares, the first in a chunk is used.
+    '''
+    def __init__(self, table_name, policy, stamp_columns=()):
+        if policy not in DUPLICATE_ID_POLICIES:
+            raise ValueError('DUPLICATE_IDS must be one of {}, not "{}"'
+                             .format(', '.join(DUPLICATE_ID_POLICIES),
+                                     policy))
+        self.table_name = table_name
+        self.policy = policy
+        self.stamp_columns = list(stamp_columns)
+        self.stamp_col = None
+        self.seen = IdHashSet(with_stamps=policy == 'keep_latest')
+        self.dropped_rows = 0
+        self.duplicate_ids = set()
+
+    def check(self, chunk):
+        '''Returns the chunk, without its older rows of duplicate Ids with
+        keep_latest.
+
+        Raises DuplicateIdError with policy "error" if an Id of the chunk
+        is duplicated in it or was in an earlier chunk.  With keep_latest
+        the Ids whose rows from earlier chunks are older than the rows kept
+        are listed in chunk.attrs["superseded_ids"], for
+        DataProc.delete_superseded to delete those rows before the chunk
+        is written.
+        '''
+        if self.policy == 'off' or chunk.empty:
+            return chunk
+        hashes = id_hashes(chunk.index)
+        if self.policy == 'error':
+            found, _ = self.seen.lookup(hashes)
+            duplicated = found | pd.Series(hashes).duplicated().to_numpy()
+            if duplicated.any():
+                raise DuplicateIdError(self.table_name, sorted(
+                    set(chunk.index[duplicated].astype(str))))
+            self.seen.add(hashes)
+            return chunk
+        if self.stamp_col is None:
+            self.stamp_col = next((c for c in self.stamp_columns
+                                   if c in chunk.columns), '')
+            if not self.stamp_col:
+                logger.warning('Table %s has no modstamp column, keeping '
+                               'the first row of duplicate Ids',
+                               self.table_name)
+        if self.stamp_col:
+            stamps = stamp_values(chunk[self.stamp_col])
+        else:
+            stamps = np.zeros(len(chunk), dtype='int64')
+        # Newest row of each Id in the chunk, the sort is stable so the
+        # first of equal stamps is kept
+        rows = pd.DataFrame({'hash': hashes, 'stamp': stamps})
+        keep = ~rows.sort_values('stamp', ascending=False, kind='stable') \
+            .duplicated('hash').sort_index().to_numpy()
+        kept = np.flatnonzero(keep)
+        found, seen_stamps = self.seen.lookup(hashes[kept])
+        newer = found & (stamps[kept] > seen_stamps)
+        keep[kept[found & ~newer]] = False
+        self.seen.update(hashes[kept[newer]], stamps[kept[newer]])
+        self.seen.add(hashes[kept[~found]], stamps[kept[~found]])
+        superseded = chunk.index[kept[newer]].astype(str).tolist()
+        if keep.all() and not superseded:
+            return chunk
+        duplicates = sorted(set(chunk.index[~keep].astype(str)) |
+                            set(superseded))
+        self.duplicate_ids.update(duplicates)
+        self.dropped_rows += int((~keep).sum()) + len(superseded)
+        logger.warning('Keeping the latest row of %s duplicate Ids in table '
+                       '%s: %s', len(duplicates), self.table_name,
+                       ', '.join(duplicates[:SHOWN_IDS]))
+        chunk = chunk[keep]
+        chunk.attrs['superseded_ids'] = superseded
+        return chunk
+
+    def log_summary(self):
+        '''Logs the duplicate Ids found in all the chunks.'''
+        if self.duplicate_ids:
+            logger.warning('Dropped %s older rows of %s duplicate Ids in '
+                           'table %s', self.dropped_rows,
+                           len(self.duplicate_ids), self.table_name)
@@ -0,0 +1,189 @@
+'''Per table and stage timing of a load run
+
+Instrumentation records the wall time, rows, bytes and rows/sec of each
+pipeline stage of each table, e.g. reading the data file, resolving the sql
+types and writing the table, plus the peak RSS of the process.  Times are
+exclusive, a stage nested in another, like reading chunks while they are
+written, is not counted in the outer stage.  At the end of the run the
+records are saved as a JSON and a CSV run report.
+
+With INSTRUMENT off stage returns a shared no-op context manager so the
+pipeline runs as before.
+'''
+import os
+import csv
+import json
+import time
+import datetime
+from contextlib import contextmanager
+from config import Config
+import logging
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+logger = logging.getLogger('main.instrumentation')
+
+REPORT_FIELDS = ['table', 'stage', 'seconds', 'rows', 'bytes',
+                 'rows_per_sec', 'peak_rss_mb', 'calls']
+
+
+def peak_rss_mb():
+    '''Returns the peak resident set size of the process in MB, None if it
+    cannot be measured.'''
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageRecord():
+    '''Accumulated measurements of one stage of one table.  rows and
+    n_bytes are set by the code running the stage.'''
+    def __init__(self, table, stage):
+        self.table = table
+        self.stage = stage
+        self.seconds = 0.0
+        self.rows = 0
+        self.n_bytes = 0
+        self.calls = 0
+        self.peak_rss_mb = None
+
+    def as_dict(self):
+        '''Returns the record as a dict with the REPORT_FIELDS keys.'''
+        return {
+            'table': self.table,
+            'stage': self.stage,
+            'seconds': round(self.seconds, 6),
+            'rows': self.rows,
+            'bytes': self.n_bytes,
+            'rows_per_sec': (round(self.rows / self.seconds, 1)
+                             if self.rows and self.seconds else None),
+            'peak_rss_mb': self.peak_rss_mb,
+            'calls': self.calls,
+        }
+
+
+class NoStage():
+    '''Context manager standing in for a stage that is not timed.  It
+    yields itself as the record, so counts set on it are discarded.'''
+    rows = 0
+    n_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+class Instrumentation(Config):
+    def __init__(self):
+        Config.__init__(self)
+        self.records = {}
+        # Stage record dicts sent by worker processes
+        self.worker_records = []
+        # Stages being timed, innermost last, with the time spent in their
+        # nested stages
+        self.active = []
+        self.run_start = datetime.datetime.now()
+
+    def stage(self, table, stage):
+        '''Returns a context manager timing the stage of the table.
+
+        It yields the StageRecord, on which the caller adds the rows and
+        bytes processed.  Repeated stages of a table, e.g. one per chunk,
+        add up in one record.
+        '''
+        if not self.INSTRUMENT:
+            return NO_STAGE
+        return self.timed_stage(table, stage)
+
+    @contextmanager
+    def timed_stage(self, table, stage):
+        '''Context manager of stage with INSTRUMENT on.'''
+        record = self.records.get((table, stage))
+        if record is None:
+            record = self.records[(table, stage)] = StageRecord(table, stage)
+        frame = [time.perf_counter(), 0.0]
+        self.active.append(frame)
+        try:
+            yield record
+        finally:
+            self.active.pop()
+            elapsed = time.perf_counter() - frame[0]
+            record.seconds += elapsed - frame[1]
+            record.calls += 1
+            record.peak_rss_mb = peak_rss_mb()
+            if self.active:
+                self.active[-1][1] += elapsed
+
+    def timed_chunks(self, table, chunks, n_bytes=0):
+        '''Yields the dataframe chunks, timing each read of the iterator as
+        the "read" stage of the table and counting its rows.  n_bytes is
+        the size of the data file being read.'''
+        if not self.INSTRUMENT:
+            yield from chunks
+            return
+        chunks = iter(chunks)
+        while True:
+            with self.stage(table, 'read') as record:
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    record.rows += len(chunk)
+                record.n_bytes = n_bytes
+            if chunk is None:
+                return
+            yield chunk
+
+    def pop_records(self):
+        '''Returns the records as dicts and clears them, e.g. to send the
+        records of a worker process to the main process.'''
+        records = [r.as_dict() for r in self.records.values()]
+        self.records = {}
+        return records
+
+    def add_records(self, records):
+        '''Adds record dicts from pop_records of another process.'''
+        self.worker_records.extend(records)
+
+    def report(self):
+        '''Returns the run report, the run totals and the stage records,
+        as a dict.  seconds is the sum of the stage times, which exceeds
+        wall_seconds when tables are loaded in parallel.'''
+        stages = self.worker_records + [r.as_dict()
+                                        for r in self.records.values()]
+        run_end = datetime.datetime.now()
+        return {
+            'run_start': self.run_start.isoformat(),
+            'run_end': run_end.isoformat(),
+            'wall_seconds': (run_end - self.run_start).total_seconds(),
+            'seconds': round(sum(s['seconds'] for s in stages), 6),
+            'peak_rss_mb': max((s['peak_rss_mb'] for s in stages
+                                if s['peak_rss_mb'] is not None),
+                               default=None),
+            'stages': stages,
+        }
+
+    def write_report(self):
+        '''Writes the run report to run_report.json and the stage records
+        to run_report.csv in RUN_REPORT_PATH.  Nothing is written with
+        INSTRUMENT off.'''
+        if not self.INSTRUMENT:
+            return
+        report = self.report()
+        json_file = os.path.join(self.RUN_REPORT_PATH, 'run_report.json')
+        with open(json_file, 'w') as json_f:
+            json_f.write(json.dumps(report, indent=4))
+        csv_file = os.path.join(self.RUN_REPORT_PATH, 'run_report.csv')
+        with open(csv_file, 'w', newline='') as csv_f:
+            writer = csv.DictWriter(csv_f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(report['stages'])
+        logger.info('Wrote run report %s and %s', json_file, csv_file)
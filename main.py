@@ -1,4 +1,9 @@
 import os
+import argparse
+import cProfile
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
 # import json
 import logging
 from logging.handlers import RotatingFileHandler
@@ -8,8 +13,11 @@ from logging.handlers import RotatingFileHandler
 # from sqlalchemy import create_engine  # , Integer, String, Boolean, \
 #    DateTime, Numeric
 from config import Config
-from file_processor import FileInfo
+from file_processor import FileInfo, skip_rows
+from data_files import data_file_size, table_name_for, csv_shard_ranges
 from db_processor import DataProc
+from instrumentation import Instrumentation
+from run_journal import RunJournal
 
 # -- Configure logger --
 # Create a log directory if it does not exist
@@ -67,49 +75,466 @@ logger.info(
 )
 # -- End logger Configuration --
 
-# Instantiate FileInfo and DataProc Classes
-f = FileInfo()
-d = DataProc()
-logger.info('** Begin main application ** ')
-logger.info('-- Begin file name processing -- ')
-# Get the full path filenames to be loaded
-path_filenames = f.get_data_filenames()
-logger.info('-- Begin loading data files and write tables to database --')
-for fn in path_filenames:
-    filename = fn.split('/')[-1].lower()
-    table_name = filename.split('.')[0]
-    logger.info('Processing file %s', filename)
-    contents = f.file_reader(fn)
-    if contents is None:
-        pass
+
+def select_data_files(path_filenames, force=False, content_hash=True):
+    '''Returns the data files that changed since their last load according
+    to the manifest, or all of them when force is True or SKIP_UNCHANGED is
+    off.  The fingerprints of the returned files are kept for
+    record_loaded_file, with content_hash False without hashing the files,
+    see FileInfo.file_fingerprint.'''
+    selected = []
+    for fn in path_filenames:
+        json_file = f.type_json_file(table_name_for(fn))
+        with inst.stage(table_name_for(fn), 'fingerprint') as record:
+            fingerprint = f.file_fingerprint(fn, json_file, manifest.get(fn),
+                                             content_hash)
+            record.n_bytes += fingerprint['size']
+        if f.SKIP_UNCHANGED and not force and manifest.get(fn) == fingerprint:
+            logger.info('Skipping unchanged file %s', fn)
+            continue
+        fingerprints[fn] = fingerprint
+        selected.append(fn)
+    logger.info('%s of %s data files selected for loading', len(selected),
+                len(path_filenames))
+    return selected
+
+
+def select_resumed_files(path_filenames):
+    '''Returns the data files the interrupted run did not finish according
+    to the run journal, for --resume.  A finished file that changed since
+    is loaded again.'''
+    selected = [fn for fn in path_filenames if not journal.is_finished(
+        fn, fingerprints[fn]['sha256'])]
+    logger.info('Resuming the run with %s of %s data files, %s partially '
+                'loaded', len(selected), len(path_filenames),
+                len(journal.unfinished()))
+    return selected
+
+
+def record_loaded_file(fn, status):
+    '''Records the fingerprint of a successfully loaded data file in the
+    manifest.  The type JSON part is refreshed as the load may have created
+    or updated the type JSON file.  Written tables are kept for the post
+    load indexes.'''
+    journal.finish_file(fn, table_name_for(fn), fingerprints[fn]['sha256'],
+                        status)
+    if status == 'deferred':
+        return
+    if status == 'written':
+        loaded_tables.add(table_name_for(fn))
+    json_file = f.type_json_file(table_name_for(fn))
+    manifest[fn] = f.file_fingerprint(
+        fn, json_file, fingerprints[fn],
+        fingerprints[fn]['sha256'] is not None)
+    f.write_manifest(manifest)
+
+
+def resolve_sqltypes(table_name, contents, json_file, is_complete=None):
+    '''Creates the sqlalchemy type dict of the dataframe, contents, from
+    its profile, the type rules and the type JSON file.
+
+    is_complete is whether contents is the whole file, by default when it
+    was not cut at CHUNK_SIZE.
+    Returns the type dict, whether it is ready for writing the table and the
+    set of columns that need the interactive session if it is not.'''
+    pdtype_dict = f.df_column_profile(contents)
+    logger.info('Created the dictionary of dtypes and column profiles from '
+                'pandas dataframe')
+    if d.INFER_TYPES:
+        if is_complete is None:
+            # The first chunk is the whole file unless cut at CHUNK_SIZE
+            is_complete = not f.CHUNK_SIZE or len(contents) < f.CHUNK_SIZE
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(
+            contents, pdtype_dict, is_complete)
+        logger.info('Created dictionary of sqlalchemy types with typical '
+                    'column values inferred from a sample of the data')
     else:
-        logger.info('Read in data from file %s', filename)
-        pdtype_dict = f.df_column_dtypes(contents)
-        logger.info('Created the dictionary of dtypes from pandas dataframe')
         sqltype_val_dict = d.pdtype2sqltype_default(pdtype_dict)
         logger.info('Created dictionary of sqlalchemy types with typical '
                     'column values using a default mapping to pandas dtypes')
-        json_file = d.TYPE_JSON_PATH + table_name + '_sqltype.json'
-        logger.info('JSON file for type storage is %s', json_file)
-        logger.info('Try to see if the sql type dictionary is ready for '
-                    'writing the sql table')
-        sqltype_dict, is_sql_ready = d.make_sqltype_dict_json(sqltype_val_dict,
-                                                              json_file)
-        logger.info('SQL Ready is %s', is_sql_ready)
-        if is_sql_ready:
-            sqltype_dict = d.write_sqltables(table_name, contents,
-                                             sqltype_dict)
-            logger.info('Wrote SQL table with name %s', table_name)
-        else:
-            logger.info('Sending user to interactive session')
-            print('\n\n** Processing Data for Table: "{}"'.format(table_name))
-            sqltype_val_dict = d.type_update_interactive(sqltype_dict)
+        ambiguous = set(sqltype_val_dict)
+    sqltype_val_dict, ruled = d.apply_type_rules(table_name, contents,
+                                                 sqltype_val_dict)
+    ambiguous -= ruled
+    logger.info('Try to see if the sql type dictionary is ready for '
+                'writing the sql table')
+    sqltype_dict, is_sql_ready = d.make_sqltype_dict_json(sqltype_val_dict,
+                                                          json_file)
+    logger.info('SQL Ready is %s', is_sql_ready)
+    return sqltype_dict, is_sql_ready, ambiguous
+
+
+def table_sqltypes(table_name, contents, sqltype_names, json_file,
+                   is_complete=None):
+    '''Returns the sqlalchemy type dict of the table, whether it is ready
+    for writing the table and the set of columns that need the interactive
+    session, as resolve_sqltypes, which is passed is_complete.
+
+    sqltype_names is the dict of the type JSON file, if any.  When its
+    columns are those of the dataframe, contents, it is used as it is.
+    With SCHEMA_REGISTRY set, the version stored for the columns is used
+    instead.  Columns it has a type for were already settled by the user,
+    so are not asked about again.'''
+    if d.SCHEMA_REGISTRY:
+        sqltype_names = d.read_type_json(json_file, contents.columns)
+    if sqltype_names is not None and \
+            set(contents.columns) == set(sqltype_names):
+        # Parsed with the stored types so there is nothing to infer
+        logger.info('SQL types taken from JSON file %s', json_file)
+        return ({k: d.sqltype_from_name(v) for k, v in sqltype_names.items()},
+                True, set())
+    sqltype_dict, is_sql_ready, ambiguous = resolve_sqltypes(
+        table_name, contents, json_file, is_complete)
+    if not is_sql_ready:
+        ambiguous -= set(sqltype_names or {})
+    return sqltype_dict, is_sql_ready, ambiguous
+
+
+def resolve_data_file_types(fn):
+    '''Resolves the types of the data file's table from the first chunk of
+    the file without the interactive session or writing the table.
+
+    The type JSON file is saved when no ambiguous columns are left.
+    Returns "ready" when the type JSON already fits the file, "resolved"
+    when it was saved, "review" with the columns left for the interactive
+    session, or "empty".'''
+    table_name = table_name_for(fn)
+    json_file = d.type_json_file(table_name)
+    sqltype_names = d.read_type_json(json_file)
+    contents = next(f.file_chunk_reader(fn, sqltype_names), None)
+    if contents is None:
+        return 'empty', set()
+    sqltype_dict, is_sql_ready, ambiguous = table_sqltypes(
+        table_name, contents, sqltype_names, json_file)
+    if is_sql_ready:
+        return 'ready', set()
+    if ambiguous:
+        return 'review', ambiguous
+    d.make_sqltype_dict_initial(sqltype_dict, json_file)
+    return 'resolved', set()
+
+
+def resolve_all_types(path_filenames):
+    '''Batch step resolving the types of every data file's table with
+    resolve_data_file_types and printing a summary, so an unattended load
+    only stops for tables listed for review.'''
+    statuses = {}
+    for fn in path_filenames:
+        status, ambiguous = resolve_data_file_types(fn)
+        statuses[status] = statuses.get(status, 0) + 1
+        logger.info('Types of %s are %s', fn, status)
+        if status == 'review':
+            print('{}: review columns {}'.format(table_name_for(fn),
+                                                 ', '.join(sorted(ambiguous))))
+    print('Types of {} tables: {}'.format(len(path_filenames), ', '.join(
+        '{} {}'.format(n, s) for s, n in sorted(statuses.items()))))
+
+
+def resume_point(fn, table_name):
+    '''Returns the rows of the data file an interrupted load of the run
+    committed to the table, 0 to load it from the start.
+
+    The rows are counted in the database, as the run may have stopped
+    between committing a chunk and recording it in the journal.  The
+    journal tells whether the table holds rows of this load at all, which
+    it does after the first chunk was committed, and whether the file is
+    the one that was being loaded.
+    '''
+    entry = journal.entry(fn)
+    if not d.CHECKPOINT_CHUNKS or entry is None or \
+            entry['status'] != 'loading' or not entry['rows'] or \
+            entry['sha256'] != fingerprints[fn]['sha256']:
+        return 0
+    rows = d.committed_rows(table_name)
+    if rows:
+        logger.info('Resuming table %s after %s committed rows',
+                    table_name, rows)
+    return rows
+
+
+def is_sharded(fn):
+    '''Returns True if the data file is loaded in shards by
+    load_sharded_file.
+
+    Only a plain CSV file of at least SHARD_MIN_MB is, see
+    FileInfo.is_shardable, and not with LOAD_MODE "incremental", with
+    DUPLICATE_IDS "keep_latest", whose rows to keep can be in different
+    shards, or on SQLite, which has one writer at a time.'''
+    if not f.is_shardable(fn):
+        return False
+    dialect = d.get_engine().dialect.name
+    if d.LOAD_MODE == 'incremental' or d.DUPLICATE_IDS == 'keep_latest' \
+            or dialect == 'sqlite':
+        logger.info('Not sharding %s with LOAD_MODE %s, DUPLICATE_IDS %s '
+                    'on %s', fn, d.LOAD_MODE, d.DUPLICATE_IDS, dialect)
+        return False
+    return True
+
+
+def load_shard_job(fn, sqltype_names, start, end):
+    '''Writes the rows in the byte range start to end of the data file to
+    its table's staging table in a worker process.  Returns the rows
+    written and the stage records of the shard for the run report.'''
+    table_name = table_name_for(fn)
+    sqltype_dict = {k: d.sqltype_from_name(v)
+                    for k, v in sqltype_names.items()}
+    chunks = inst.timed_chunks(
+        table_name, f.shard_chunks(fn, start, end, sqltype_names,
+                                   f.CHUNK_SIZE or None), end - start)
+    with inst.stage(table_name, 'write') as record:
+        rows = d.write_shard(table_name, chunks, sqltype_dict)
+        record.rows += rows
+    return rows, inst.pop_records()
+
+
+def load_sharded_file(fn, table_name, contents, sqltype_dict, ranges):
+    '''Loads the CSV data file into the table with SHARD_WORKERS worker
+    processes, each parsing and writing a byte range of the file.
+
+    ranges are the byte ranges of the shards, which end on record
+    boundaries, see data_files.csv_shard_ranges.  The shards are appended
+    to one staging table at once and the primary key is built once they
+    are all written, then the staging table is swapped in, see
+    DataProc.finish_sharded_load.  contents is the first rows of the file,
+    read for the types, giving the staging table's columns.  Returns the
+    number of rows written.
+    '''
+    logger.info('Loading %s in %s shards', fn, len(ranges))
+    with d.get_engine().begin() as con:
+        d.create_staging_table(con, table_name, contents, sqltype_dict)
+    # The types resolved by load_data_file are in the type JSON, as the
+    # version matched to the file's columns with SCHEMA_REGISTRY set
+    sqltype_names = d.read_type_json(d.type_json_file(table_name),
+                                     contents.columns)
+    rows = 0
+    with ProcessPoolExecutor(max_workers=len(ranges),
+                             initializer=init_worker,
+                             initargs=(fingerprints,)) as pool:
+        futures = [pool.submit(load_shard_job, fn, sqltype_names, start,
+                               end) for start, end in ranges]
+        for future in as_completed(futures):
+            try:
+                shard_rows, records = future.result()
+            except Exception:
+                for other in futures:
+                    other.cancel()
+                raise
+            rows += shard_rows
+            inst.add_records(records)
+    with inst.stage(table_name, 'primary key'):
+        d.finish_sharded_load(table_name)
+    logger.info('Wrote %s rows of %s shards to table %s', rows, len(ranges),
+                table_name)
+    return rows
+
+
+def load_data_file(fn, interactive=True, sharded=False):
+    '''Reads the data file, fn, resolves the sqlalchemy types of its table
+    and writes the table to the database.
+
+    sharded is whether the file is loaded in shards, see is_sharded.
+    Returns "written", "empty" when there was nothing to load, or
+    "deferred" when interactive is False and the types need the interactive
+    session, in which case nothing is written.'''
+    filename = fn.split('/')[-1].lower()
+    table_name = table_name_for(fn)
+    logger.info('Processing file %s', filename)
+    json_file = d.type_json_file(table_name)
+    logger.info('JSON file for type storage is %s', json_file)
+    sqltype_names = d.read_type_json(json_file)
+    ranges = None
+    if sharded:
+        # The shards are parsed by the workers, so only the first
+        # INFER_SAMPLE_ROWS rows are read here for the types
+        ranges = csv_shard_ranges(fn, d.SHARD_WORKERS)
+        chunks = f.shard_chunks(fn, *ranges[0], sqltype_names,
+                                d.INFER_SAMPLE_ROWS)
+    else:
+        # With CHUNK_SIZE set the file is streamed.  Types are taken from
+        # the first chunk and the remaining chunks are appended by
+        # write_sqltables.  A type JSON matching the file is used to parse
+        # it.
+        chunks = inst.timed_chunks(
+            table_name, f.file_chunk_reader(fn, sqltype_names,
+                                            fingerprints.get(fn)),
+            data_file_size(fn))
+    contents = next(chunks, None)
+    if contents is None:
+        return 'empty'
+    logger.info('Read in data from file %s', filename)
+    with inst.stage(table_name, 'types') as record:
+        record.rows += len(contents)
+        sqltype_dict, is_sql_ready, ambiguous = table_sqltypes(
+            table_name, contents, sqltype_names, json_file,
+            False if ranges else None)
+    if not is_sql_ready and ambiguous and not interactive:
+        logger.info('Deferring table %s for the interactive session',
+                    table_name)
+        return 'deferred'
+    if not is_sql_ready:
+        if ambiguous:
+            logger.info('Sending user to interactive session for %s '
+                        'columns', len(ambiguous))
+            print('\n\n** Processing Data for Table: "{}"'.format(
+                table_name))
+            ambiguous_dict = {k: v for k, v in sqltype_dict.items()
+                              if k in ambiguous}
+            sqltype_dict.update(d.type_update_interactive(ambiguous_dict))
             logger.info('User complete making updates.')
-            sqltype_dict = d.make_sqltype_dict_initial(sqltype_val_dict,
-                                                       json_file)
-            logger.info('Created the sqlalchemy type dictionary for writing '
-                        'table')
-            sqltype_dict = d.write_sqltables(table_name, contents,
-                                             sqltype_dict)
+        sqltype_dict = d.make_sqltype_dict_initial(sqltype_dict, json_file)
+        logger.info('Created the sqlalchemy type dictionary for writing '
+                    'table')
+    if ranges:
+        chunks.close()
+        journal.start_file(fn, table_name, fingerprints[fn]['sha256'])
+        load_sharded_file(fn, table_name, contents, sqltype_dict, ranges)
         logger.info('Wrote SQL table with name %s', table_name)
-logger.info('** End main application ** ')
+        return 'written'
+    resume_rows = resume_point(fn, table_name)
+    sha256 = fingerprints[fn]['sha256']
+    journal.start_file(fn, table_name, sha256, resume_rows)
+    checkpoint = None
+    if d.CHECKPOINT_CHUNKS:
+        def checkpoint(rows):
+            journal.checkpoint(fn, rows)
+    chunks = skip_rows(itertools.chain([contents], chunks), resume_rows)
+    # Reading the remaining chunks is timed as the read stage, not write
+    with inst.stage(table_name, 'write') as record:
+        record.rows += d.write_sqltables(table_name, chunks, sqltype_dict,
+                                         checkpoint, resume_rows)
+    logger.info('Wrote SQL table with name %s', table_name)
+    return 'written'
+
+
+def init_worker(selected_fingerprints):
+    '''Gives each worker process its own FileInfo and DataProc and so its
+    own database engine, which is disposed when the worker exits.  The
+    fingerprints of the selected data files are passed on for their cache
+    keys.'''
+    global f, d, inst, journal, fingerprints
+    if 'd' in globals():
+        # Forked from the main process, whose pooled connections must not
+        # be closed or reused here
+        d.dispose_engine(close=False)
+    fingerprints = selected_fingerprints
+    f = FileInfo()
+    d = DataProc()
+    inst = Instrumentation()
+    journal = RunJournal(f.journal_file())
+    Finalize(None, d.dispose_engine, exitpriority=10)
+
+
+def load_data_file_job(fn):
+    '''Loads the data file in a worker process without the interactive
+    session.  Returns the status from load_data_file and the stage records
+    of the file for the run report of the main process.'''
+    status = load_data_file(fn, False)
+    return status, inst.pop_records()
+
+
+def load_data_files_parallel(path_filenames, workers):
+    '''Loads the data files with a pool of worker processes.
+
+    Files are submitted largest first so the biggest tables do not start
+    last.  Tables that need the interactive type session are not written by
+    the workers, they are loaded afterwards one at a time in this process.
+    '''
+    jobs = sorted(path_filenames, key=data_file_size, reverse=True)
+    deferred = []
+    logger.info('Loading %s files with %s worker processes', len(jobs),
+                workers)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(fingerprints,)) as pool:
+        futures = {pool.submit(load_data_file_job, fn): fn for fn in jobs}
+        for future in as_completed(futures):
+            fn = futures[future]
+            try:
+                status, records = future.result()
+            except Exception:
+                logger.exception('Loading file %s failed', fn)
+                for other in futures:
+                    other.cancel()
+                raise
+            logger.info('Worker finished file %s with status %s', fn, status)
+            inst.add_records(records)
+            record_loaded_file(fn, status)
+            if status == 'deferred':
+                deferred.append(fn)
+    # Keep the largest first order for the interactive tables too
+    for fn in sorted(deferred, key=jobs.index):
+        record_loaded_file(fn, load_data_file(fn))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load Salesforce.com backup data files into a database.')
+    parser.add_argument('--force', action='store_true',
+                        help='load all data files, including those unchanged '
+                        'since their last load')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run with cProfile and save the '
+                        'stats to FILE, e.g. for python -m pstats FILE')
+    parser.add_argument('--resolve-types', action='store_true',
+                        help='only resolve and save the types of all tables '
+                        'with the type rules, listing the tables that need '
+                        'the interactive session')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last run after a failure, '
+                        'skipping the data files it finished and, with '
+                        'CHECKPOINT_CHUNKS on, continuing partially loaded '
+                        'tables after their committed chunks')
+    args = parser.parse_args()
+    # Instantiate FileInfo and DataProc Classes
+    f = FileInfo()
+    d = DataProc()
+    inst = Instrumentation()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    logger.info('** Begin main application ** ')
+    logger.info('-- Begin file name processing -- ')
+    if args.resolve_types:
+        # Batch type resolution only, nothing is loaded
+        resolve_all_types(f.get_data_filenames())
+    else:
+        # Get the full path filenames to be loaded
+        manifest = f.read_manifest()
+        fingerprints = {}
+        loaded_tables = set()
+        # The content hashes are compared to skip unchanged files and to
+        # resume a run, now or with --resume after a run with checkpoints.
+        # A file loaded without its hash is loaded again by --resume.
+        content_hash = f.SKIP_UNCHANGED or args.resume or f.CHECKPOINT_CHUNKS
+        path_filenames = select_data_files(f.get_data_filenames(), args.force,
+                                           content_hash)
+        journal = RunJournal(f.journal_file())
+        if args.resume:
+            path_filenames = select_resumed_files(path_filenames)
+        else:
+            journal.clear()
+        logger.info('-- Begin loading data files and write tables to '
+                    'database --')
+        try:
+            # Files loaded in shards have all the worker processes
+            for fn in [fn for fn in path_filenames if is_sharded(fn)]:
+                path_filenames.remove(fn)
+                record_loaded_file(fn, load_data_file(fn, sharded=True))
+            if d.LOAD_WORKERS > 1:
+                load_data_files_parallel(path_filenames, d.LOAD_WORKERS)
+            else:
+                for fn in path_filenames:
+                    record_loaded_file(fn, load_data_file(fn))
+            if d.BUILD_INDEXES and loaded_tables:
+                logger.info('-- Begin indexing reference columns --')
+                with inst.stage(None, 'indexes'):
+                    d.build_reference_indexes(sorted(loaded_tables))
+        finally:
+            # Close the pooled database connections however the run ends
+            d.dispose_engine()
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                logger.info('Saved profile stats to %s', args.profile)
+            inst.write_report()
+    logger.info('** End main application ** ')
@@ -0,0 +1,159 @@
+'''Dry run of a load, showing what main.py would do
+
+For each data file under DATA_FILES it prints the table, the file size, a
+row count estimated from a sample of the file and the status of the table's
+type JSON file:
+
+    ready    the type JSON columns match the file, no questions are asked
+    drift    the columns differ from the type JSON, listing the changes
+    missing  there is no type JSON, the types will be inferred
+
+Only the start of each file is read, the database is not used and the
+schema registry of SCHEMA_REGISTRY is only read.  pandas and sqlalchemy are
+not imported, so the plan takes seconds even for a multi-GB export.
+
+    python plan.py [--json] [--sample-bytes N]
+'''
+import io
+import csv
+import json
+import argparse
+from config import Config
+from data_files import find_data_files, open_data_file, data_file_size, \
+    data_file_ext, table_name_for, count_csv_records, COMPRESSED_EXT
+from spreadsheet_readers import spreadsheet_readers
+import logging
+
+logger = logging.getLogger('main.plan')
+
+# Bytes read from the start of each CSV file for its header and row count
+SAMPLE_BYTES = 1 << 20
+
+
+def csv_sample(path_filename, size, sample_bytes=SAMPLE_BYTES):
+    '''Returns the header of the CSV data file and its number of rows,
+    estimated from the first sample_bytes of the file.
+
+    The estimate is exact for files smaller than the sample and None for
+    gzip compressed files, whose uncompressed size is not known.
+    '''
+    with open_data_file(path_filename) as file_obj:
+        sample = file_obj.read(sample_bytes)
+    text = sample.decode('utf-8-sig', errors='replace')
+    header = next(csv.reader(io.StringIO(text)), [])
+    records, end = count_csv_records(sample)
+    # sf.com column names have no line breaks
+    header_end = sample.find(b'\n') + 1
+    if len(sample) < sample_bytes:
+        # The whole file was read, a last line without a line break is a row
+        rows = records - 1 + bool(sample[end:].strip())
+    elif path_filename.lower().endswith('.' + COMPRESSED_EXT):
+        rows = None
+    elif end > header_end:
+        rows = round((records - 1) * (size - header_end) /
+                     (end - header_end))
+    else:
+        # Not one whole row in the sample
+        rows = None
+    if rows is not None:
+        rows = max(rows, 0)
+    return header, rows
+
+
+def spreadsheet_header(path_filename, sheet_name=None):
+    '''Returns the header row of the spreadsheet data file.'''
+    read_rows = spreadsheet_readers[data_file_ext(path_filename)]
+    with open_data_file(path_filename) as file_obj:
+        header = next(read_rows(file_obj, sheet_name), None) or []
+    while header and header[-1] is None:
+        header.pop()
+    return [str(c) for c in header]
+
+
+def type_json_status(c, table_name, header):
+    '''Returns the status of the table's type JSON file for the columns
+    of the data file, "ready", "missing" or "drift" with the added (+)
+    and removed (-) columns.'''
+    # Columns pruned from the table, see FileInfo.pruned_columns
+    pruned = set(c.read_pruned_json(table_name) or []) \
+        if c.PRUNE_EMPTY_COLUMNS else set()
+    file_cols = {col for col in header if col not in pruned and
+                 not c.column_rule_match(c.COLUMN_EXCLUDE, table_name, col)}
+    file_cols -= {'Id'}
+    # As the load, the registry version stored for the columns if any
+    sqltype_names = c.read_type_json(c.type_json_file(table_name),
+                                     file_cols)
+    if sqltype_names is None:
+        return 'missing'
+    json_cols = set(sqltype_names)
+    if file_cols == json_cols:
+        return 'ready'
+    if c.TYPE_JSON_USECOLS and json_cols <= file_cols:
+        return 'ready (usecols)'
+    changes = ['+' + col for col in sorted(file_cols - json_cols)]
+    changes += ['-' + col for col in sorted(json_cols - file_cols)]
+    return 'drift ' + ' '.join(changes)
+
+
+def plan_data_files(c, sample_bytes=SAMPLE_BYTES):
+    '''Returns a list of dicts with the table, data file, size, estimated
+    rows and type JSON status of each data file of the Config, c.  Its
+    schema registry, if any, is only read.'''
+    c.registry_read_only = True
+    plan = []
+    for fn in find_data_files(c.DATA_FILES, c.DATAFILE_EXTS):
+        table_name = table_name_for(fn)
+        size = data_file_size(fn)
+        ext = data_file_ext(fn)
+        if ext == 'csv':
+            header, rows = csv_sample(fn, size, sample_bytes)
+        elif ext in spreadsheet_readers:
+            header = spreadsheet_header(fn, c.SPREADSHEET_SHEET or None)
+            rows = None
+        else:
+            header, rows = [], None
+        plan.append({
+            'table': table_name,
+            'file': fn,
+            'bytes': size,
+            'rows': rows,
+            'type_json': type_json_status(c, table_name, header),
+        })
+        logger.debug('Planned %s', plan[-1])
+    return plan
+
+
+def print_plan(plan):
+    '''Prints the plan as a table with a total line.'''
+    line = '{:<24} {:>12} {:>12}  {}'
+    print(line.format('TABLE', 'MB', 'EST. ROWS', 'TYPE JSON'))
+    for p in plan:
+        print(line.format(p['table'], '{:.1f}'.format(p['bytes'] / 1e6),
+                          '?' if p['rows'] is None else p['rows'],
+                          p['type_json']))
+    print(line.format('{} files'.format(len(plan)), '{:.1f}'.format(
+        sum(p['bytes'] for p in plan) / 1e6), sum(
+        p['rows'] or 0 for p in plan), ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Show what loading the sf.com data files would do '
+        'without loading them.')
+    parser.add_argument('--json', action='store_true',
+                        help='print the plan as JSON')
+    parser.add_argument('--sample-bytes', type=int, default=SAMPLE_BYTES,
+                        help='bytes read from each CSV file')
+    args = parser.parse_args(argv)
+    # The plan goes to stdout, not the warnings about DATAFILE_EXTS
+    logging.getLogger('main').addHandler(logging.NullHandler())
+    plan = plan_data_files(Config(), args.sample_bytes)
+    if args.json:
+        print(json.dumps(plan, indent=4))
+    else:
+        print_plan(plan)
+    return plan
+
+
+if __name__ == '__main__':
+    main()
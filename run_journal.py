@@ -0,0 +1,107 @@
+'''Journal of the data files loaded by a run, for resuming it
+
+The journal records the status of each data file of the run, "loading"
+until its table is written, and with CHECKPOINT_CHUNKS on the rows of each
+chunk committed to the database.  When main.py is run again with --resume
+after a failure, files the journal lists as finished are skipped and a
+partially loaded table continues after its committed rows.
+
+The journal is a SQLite database next to the load manifest.  Every update
+is a transaction, so a crash leaves the journal as it was after the last
+update, and the worker processes of a parallel load can update it at once.
+It is cleared at the start of each run without --resume.
+'''
+import sqlite3
+import datetime
+import logging
+
+logger = logging.getLogger('main.run_journal')
+
+# Statuses of a data file the run is finished with
+FINISHED = ('written', 'empty')
+
+SCHEMA_SQL = '''
+create table if not exists journal_file (
+    data_file text primary key,
+    table_name text not null,
+    sha256 text,
+    status text not null,
+    rows integer not null,
+    chunks integer not null,
+    updated_at text not null
+);
+'''
+
+
+class RunJournal():
+    '''Run journal in the SQLite database, db_file.'''
+    def __init__(self, db_file, timeout=30):
+        self.db_file = db_file
+        self.con = sqlite3.connect(db_file, timeout=timeout,
+                                   isolation_level=None)
+        self.con.execute('pragma journal_mode=wal')
+        # Each commit is on disk before the next chunk is written
+        self.con.execute('pragma synchronous=full')
+        self.con.executescript(SCHEMA_SQL)
+
+    def close(self):
+        self.con.close()
+
+    def clear(self):
+        '''Empties the journal for a new run.'''
+        self.con.execute('delete from journal_file')
+        logger.info('Cleared run journal %s', self.db_file)
+
+    def entry(self, data_file):
+        '''Returns the journal entry of the data file as a dict, None if
+        the run has not started it.'''
+        row = self.con.execute(
+            'select table_name, sha256, status, rows, chunks, updated_at '
+            'from journal_file where data_file = ?', (data_file,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['table', 'sha256', 'status', 'rows', 'chunks',
+                         'updated_at'], row))
+
+    def is_finished(self, data_file, sha256):
+        '''Returns True if the run finished loading the data file and it
+        has not changed since, its content hash still being sha256.'''
+        entry = self.entry(data_file)
+        return (entry is not None and entry['status'] in FINISHED and
+                entry['sha256'] == sha256)
+
+    def start_file(self, data_file, table_name, sha256, rows=0):
+        '''Records that the data file is being loaded into the table, with
+        rows of it already committed when a load is resumed.'''
+        self.con.execute(
+            'insert or replace into journal_file values (?, ?, ?, ?, ?, ?, '
+            '?)', (data_file, table_name, sha256, 'loading', rows, 0,
+                   datetime.datetime.now().isoformat()))
+
+    def checkpoint(self, data_file, rows):
+        '''Records that rows of the data file are committed to its
+        table.'''
+        self.con.execute(
+            'update journal_file set rows = ?, chunks = chunks + 1, '
+            'updated_at = ? where data_file = ?',
+            (rows, datetime.datetime.now().isoformat(), data_file))
+        logger.debug('Checkpoint of %s at %s rows', data_file, rows)
+
+    def finish_file(self, data_file, table_name, sha256, status):
+        '''Records the final status of the data file from
+        main.load_data_file, e.g. "written".'''
+        self.con.execute(
+            'insert or replace into journal_file values (?, ?, ?, ?, '
+            'coalesce((select rows from journal_file where data_file = ?), '
+            '0), coalesce((select chunks from journal_file where '
+            'data_file = ?), 0), ?)',
+            (data_file, table_name, sha256, status, data_file, data_file,
+             datetime.datetime.now().isoformat()))
+
+    def unfinished(self):
+        '''Returns the entries of the data files the run did not finish,
+        keyed by data file.'''
+        rows = self.con.execute(
+            'select data_file from journal_file where status not in (?, ?)',
+            FINISHED).fetchall()
+        return {r[0]: self.entry(r[0]) for r in rows}
@@ -0,0 +1,208 @@
+'''Registry of the sqlalchemy type names of every table
+
+With SCHEMA_REGISTRY set, one SQLite database stands in for the per-table
+<table>_sqltype.json files in TYPE_JSON_PATH, see Config.read_type_json and
+Config.write_type_json.  Every change of a table's column to type name
+mapping is kept as a new version, with a hash of the column set so a data
+file is matched to the current version by one indexed lookup.  A change of
+the column set between versions is recorded as drift.
+
+The database is in WAL mode so loads on several processes or hosts can read
+it while one of them saves a version.  WAL needs a local file system, not a
+network share.  Existing type JSON files are imported the first time.
+
+    python schema_registry.py history <table>
+    python schema_registry.py drift [<table>]
+'''
+import os
+import json
+import pathlib
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import logging
+
+logger = logging.getLogger('main.schema_registry')
+
+TYPE_JSON_SUFFIX = '_sqltype.json'
+
+SCHEMA_SQL = '''
+create table if not exists schema_version (
+    table_name text not null,
+    version integer not null,
+    column_hash text not null,
+    type_names text not null,
+    source text not null,
+    created_at text not null,
+    primary key (table_name, version)
+);
+create index if not exists ix_schema_version_column_hash
+    on schema_version (table_name, column_hash);
+create table if not exists schema_drift (
+    table_name text not null,
+    version integer not null,
+    added text not null,
+    removed text not null,
+    detected_at text not null,
+    primary key (table_name, version)
+);
+'''
+
+
+def column_hash(columns):
+    '''Returns the sha256 hex digest of the set of column names.'''
+    return hashlib.sha256('\n'.join(sorted(columns)).encode('utf-8')) \
+        .hexdigest()
+
+
+class SchemaRegistry():
+    '''Versioned type names by table in the SQLite database, db_file.
+    timeout is the seconds to wait for another process saving a
+    version.  With read_only True the database, which must exist, is
+    neither created nor changed.'''
+    def __init__(self, db_file, timeout=30, read_only=False):
+        self.db_file = db_file
+        if read_only:
+            uri = pathlib.Path(db_file).resolve().as_uri() + '?mode=ro'
+            self.con = sqlite3.connect(uri, uri=True, timeout=timeout,
+                                       isolation_level=None)
+        else:
+            # Autocommit, transactions are begun explicitly
+            self.con = sqlite3.connect(db_file, timeout=timeout,
+                                       isolation_level=None)
+            self.con.execute('pragma journal_mode=wal')
+            self.con.executescript(SCHEMA_SQL)
+        logger.info('Opened schema registry %s', db_file)
+
+    def close(self):
+        self.con.close()
+
+    def current(self, table_name):
+        '''Returns the latest version of the table as a dict with the
+        version, column_hash and type_names, None if there is none.'''
+        row = self.con.execute(
+            'select version, column_hash, type_names from schema_version '
+            'where table_name = ? order by version desc limit 1',
+            (table_name,)).fetchone()
+        if row is None:
+            return None
+        return {'version': row[0], 'column_hash': row[1],
+                'type_names': json.loads(row[2])}
+
+    def read(self, table_name):
+        '''Returns the current dict of type names by column of the table,
+        None if the table has none, like Config.read_type_json.'''
+        current = self.current(table_name)
+        return None if current is None else current['type_names']
+
+    def match(self, table_name, columns):
+        '''Returns the latest type names of the table stored for exactly
+        the columns, None if there are none.  This may be an earlier
+        version than the current one, e.g. when a column was dropped and
+        added back.'''
+        row = self.con.execute(
+            'select type_names from schema_version where table_name = ? '
+            'and column_hash = ? order by version desc limit 1',
+            (table_name, column_hash(columns))).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save(self, table_name, type_names, source='load'):
+        '''Saves the type names of the table as a new version, unless they
+        are those of the current version, and returns the version.
+
+        A column set different from the current version's is recorded as
+        drift.  Versions are numbered in an immediate transaction so
+        processes saving at once do not get the same number.
+        '''
+        now = datetime.datetime.now().isoformat()
+        new_hash = column_hash(type_names)
+        self.con.execute('begin immediate')
+        try:
+            current = self.current(table_name)
+            if current is not None and \
+                    current['type_names'] == dict(type_names):
+                self.con.execute('commit')
+                return current['version']
+            version = 1 if current is None else current['version'] + 1
+            self.con.execute(
+                'insert into schema_version values (?, ?, ?, ?, ?, ?)',
+                (table_name, version, new_hash,
+                 json.dumps(type_names, sort_keys=True), source, now))
+            if current is not None and current['column_hash'] != new_hash:
+                old_cols = set(current['type_names'])
+                added = sorted(set(type_names) - old_cols)
+                removed = sorted(old_cols - set(type_names))
+                self.con.execute(
+                    'insert into schema_drift values (?, ?, ?, ?, ?)',
+                    (table_name, version, json.dumps(added),
+                     json.dumps(removed), now))
+                logger.info('Schema drift in table %s, added %s removed %s',
+                            table_name, added, removed)
+            self.con.execute('commit')
+        except BaseException:
+            self.con.execute('rollback')
+            raise
+        logger.debug('Saved version %s of table %s', version, table_name)
+        return version
+
+    def history(self, table_name):
+        '''Returns every version of the table as dicts, oldest first.'''
+        rows = self.con.execute(
+            'select version, type_names, source, created_at from '
+            'schema_version where table_name = ? order by version',
+            (table_name,)).fetchall()
+        return [{'version': r[0], 'type_names': json.loads(r[1]),
+                 'source': r[2], 'created_at': r[3]} for r in rows]
+
+    def drift(self, table_name=None):
+        '''Returns the recorded drift of the table, or of all tables, as
+        dicts with the added and removed columns.'''
+        sql = 'select table_name, version, added, removed, detected_at ' \
+            'from schema_drift'
+        params = ()
+        if table_name is not None:
+            sql += ' where table_name = ?'
+            params = (table_name,)
+        rows = self.con.execute(sql + ' order by detected_at, table_name',
+                                params).fetchall()
+        return [{'table': r[0], 'version': r[1], 'added': json.loads(r[2]),
+                 'removed': json.loads(r[3]), 'detected_at': r[4]}
+                for r in rows]
+
+    def import_type_json_files(self, type_json_path):
+        '''Saves the type JSON files in type_json_path of the tables that
+        have no version yet.  Returns the number of files imported.'''
+        if not type_json_path or not os.path.isdir(type_json_path):
+            return 0
+        known = {r[0] for r in self.con.execute(
+            'select distinct table_name from schema_version')}
+        imported = 0
+        for fn in sorted(os.listdir(type_json_path)):
+            table_name = fn[:-len(TYPE_JSON_SUFFIX)]
+            if not fn.endswith(TYPE_JSON_SUFFIX) or table_name in known:
+                continue
+            with open(os.path.join(type_json_path, fn), 'r') as json_f:
+                self.save(table_name, json.load(json_f), source='json')
+            imported += 1
+        if imported:
+            logger.info('Imported %s type JSON files into %s', imported,
+                        self.db_file)
+        return imported
+
+
+if __name__ == '__main__':
+    from config import Config
+    parser = argparse.ArgumentParser(
+        description='Show the schema registry of SCHEMA_REGISTRY.')
+    parser.add_argument('command', choices=['history', 'drift'])
+    parser.add_argument('table', nargs='?')
+    args = parser.parse_args()
+    registry = Config().schema_registry()
+    if registry is None:
+        raise SystemExit('SCHEMA_REGISTRY is not set')
+    if args.command == 'history':
+        result = registry.history(args.table)
+    else:
+        result = registry.drift(args.table)
+    print(json.dumps(result, indent=4))
@@ -0,0 +1,156 @@
+'''Streaming row readers for xlsx, xls and ods data files
+
+Each reader is a generator yielding the rows of one sheet as lists of python
+values, header row first, so FileInfo.spreadsheet_chunks can build dataframe
+chunks without the whole workbook in memory.  sheet_name selects the sheet,
+the first sheet is read when it is None.
+
+openpyxl and xlrd are only imported when an xlsx or xls file is read.  ods
+files are parsed with the standard library.
+'''
+import zipfile
+import datetime
+import xml.etree.ElementTree as ElementTree
+import logging
+
+logger = logging.getLogger('main.spreadsheet_readers')
+
+ODS_NS = {
+    'office': 'urn:oasis:names:tc:opendocument:xmlns:office:1.0',
+    'table': 'urn:oasis:names:tc:opendocument:xmlns:table:1.0',
+    'text': 'urn:oasis:names:tc:opendocument:xmlns:text:1.0',
+}
+
+
+def ods_attr(prefix, name):
+    '''Returns the ElementTree name of an ods attribute or tag.'''
+    return '{{{}}}{}'.format(ODS_NS[prefix], name)
+
+
+def number_value(value):
+    '''Returns whole number floats as int, as they would be parsed from a
+    CSV file.'''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def xlsx_rows(file_obj, sheet_name=None):
+    '''Yields the rows of an xlsx sheet using openpyxl in read-only mode,
+    which streams the sheet XML instead of loading the workbook.'''
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_obj, read_only=True,
+                                      data_only=True)
+    try:
+        if sheet_name is None:
+            if len(workbook.sheetnames) > 1:
+                logger.warning('Only reading the first of sheets %s',
+                               workbook.sheetnames)
+            sheet = workbook.worksheets[0]
+        else:
+            sheet = workbook[sheet_name]
+        for row in sheet.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def xls_rows(file_obj, sheet_name=None):
+    '''Yields the rows of an xls sheet using xlrd with on_demand loading,
+    so only the selected sheet is parsed.'''
+    import xlrd
+    book = xlrd.open_workbook(file_contents=file_obj.read(), on_demand=True)
+    try:
+        if sheet_name is None:
+            if book.nsheets > 1:
+                logger.warning('Only reading the first of sheets %s',
+                               book.sheet_names())
+            sheet = book.sheet_by_index(0)
+        else:
+            sheet = book.sheet_by_name(sheet_name)
+        for r in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(r):
+                if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                    row.append(None)
+                elif cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate_as_datetime(cell.value,
+                                                       book.datemode))
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(cell.value))
+                else:
+                    row.append(number_value(cell.value))
+            yield row
+    finally:
+        book.release_resources()
+
+
+def ods_cell_value(cell):
+    '''Returns the python value of an ods table cell element.'''
+    value_type = cell.get(ods_attr('office', 'value-type'))
+    if value_type in ('float', 'percentage', 'currency'):
+        return number_value(float(cell.get(ods_attr('office', 'value'))))
+    if value_type == 'boolean':
+        return cell.get(ods_attr('office', 'boolean-value')) == 'true'
+    if value_type == 'date':
+        return datetime.datetime.fromisoformat(
+            cell.get(ods_attr('office', 'date-value')))
+    if value_type == 'time':
+        return cell.get(ods_attr('office', 'time-value'))
+    text = '\n'.join(''.join(p.itertext())
+                     for p in cell.iter(ods_attr('text', 'p')))
+    # Empty text is missing, as it is in a CSV file
+    return text or None
+
+
+def ods_row_values(row_elem):
+    '''Returns the values of an ods table row element as a list of rows,
+    more than one if the row is repeated.'''
+    cell_tags = (ods_attr('table', 'table-cell'),
+                 ods_attr('table', 'covered-table-cell'))
+    cols_repeated = ods_attr('table', 'number-columns-repeated')
+    cells = [(ods_cell_value(cell), int(cell.get(cols_repeated, 1)))
+             for cell in row_elem if cell.tag in cell_tags]
+    # Trailing empty cells pad the row to the sheet width
+    while cells and cells[-1][0] is None:
+        cells.pop()
+    if not cells:
+        return []
+    row = [value for value, repeat in cells for _ in range(repeat)]
+    repeat = int(row_elem.get(ods_attr('table', 'number-rows-repeated'), 1))
+    return [list(row) for _ in range(repeat)]
+
+
+def ods_rows(file_obj, sheet_name=None):
+    '''Yields the rows of an ods sheet by incrementally parsing the
+    content.xml member of the archive.
+
+    Rows are cleared once read.  Repeated empty cells and rows, which ods
+    uses to pad a sheet to its full size, are not expanded.
+    '''
+    table_tag = ods_attr('table', 'table')
+    row_tag = ods_attr('table', 'table-row')
+    with zipfile.ZipFile(file_obj) as archive:
+        with archive.open('content.xml') as content:
+            in_sheet = False
+            for event, elem in ElementTree.iterparse(
+                    content, events=('start', 'end')):
+                if elem.tag == table_tag and event == 'start':
+                    name = elem.get(ods_attr('table', 'name'))
+                    in_sheet = sheet_name is None or name == sheet_name
+                elif elem.tag == table_tag and in_sheet:
+                    # Only one sheet is read
+                    break
+                elif elem.tag == row_tag and event == 'end':
+                    if in_sheet:
+                        for row in ods_row_values(elem):
+                            yield row
+                    elem.clear()
+
+
+# Row readers by file extension
+spreadsheet_readers = {
+    'xlsx': xlsx_rows,
+    'xls': xls_rows,
+    'ods': ods_rows,
+}
@@ -1,6 +1,7 @@
 import unittest
 import os
 import json
+import tempfile
 import file_processor as fp
 import db_processor as dp
 import pandas as pd
@@ -129,6 +130,425 @@ class FileTestCase(unittest.TestCase):
         pd.testing.assert_series_equal(contents_pd.CreateDate,
                                        contents_csv.CreateDate)
 
+    def test_read_csvfile_in_chunks(self):
+        f = fp.FileInfo()
+        path_filename = 'test_data/no_duplicates/one.csv'
+        f.CHUNK_SIZE = 0
+        chunks = list(f.file_chunk_reader(path_filename))
+        self.assertEqual(len(chunks), 1)
+        pd.testing.assert_frame_equal(chunks[0], f.file_reader(path_filename))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_filename = os.path.join(tmp_dir, 'many.csv')
+            contents_pd = pd.DataFrame.from_dict({
+                'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(7)],
+                'Count': list(range(7)),
+            }).set_index('Id')
+            contents_pd.to_csv(path_filename)
+            f.CHUNK_SIZE = 3
+            chunks = list(f.file_chunk_reader(path_filename))
+            self.assertListEqual([len(c) for c in chunks], [3, 3, 1])
+            pd.testing.assert_frame_equal(pd.concat(chunks), contents_pd)
+
+    def test_arrow_csv_engine_matches_pandas(self):
+        f = fp.FileInfo()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(9)],
+            'Name': ['Name, {}\nline two'.format(i) if i % 3 else None
+                     for i in range(9)],
+            'Count': [i if i % 4 else None for i in range(9)],
+            'IsActive': [['true', 'false', None][i % 3] for i in range(9)],
+            'CloseDate': ['2018-05-{:02d}'.format(i + 1) for i in range(9)],
+            'Empty': [None] * 9,
+        })
+
+        def read_both(path_filename, sqltype_names=None, chunksize=None):
+            f.CSV_ENGINE = 'pandas'
+            expected = list(f.csv_chunks(path_filename, sqltype_names,
+                                         chunksize))
+            f.CSV_ENGINE = 'arrow'
+            chunks = list(f.csv_chunks(path_filename, sqltype_names,
+                                       chunksize))
+            self.assertListEqual([len(c) for c in chunks],
+                                 [len(c) for c in expected])
+            for chunk, expected_chunk in zip(chunks, expected):
+                pd.testing.assert_frame_equal(chunk, expected_chunk)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_filename = os.path.join(tmp_dir, 'many.csv')
+            contents_pd.to_csv(path_filename, index=False)
+            read_both(path_filename)
+            read_both(path_filename, chunksize=3)
+            sqltype_names = {'Name': 'String', 'Count': 'Integer',
+                             'IsActive': 'Boolean', 'CloseDate': 'Date',
+                             'Empty': 'Float'}
+            read_both(path_filename, sqltype_names)
+            read_both(path_filename, sqltype_names, 3)
+            # Text after a first block of numbers cannot be streamed with
+            # the types of the first block, the rest is read by pandas
+            contents_pd['Count'] = contents_pd['Count'].astype(object)
+            contents_pd.loc[8, 'Count'] = 'many'
+            contents_pd.to_csv(path_filename, index=False)
+            block_size = fp.ARROW_BLOCK_SIZE
+            fp.ARROW_BLOCK_SIZE = 256
+            try:
+                with self.assertLogs('main.file_processor', 'WARNING'):
+                    f.CSV_ENGINE = 'arrow'
+                    chunks = list(f.csv_chunks(path_filename, chunksize=4))
+            finally:
+                fp.ARROW_BLOCK_SIZE = block_size
+            self.assertEqual(sum(len(c) for c in chunks), 9)
+            self.assertEqual(chunks[-1]['Count'].iloc[-1], 'many')
+            read_both(path_filename)
+        f.CSV_ENGINE = 'pandas'
+
+    def test_read_spreadsheets_in_chunks(self):
+        f = fp.FileInfo()
+        f.CHUNK_SIZE = 2
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(5)],
+            'Count': list(range(5)),
+            'Subject': ['a', None, 'c', 'd', 'e'],
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for ext in ('xlsx', 'ods'):
+                path_filename = os.path.join(tmp_dir, 'sheet.' + ext)
+                contents_pd.to_excel(path_filename)
+                chunks = list(f.file_chunk_reader(path_filename))
+                self.assertListEqual([len(c) for c in chunks], [2, 2, 1])
+                pd.testing.assert_frame_equal(pd.concat(chunks), contents_pd)
+                pd.testing.assert_frame_equal(
+                    f.file_reader(path_filename), contents_pd)
+        # The spreadsheets in test_data are empty
+        for ext in ('xls', 'xlsx'):
+            path_filename = 'test_data/no_duplicates/one.' + ext
+            self.assertListEqual(list(f.file_chunk_reader(path_filename)), [])
+            self.assertIsNone(f.file_reader(path_filename))
+
+    def test_prune_empty_and_excluded_columns(self):
+        f = fp.FileInfo()
+        f.CHUNK_SIZE = 2
+        f.PRUNE_EMPTY_COLUMNS = True
+        f.COLUMN_EXCLUDE = ['pruned.Secret*']
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(5)],
+            'Count': list(range(5)),
+            'Empty__c': [None] * 5,
+            'Late__c': [None] * 4 + ['set'],
+            'Secret__c': ['x'] * 5,
+        }).set_index('Id')
+        expected = contents_pd[['Count', 'Late__c']]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            f.TYPE_JSON_PATH = tmp_dir + '/'
+            for ext in ('csv', 'xlsx'):
+                path_filename = os.path.join(tmp_dir, 'pruned.' + ext)
+                if ext == 'csv':
+                    contents_pd.to_csv(path_filename)
+                else:
+                    contents_pd.to_excel(path_filename)
+                chunks = list(f.file_chunk_reader(path_filename))
+                # CSV files have NaN and spreadsheets None for no value
+                pd.testing.assert_frame_equal(pd.concat(chunks).fillna('-'),
+                                              expected.fillna('-'))
+                # The empty columns of the whole file are recorded
+                self.assertListEqual(f.read_pruned_json('pruned'),
+                                     ['Empty__c'])
+                os.remove(f.pruned_json_file('pruned'))
+            # A type JSON of the kept columns is used to parse the file
+            path_filename = os.path.join(tmp_dir, 'pruned.csv')
+            contents = f.file_reader(path_filename, {'Count': 'Integer',
+                                                     'Late__c': 'String'})
+            self.assertEqual(contents['Count'].dtype, 'Int64')
+            # Later loads keep the recorded columns out
+            contents_pd['Empty__c'] = 'now set'
+            contents_pd.to_csv(path_filename)
+            self.assertListEqual(list(f.file_reader(path_filename).columns),
+                                 ['Count', 'Late__c'])
+            f.PRUNE_EMPTY_COLUMNS = False
+            f.COLUMN_EXCLUDE = []
+            self.assertListEqual(list(f.file_reader(path_filename).columns),
+                                 list(contents_pd.columns))
+
+    def test_read_data_files_in_archives(self):
+        import gzip
+        import zipfile
+        f = fp.FileInfo()
+        f.CHUNK_SIZE = 2
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(5)],
+            'Count': list(range(5)),
+        }).set_index('Id')
+        csv_bytes = contents_pd.to_csv().encode('utf-8')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            f.DATA_FILES = tmp_dir + '/'
+            with zipfile.ZipFile(os.path.join(tmp_dir, 'WE_1.zip'),
+                                 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                zip_file.writestr('Account.csv', csv_bytes)
+                zip_file.writestr('Attachments/notes.txt', b'not data')
+                zip_file.writestr('Lead.csv.gz', gzip.compress(csv_bytes))
+            with open(os.path.join(tmp_dir, 'Contact.csv.gz'), 'wb') as gz:
+                gz.write(gzip.compress(csv_bytes))
+            expected_filenames = [
+                f.DATA_FILES + 'WE_1.zip/Account.csv',
+                f.DATA_FILES + 'WE_1.zip/Lead.csv.gz',
+                f.DATA_FILES + 'Contact.csv.gz',
+            ]
+            f.DATAFILE_EXTS = ['csv']
+            self.assertCountEqual(f.get_data_filenames(), expected_filenames)
+            for path_filename in expected_filenames:
+                chunks = list(f.file_chunk_reader(path_filename))
+                self.assertListEqual([len(c) for c in chunks], [2, 2, 1])
+                pd.testing.assert_frame_equal(pd.concat(chunks), contents_pd)
+            self.assertEqual(fp.data_file_size(expected_filenames[0]),
+                             len(csv_bytes))
+            fingerprint = f.file_fingerprint(expected_filenames[0],
+                                             'missing.json')
+            self.assertEqual(fingerprint['size'], len(csv_bytes))
+            # Hashed on the decompressed contents
+            self.assertEqual(fingerprint['sha256'],
+                             f.file_hash(expected_filenames[2]))
+
+    def test_prefetch_chunks_overlaps_reading(self):
+        import time
+        closed = []
+
+        def slow_chunks(n, fail=False):
+            try:
+                for i in range(n):
+                    time.sleep(0.05)
+                    yield i
+                if fail:
+                    raise ValueError('Parse failed')
+            finally:
+                closed.append(n)
+        start = time.perf_counter()
+        chunks = []
+        for chunk in fp.prefetch_chunks(slow_chunks(4), 2):
+            time.sleep(0.05)
+            chunks.append(chunk)
+        # Reading and consuming take 0.4 s one after the other
+        self.assertLess(time.perf_counter() - start, 0.35)
+        self.assertListEqual(chunks, [0, 1, 2, 3])
+        chunks = []
+        with self.assertRaises(ValueError):
+            for chunk in fp.prefetch_chunks(slow_chunks(2, True), 1):
+                chunks.append(chunk)
+        self.assertListEqual(chunks, [0, 1])
+        # Stopping early closes the chunks
+        prefetched = fp.prefetch_chunks(slow_chunks(10), 1)
+        self.assertEqual(next(prefetched), 0)
+        prefetched.close()
+        self.assertListEqual(closed, [4, 2, 10])
+
+    def test_parquet_cache_of_parsed_files(self):
+        f = fp.FileInfo()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(5)],
+            'Count': list(range(5)),
+            'CreateDate': pd.to_datetime(['2018-05-09 18:10:39'] * 5),
+        }).set_index('Id')
+        sqltype_names = {'Count': 'Integer', 'CreateDate': 'DateTime'}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            f.PARQUET_CACHE_PATH = os.path.join(tmp_dir, 'cache')
+            os.mkdir(f.PARQUET_CACHE_PATH)
+            path_filename = os.path.join(tmp_dir, 'many.csv')
+            contents_pd.to_csv(path_filename)
+            f.CHUNK_SIZE = 2
+            parsed = list(f.file_chunk_reader(path_filename, sqltype_names))
+            cache_file = f.parquet_cache_file(path_filename, sqltype_names)
+            self.assertTrue(os.path.isfile(cache_file))
+            # A partly read file is not cached
+            f.file_chunk_reader(path_filename).__next__()
+            self.assertListEqual(os.listdir(f.PARQUET_CACHE_PATH),
+                                 [os.path.basename(cache_file)])
+            # Cached chunks are read without parsing the file
+
+            def not_parsed(*args):
+                self.fail('Cached file parsed')
+                yield
+            f.csv_chunks = not_parsed
+            cached = list(f.file_chunk_reader(path_filename, sqltype_names))
+            self.assertListEqual([len(c) for c in cached], [2, 2, 1])
+            for chunk, cached_chunk in zip(parsed, cached):
+                pd.testing.assert_frame_equal(chunk, cached_chunk)
+            f.CHUNK_SIZE = 0
+            pd.testing.assert_frame_equal(
+                next(f.file_chunk_reader(path_filename, sqltype_names)),
+                pd.concat(parsed))
+            del f.csv_chunks
+            # Another type JSON is another cache file, the least recently
+            # used file is evicted above the size cap
+            f.PARQUET_CACHE_MAX_MB = 0
+            list(f.file_chunk_reader(path_filename, {'Count': 'Float',
+                                                     'CreateDate': 'Date'}))
+            cache_files = os.listdir(f.PARQUET_CACHE_PATH)
+            self.assertEqual(len(cache_files), 1)
+            self.assertNotEqual(cache_files[0], os.path.basename(cache_file))
+
+    def test_read_csvfile_with_type_json_types(self):
+        f = fp.FileInfo()
+        path_filename = 'test_data/no_duplicates/two.csv'
+        sqltype_names = {
+            'CountTwo': 'Integer',
+            'SubjectTwo': 'String(255)',
+            'IsActiveTwo': 'Boolean',
+            'DollarsTwo': 'Numeric(18, 2)',
+            'CreateDateTwo': 'DateTime',
+        }
+        contents_csv = f.file_reader(path_filename, sqltype_names)
+        self.assertDictEqual(
+            {c: contents_csv[c].dtype.name for c in contents_csv.columns}, {
+                'CountTwo': 'Int64',
+                'SubjectTwo': 'object',
+                'IsActiveTwo': 'boolean',
+                'DollarsTwo': 'float64',
+                'CreateDateTwo': 'datetime64[ns]',
+            })
+        # Only the columns of the type JSON are read with TYPE_JSON_USECOLS
+        del sqltype_names['SubjectTwo']
+        contents_csv = f.file_reader(path_filename, sqltype_names)
+        self.assertIn('SubjectTwo', contents_csv.columns)
+        self.assertEqual(contents_csv.CountTwo.dtype.name, 'float64')
+        f.TYPE_JSON_USECOLS = True
+        contents_csv = f.file_reader(path_filename, sqltype_names)
+        self.assertCountEqual(contents_csv.columns, sqltype_names)
+        self.assertEqual(contents_csv.CountTwo.dtype.name, 'Int64')
+        # Types that do not fit the data fall back to pandas inference
+        sqltype_names['DollarsTwo'] = 'Boolean'
+        contents_csv = f.file_reader(path_filename, sqltype_names)
+        self.assertEqual(contents_csv.DollarsTwo.dtype.name, 'int64')
+
+    def test_file_fingerprint_and_manifest(self):
+        f = fp.FileInfo()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            f.TYPE_JSON_PATH = tmp_dir + '/'
+            path_filename = os.path.join(tmp_dir, 'one.csv')
+            json_file = f.type_json_file('one')
+            with open(path_filename, 'w') as file_obj:
+                file_obj.write('"Id","Count"\n"001A",1\n')
+            self.assertDictEqual(f.read_manifest(), {})
+            fingerprint = f.file_fingerprint(path_filename, json_file)
+            self.assertEqual(fingerprint['size'], 22)
+            self.assertIsNone(fingerprint['type_json_sha256'])
+            f.write_manifest({path_filename: fingerprint})
+            manifest = f.read_manifest()
+            self.assertDictEqual(
+                f.file_fingerprint(path_filename, json_file,
+                                   manifest[path_filename]),
+                manifest[path_filename])
+            # A new type JSON file changes the fingerprint
+            with open(json_file, 'w') as json_f:
+                json_f.write('{"Count": "Integer"}')
+            self.assertNotEqual(
+                f.file_fingerprint(path_filename, json_file,
+                                   manifest[path_filename]),
+                manifest[path_filename])
+            with open(path_filename, 'a') as file_obj:
+                file_obj.write('"001B",2\n')
+            self.assertNotEqual(
+                f.file_fingerprint(path_filename, json_file)['sha256'],
+                fingerprint['sha256'])
+            # Not hashed unless the hash is used
+            self.assertIsNone(f.file_fingerprint(
+                path_filename, json_file, content_hash=False)['sha256'])
+            # Another database or LOAD_MODE has a manifest of its own
+            f.LOAD_MODE = 'swap'
+            self.assertDictEqual(f.read_manifest(), {})
+            f.write_manifest({})
+            f.LOAD_MODE = 'replace'
+            self.assertIn(path_filename, f.read_manifest())
+            f.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/new.db'.format(tmp_dir)
+            self.assertDictEqual(f.read_manifest(), {})
+
+    def test_stage_instrumentation_and_run_report(self):
+        import time
+        from instrumentation import Instrumentation, NO_STAGE
+        inst = Instrumentation()
+        inst.INSTRUMENT = False
+        self.assertIs(inst.stage('one', 'read'), NO_STAGE)
+        self.assertEqual(len(list(inst.timed_chunks('one', [1, 2]))), 2)
+        self.assertListEqual(inst.pop_records(), [])
+        inst.INSTRUMENT = True
+        chunks = [pd.DataFrame({'a': range(3)}), pd.DataFrame({'a': [1]})]
+
+        def slow_chunks():
+            for chunk in chunks:
+                time.sleep(0.05)
+                yield chunk
+        with inst.stage('one', 'write') as record:
+            for chunk in inst.timed_chunks('one', slow_chunks(), 100):
+                record.rows += len(chunk)
+        records = {r['stage']: r for r in inst.report()['stages']}
+        self.assertEqual(records['read']['rows'], 4)
+        self.assertEqual(records['read']['bytes'], 100)
+        self.assertEqual(records['read']['calls'], 3)
+        self.assertGreaterEqual(records['read']['seconds'], 0.1)
+        # Time spent reading chunks is not counted as writing
+        self.assertLess(records['write']['seconds'], 0.05)
+        self.assertEqual(records['write']['rows'], 4)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            inst.RUN_REPORT_PATH = tmp_dir
+            inst.add_records([dict(records['write'], table='two')])
+            inst.write_report()
+            with open(os.path.join(tmp_dir, 'run_report.json')) as json_f:
+                report = json.load(json_f)
+            report_csv = pd.read_csv(os.path.join(tmp_dir, 'run_report.csv'))
+        self.assertEqual(len(report['stages']), 3)
+        self.assertListEqual(list(report_csv['table']), ['two', 'one', 'one'])
+
+    def test_plan_data_files_without_loading(self):
+        import sys
+        import subprocess
+        import plan
+        from config import Config
+        c = Config()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(200)],
+            'Description': ['Line one\nline "two", end'] * 200,
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            c.DATA_FILES = tmp_dir + '/'
+            c.TYPE_JSON_PATH = tmp_dir + '/'
+            c.DATAFILE_EXTS = ['csv']
+            for name in ('Account', 'Contact', 'Lead'):
+                contents_pd.to_csv(os.path.join(tmp_dir, name + '.csv'))
+            with open(c.type_json_file('account'), 'w') as json_f:
+                json.dump({'Description': 'String'}, json_f)
+            with open(c.type_json_file('contact'), 'w') as json_f:
+                json.dump({'Subject': 'String'}, json_f)
+            tables = {p['table']: p for p in plan.plan_data_files(c)}
+            self.assertEqual(tables['account']['type_json'], 'ready')
+            self.assertEqual(tables['contact']['type_json'],
+                             'drift +Description -Subject')
+            self.assertEqual(tables['lead']['type_json'], 'missing')
+            self.assertEqual(tables['lead']['rows'], 200)
+            # Estimated from the first 1000 bytes
+            tables = {p['table']: p for p in plan.plan_data_files(c, 1000)}
+            self.assertAlmostEqual(tables['lead']['rows'], 200, delta=10)
+            # A schema registry is not created by the plan
+            c.SCHEMA_REGISTRY = os.path.join(tmp_dir, 'registry.db')
+            tables = {p['table']: p for p in plan.plan_data_files(c)}
+            self.assertEqual(tables['account']['type_json'], 'ready')
+            self.assertFalse(os.path.exists(c.SCHEMA_REGISTRY))
+            # nor changed, and a version matching the file is ready
+            loader = Config()
+            loader.TYPE_JSON_PATH = c.TYPE_JSON_PATH
+            loader.SCHEMA_REGISTRY = c.SCHEMA_REGISTRY
+            loader.write_type_json(c.type_json_file('contact'),
+                                   {'Description': 'String'})
+            loader.write_type_json(c.type_json_file('contact'),
+                                   {'Subject': 'String'})
+            loader.schema_registry().close()
+            mtime = os.path.getmtime(c.SCHEMA_REGISTRY)
+            tables = {p['table']: p for p in plan.plan_data_files(c)}
+            self.assertEqual(tables['contact']['type_json'], 'ready')
+            self.assertEqual(tables['lead']['type_json'], 'missing')
+            self.assertEqual(os.path.getmtime(c.SCHEMA_REGISTRY), mtime)
+            c.schema_registry().close()
+        # Planning does not import pandas or sqlalchemy
+        imported = subprocess.check_output([
+            sys.executable, '-c', 'import sys, plan; plan.main([]); '
+            'print("pandas" in sys.modules, "sqlalchemy" in sys.modules)'])
+        self.assertEqual(imported.splitlines()[-1], b'False False')
+
     def test_dict_of_pdtype_typval_returned_from_df(self):
         f = fp.FileInfo()
         dict_for_pd = {
@@ -149,6 +569,32 @@ class FileTestCase(unittest.TestCase):
         }
         self.assertDictEqual(f.df_column_dtypes(input_df), expected_results)
 
+    def test_column_profile_from_df(self):
+        f = fp.FileInfo()
+        dict_for_pd = {
+            'Id': ['001A', '001B', '001C', '001D'],
+            'Count': [None, 12, 12, 3],
+            'Subject': [None, None, 'Shipments', 'Box'],
+            'Empty': [None, None, None, None],
+        }
+        input_df = pd.DataFrame.from_dict(dict_for_pd).set_index('Id')
+        profile = f.df_column_profile(input_df)
+        self.assertTupleEqual(profile['Count'],
+                              ('float64', '12.0', 0.25, None, 2))
+        self.assertTupleEqual(profile['Subject'],
+                              ('object', 'Shipments', 0.5, 9, 2))
+        self.assertTupleEqual(profile['Empty'],
+                              ('object', 'None', 1.0, None, 0))
+        self.assertEqual(profile['Subject'].max_length, 9)
+        # Distinct counts of large columns are estimated from a sample
+        input_df = pd.DataFrame({
+            'Code': ['C{}'.format(i % 500) for i in range(50000)],
+            'IsX': [True, None] * 25000,
+        })
+        profile = f.df_column_profile(input_df)
+        self.assertAlmostEqual(profile['Code'].n_distinct, 500, delta=50)
+        self.assertEqual(profile['IsX'].max_length, 4)
+
 
 # TODO Complete testcases for db_processor
 class DBTestCase(unittest.TestCase):
@@ -160,6 +606,601 @@ class DBTestCase(unittest.TestCase):
                               json.loads(os.environ['DATAFILE_EXTS']))
         self.assertListEqual(c.DATAFILE_EXTS,
                              json.loads(os.environ['DATAFILE_EXTS']))
+        # Settings are logged by the first instance only
+        with self.assertNoLogs('main', level='INFO'):
+            f = fp.FileInfo()
+            d = dp.DataProc()
+        self.assertIs(f.sql_types, d.sql_types)
+
+    def test_writer_selected_from_dialect(self):
+        from db_writers import writer_for_uri, copy_writer, \
+            executemany_writer
+        self.assertIs(writer_for_uri(
+            'postgresql+psycopg2://u:p@localhost/db'), copy_writer)
+        self.assertIs(writer_for_uri('sqlite:///test.db'),
+                      executemany_writer)
+        self.assertIs(writer_for_uri(
+            'postgresql+psycopg2://u:p@localhost/db', 'executemany'),
+            executemany_writer)
+        self.assertIsNone(writer_for_uri('sqlite:///test.db', 'default'))
+
+    def test_write_sqltables_chunks_to_sqlite(self):
+        from sqlalchemy import String, Integer
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEG{:03d}'.format(i) for i in range(7)],
+            'Count': list(range(7)),
+        }).set_index('Id')
+        chunks = [contents_pd[:3], contents_pd[3:6], contents_pd[6:]]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            sqltype_dict = {'Id': String, 'Count': Integer}
+            self.assertEqual(d.write_sqltables('many', chunks, sqltype_dict),
+                             7)
+            # A second write replaces the table rather than appending
+            self.assertEqual(d.write_sqltables('many', contents_pd,
+                                               sqltype_dict), 7)
+            contents_db = pd.read_sql_table('many', d.get_engine(),
+                                            index_col='Id')
+            d.dispose_engine()
+        pd.testing.assert_frame_equal(contents_db, contents_pd)
+
+    def test_failed_write_leaves_table_unchanged(self):
+        from sqlalchemy import Integer
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEGQA5', '0032A00002QQ24jQAD'],
+            'Count': [12, 13],
+        }).set_index('Id')
+
+        def failing_chunks():
+            yield contents_pd[:1]
+            raise RuntimeError('Read failed')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            engine = d.get_engine()
+            d.write_sqltables('one', contents_pd, {'Count': Integer})
+            with self.assertRaises(RuntimeError):
+                d.write_sqltables('one', failing_chunks(), {'Count': Integer})
+            with self.assertRaises(RuntimeError):
+                d.write_sqltables(
+                    'one', fp.prefetch_chunks(failing_chunks(), 1),
+                    {'Count': Integer})
+            # The same pooled engine is used for every write
+            self.assertIs(d.get_engine(), engine)
+            contents_db = pd.read_sql_table('one', engine, index_col='Id')
+            d.dispose_engine()
+        pd.testing.assert_frame_equal(contents_db, contents_pd)
+
+    def test_worker_initializer_leaves_parent_connections(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # main.py creates its log directory when imported
+            os.chdir(tmp_dir)
+            try:
+                import main
+            finally:
+                os.chdir(cwd)
+            parent = dp.DataProc()
+            parent.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(
+                tmp_dir)
+            con = parent.get_engine().connect()
+            # As in a worker forked from the main process
+            main.d = parent
+            main.init_worker({})
+            self.assertIsNone(parent.engine)
+            self.assertIsNot(main.d, parent)
+            # The inherited connection is not closed by the worker
+            self.assertEqual(con.execute('select 1').scalar(), 1)
+            con.close()
+            main.d.SQLALCHEMY_DATABASE_URI = parent.SQLALCHEMY_DATABASE_URI
+            engine = main.d.get_engine()
+            self.assertEqual(engine.pool._pre_ping, main.d.DB_POOL_PRE_PING)
+            self.assertEqual(engine.pool._recycle, main.d.DB_POOL_RECYCLE)
+            main.d.dispose_engine()
+            main.journal.close()
+
+    def test_checkpointed_write_resumes_after_failure(self):
+        from sqlalchemy import Integer
+        from run_journal import RunJournal
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVE{:04d}'.format(i) for i in range(7)],
+            'Count': list(range(7)),
+        }).set_index('Id')
+
+        def failing_chunks():
+            yield contents_pd[:3]
+            yield contents_pd[3:5]
+            raise RuntimeError('Read failed')
+        for load_mode in ['replace', 'swap']:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                d.LOAD_MODE = load_mode
+                d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(
+                    tmp_dir)
+                journal = RunJournal(os.path.join(tmp_dir, 'journal.db'))
+                journal.start_file('one.csv', 'one', 'abc')
+
+                def checkpoint(rows):
+                    journal.checkpoint('one.csv', rows)
+                with self.assertRaises(RuntimeError):
+                    d.write_sqltables('one', failing_chunks(),
+                                      {'Count': Integer}, checkpoint)
+                entry = journal.entry('one.csv')
+                self.assertEqual(entry['status'], 'loading')
+                self.assertEqual((entry['rows'], entry['chunks']), (5, 2))
+                self.assertFalse(journal.is_finished('one.csv', 'abc'))
+                # The committed chunks are counted in the database
+                resume_rows = d.committed_rows('one')
+                self.assertEqual(resume_rows, 5)
+                rows = d.write_sqltables('one', [contents_pd[5:]],
+                                         {'Count': Integer}, checkpoint,
+                                         resume_rows)
+                self.assertEqual(rows, 2)
+                journal.finish_file('one.csv', 'one', 'abc', 'written')
+                self.assertTrue(journal.is_finished('one.csv', 'abc'))
+                self.assertFalse(journal.is_finished('one.csv', 'new'))
+                self.assertEqual(journal.entry('one.csv')['rows'], 7)
+                contents_db = pd.read_sql_table('one', d.get_engine(),
+                                                index_col='Id')
+                d.dispose_engine()
+                journal.clear()
+                self.assertIsNone(journal.entry('one.csv'))
+                journal.close()
+            pd.testing.assert_frame_equal(contents_db, contents_pd)
+
+    def test_duplicate_ids_fail_or_keep_latest(self):
+        from sqlalchemy import Integer, String
+        from id_tracker import DuplicateIdError
+        d = dp.DataProc()
+        sqltype_dict = {'Count': Integer, 'SystemModstamp': String}
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['001A', '001B', '001C', '001B', '001A', '001D', '001A'],
+            'Count': [1, 2, 3, 4, 5, 6, 7],
+            'SystemModstamp': ['2018-05-09T18:10:39.000Z',
+                               '2018-05-09T18:10:39.000Z',
+                               '2018-05-09T18:10:39.000Z',
+                               '2018-05-08T18:10:39.000Z',
+                               '2018-05-10T18:10:39.000Z',
+                               '2018-05-09T18:10:39.000Z',
+                               '2018-05-10T18:10:39.000Z'],
+        }).set_index('Id')
+        # 001B's second row is older, 001A's second row is newer, its
+        # third has the same stamp
+        expected = contents_pd.iloc[[1, 2, 4, 5]].sort_index()
+        for load_mode in ['replace', 'swap']:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                d.LOAD_MODE = load_mode
+                d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(
+                    tmp_dir)
+                d.DUPLICATE_IDS = 'error'
+                chunks = [contents_pd[:3], contents_pd[3:5],
+                          contents_pd[5:]]
+                with self.assertRaises(DuplicateIdError) as cm:
+                    d.write_sqltables('one', chunks, sqltype_dict)
+                self.assertEqual(cm.exception.ids, ['001A', '001B'])
+                with self.assertRaises(DuplicateIdError):
+                    d.write_sqltables('one', contents_pd, sqltype_dict)
+                d.DUPLICATE_IDS = 'keep_latest'
+                rows = d.write_sqltables('one', chunks, sqltype_dict)
+                self.assertEqual(rows, 5)
+                contents_db = pd.read_sql_table('one', d.get_engine(),
+                                                index_col='Id')
+                pd.testing.assert_frame_equal(contents_db.sort_index(),
+                                              expected)
+                # A resumed load reads the committed Ids back
+                d.DUPLICATE_IDS = 'error'
+                d.LOAD_MODE = 'replace'
+                tracker = d.id_tracker('one', resume_rows=4)
+                self.assertEqual(len(tracker.seen), 4)
+                with self.assertRaises(DuplicateIdError):
+                    tracker.check(contents_pd[:1])
+                d.dispose_engine()
+
+    def test_sharded_load_matches_whole_file(self):
+        from sqlalchemy import Integer, String
+        from data_files import csv_shard_ranges
+        from id_tracker import DuplicateIdError
+        f = fp.FileInfo()
+        d = dp.DataProc()
+        sqltype_names = {'Body': 'String', 'Count': 'Integer'}
+        sqltype_dict = {'Body': String, 'Count': Integer}
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVE{:04d}'.format(i) for i in range(50)],
+            'Body': ['Line one, "{}"\nline two'.format(i) if i % 3 else
+                     'Body {}'.format(i) for i in range(50)],
+            'Count': list(range(50)),
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_filename = os.path.join(tmp_dir, 'many.csv')
+            contents_pd.to_csv(path_filename)
+            # Small blocks so quoted line breaks span them
+            ranges = csv_shard_ranges(path_filename, 4, block_size=64)
+            self.assertEqual(len(ranges), 4)
+            shards = [list(f.shard_chunks(path_filename, start, end,
+                                          sqltype_names, 5))
+                      for start, end in ranges]
+            pd.testing.assert_frame_equal(
+                pd.concat([c for chunks in shards for c in chunks]),
+                contents_pd, check_dtype=False)
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(
+                tmp_dir)
+            with d.get_engine().begin() as con:
+                d.create_staging_table(con, 'many', contents_pd,
+                                       sqltype_dict)
+            rows = sum(d.write_shard('many', chunks, sqltype_dict)
+                       for chunks in shards)
+            self.assertEqual(rows, 50)
+            d.finish_sharded_load('many')
+            contents_db = pd.read_sql_table('many', d.get_engine(),
+                                            index_col='Id')
+            # An Id in two shards fails the primary key
+            with d.get_engine().begin() as con:
+                d.create_staging_table(con, 'many', contents_pd,
+                                       sqltype_dict)
+            d.write_shard('many', [contents_pd[:30]], sqltype_dict)
+            d.write_shard('many', [contents_pd[25:]], sqltype_dict)
+            with self.assertRaises(DuplicateIdError) as cm:
+                d.finish_sharded_load('many')
+            self.assertEqual(cm.exception.ids, list(contents_pd.index[25:30]))
+            d.dispose_engine()
+        pd.testing.assert_frame_equal(contents_db, contents_pd)
+
+    def test_incremental_load_upserts_and_deletes(self):
+        from sqlalchemy import Integer, String
+        d = dp.DataProc()
+        sqltype_dict = {'Count': Integer, 'SystemModstamp': String}
+        first_load = pd.DataFrame.from_dict({
+            'Id': ['001A', '001B', '001C'],
+            'Count': [1, 2, 3],
+            'SystemModstamp': ['2018-05-09T18:10:39.000Z'] * 3,
+        }).set_index('Id')
+        # 001A unchanged, 001B modified, 001C deleted and 001D added
+        second_load = pd.DataFrame.from_dict({
+            'Id': ['001A', '001B', '001D'],
+            'Count': [10, 20, 40],
+            'SystemModstamp': ['2018-05-09T18:10:39.000Z',
+                               '2018-06-01T08:00:00.000Z',
+                               '2018-06-01T08:00:00.000Z'],
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            d.LOAD_MODE = 'incremental'
+            # No table yet so the first load falls back to a full replace
+            self.assertEqual(d.write_sqltables('acc', first_load,
+                                               sqltype_dict), 3)
+            self.assertEqual(d.write_sqltables('acc', [second_load[:2],
+                                                       second_load[2:]],
+                                               sqltype_dict), 2)
+            contents_db = pd.read_sql('select * from acc order by "Id"',
+                                      d.get_engine(), index_col='Id')
+            d.dispose_engine()
+        self.assertListEqual(list(contents_db.index), ['001A', '001B', '001D'])
+        # The unchanged row keeps its stored value
+        self.assertListEqual(list(contents_db.Count), [1, 20, 40])
+
+    def test_swap_load_through_staging_table(self):
+        from sqlalchemy import Integer, inspect
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['001A', '001B', '001C'],
+            'Count': [1, 2, 3],
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            d.LOAD_MODE = 'swap'
+            for _ in range(2):
+                self.assertEqual(d.write_sqltables(
+                    'acc', [contents_pd[:2], contents_pd[2:]],
+                    {'Count': Integer}), 3)
+            inspector = inspect(d.get_engine())
+            self.assertListEqual(inspector.get_table_names(), ['acc'])
+            self.assertListEqual(
+                [i['name'] for i in inspector.get_indexes('acc')],
+                ['acc_pkey'])
+            contents_db = pd.read_sql_table('acc', d.get_engine(),
+                                            index_col='Id')
+            d.dispose_engine()
+        pd.testing.assert_frame_equal(contents_db, contents_pd)
+
+    def test_benchmark_on_synthetic_export(self):
+        import benchmark
+        f = fp.FileInfo()
+        d = dp.DataProc()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_filenames = benchmark.generate_export(tmp_dir, 2, 50, 6)
+            contents = pd.read_csv(path_filenames[0], index_col='Id')
+            self.assertEqual(len(contents), 50)
+            self.assertEqual(len(contents.columns), 16)
+            self.assertTrue(contents.index.str.fullmatch(
+                r'001[a-zA-Z0-9]{15}').all())
+            f.DATAFILE_EXTS = ['csv']
+            d.TYPE_JSON_PATH = tmp_dir + '/'
+            d.LOAD_MODE = 'replace'
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            results = benchmark.run_benchmark(f, d, tmp_dir + '/')
+            d.dispose_engine()
+        self.assertListEqual([t['table'] for t in results['tables']],
+                             ['account', 'contact'])
+        self.assertEqual(results['totals']['rows'], 100)
+        self.assertCountEqual(results['totals']['seconds'], [
+            'get_data_filenames', 'file_reader', 'df_column_dtypes',
+            'pdtype2sqltype_default', 'write_sqltables'])
+
+    def test_reference_column_indexes(self):
+        from sqlalchemy import inspect
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEGQA5', '0032A00002QQ24jQAD'],
+            'AccountId': ['0012A00002OVVEGQA5', None],
+            'OwnerId': ['0052A00002OVVEGQA5', '0052A00002QQ24jQAD'],
+            'ExternalId': ['ABCDEFGHIJKLMNO', 'ABCDEFGHIJKLMNP'],
+            'Parent__c': ['0032A00002QQ24jQAD', '0032A00002OVVEGQA5'],
+            'Subject': ['0012A00002OVVEGQA5', 'Call'],
+        }).set_index('Id')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}/test.db'.format(tmp_dir)
+            d.write_sqltables('task', contents_pd, {})
+            self.assertListEqual(d.reference_columns('task'),
+                                 ['AccountId', 'OwnerId', 'Parent__c'])
+            d.INDEX_INCLUDE = ['task.Subject']
+            d.INDEX_EXCLUDE = ['*.OwnerId']
+            self.assertListEqual(d.build_reference_indexes(['task']), [
+                'ix_task_accountid', 'ix_task_parent__c', 'ix_task_subject'])
+            # Indexes that exist are skipped
+            d.build_reference_indexes(['task'])
+            indexes = inspect(d.get_engine()).get_indexes('task')
+            d.dispose_engine()
+        # ix_task_Id is created by pandas
+        self.assertCountEqual([i['name'] for i in indexes], [
+            'task_pkey', 'ix_task_Id', 'ix_task_accountid',
+            'ix_task_parent__c', 'ix_task_subject'])
+
+    def test_type_rules_set_column_types(self):
+        d = dp.DataProc()
+        contents_pd = pd.DataFrame.from_dict({
+            'Id': ['0032A00002OVVEGQA5', '0032A00002QQ24jQAD'],
+            'AccountId': ['0012A00002OVVEGQA5', None],
+            'IsActive': [0, 1],
+            'PostalCode': ['02134', '90210'],
+            'Site': ['Main', None],
+            'Notes': [None, None],
+        }).set_index('Id')
+        sqltype_val_dict = {c: ('String', 'x') for c in contents_pd.columns}
+        type_rules = {
+            'rules': [
+                {'column': '*Id', 'type': 'String(18)'},
+                {'column': 'Is*', 'type': 'Boolean'},
+                {'values': r'\d{5}', 'type': 'String(5)'},
+                {'column': 'Site', 'type': 'String(255)'},
+            ],
+            'tables': {'account': [{'column': 'Site', 'type': 'String(80)'}]},
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.TYPE_RULES_FILE = os.path.join(tmp_dir, 'rules.json')
+            with open(d.TYPE_RULES_FILE, 'w') as json_f:
+                json.dump(type_rules, json_f)
+            ruled_dict, ruled = d.apply_type_rules('account', contents_pd,
+                                                   sqltype_val_dict)
+        self.assertDictEqual(ruled_dict, {
+            'AccountId': ('String(18)', 'x'),
+            'IsActive': ('Boolean', 'x'),
+            'PostalCode': ('String(5)', 'x'),
+            'Site': ('String(80)', 'x'),
+            'Notes': ('String', 'x'),
+        })
+        self.assertSetEqual(ruled, {'AccountId', 'IsActive', 'PostalCode',
+                                    'Site'})
+        # The rules are read once, other tables use the global rules
+        self.assertEqual(d.apply_type_rules('contact', contents_pd,
+                                            sqltype_val_dict)[0]['Site'],
+                         ('String(255)', 'x'))
+        d.type_rules = None
+        d.TYPE_RULES_FILE = ''
+        self.assertEqual(d.apply_type_rules('account', contents_pd,
+                                            sqltype_val_dict),
+                         (sqltype_val_dict, set()))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.type_rules = None
+            d.TYPE_RULES_FILE = os.path.join(tmp_dir, 'rules.json')
+            with open(d.TYPE_RULES_FILE, 'w') as json_f:
+                json.dump({'rules': [{'column': '*', 'type': 'Text'}]},
+                          json_f)
+            with self.assertRaises(ValueError):
+                d.read_type_rules()
+
+    def test_schema_registry_versions_and_drift(self):
+        d = dp.DataProc()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            d.TYPE_JSON_PATH = tmp_dir + '/'
+            with open(d.type_json_file('account'), 'w') as json_f:
+                json.dump({'Name': 'String', 'Site': 'String(80)'}, json_f)
+            d.SCHEMA_REGISTRY = os.path.join(tmp_dir, 'registry.db')
+            # The existing type JSON file is imported on first use
+            json_file = d.type_json_file('account')
+            self.assertDictEqual(d.read_type_json(json_file),
+                                 {'Name': 'String', 'Site': 'String(80)'})
+            self.assertIsNone(d.read_type_json(d.type_json_file('contact')))
+            registry = d.schema_registry()
+            fingerprint_hash = d.type_json_hash(json_file)
+            sqltype_dict = d.make_sqltype_dict_initial(
+                {'Name': ('String', 'x'), 'Site': ('String(80)', 'x')},
+                json_file)
+            self.assertEqual(sqltype_dict['Site'].length, 80)
+            # Saving the same types adds no version
+            self.assertEqual(len(registry.history('account')), 1)
+            self.assertEqual(d.type_json_hash(json_file), fingerprint_hash)
+            d.write_type_json(json_file, {'Name': 'String',
+                                          'Phone': 'String(40)'})
+            self.assertNotEqual(d.type_json_hash(json_file),
+                                fingerprint_hash)
+            history = registry.history('account')
+            self.assertListEqual([h['version'] for h in history], [1, 2])
+            self.assertListEqual([h['source'] for h in history],
+                                 ['json', 'load'])
+            drift = registry.drift('account')
+            self.assertEqual(len(drift), 1)
+            self.assertListEqual(drift[0]['added'], ['Phone'])
+            self.assertListEqual(drift[0]['removed'], ['Site'])
+            # The earlier column set is still matched to its version
+            self.assertDictEqual(registry.match('account', ['Site', 'Name']),
+                                 {'Name': 'String', 'Site': 'String(80)'})
+            self.assertIsNone(registry.match('account', ['Name']))
+            # A second reader sees the versions saved by the first
+            other = dp.DataProc()
+            other.TYPE_JSON_PATH = d.TYPE_JSON_PATH
+            other.SCHEMA_REGISTRY = d.SCHEMA_REGISTRY
+            self.assertIn('Phone', other.read_type_json(json_file))
+            other.schema_registry().close()
+            registry.close()
+
+    def test_schema_registry_matches_file_columns(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # main.py creates its log directory when imported
+            os.chdir(tmp_dir)
+            try:
+                import main
+            finally:
+                os.chdir(cwd)
+            f = fp.FileInfo()
+            d = dp.DataProc()
+            main.d = d
+            for c in (f, d):
+                c.TYPE_JSON_PATH = tmp_dir + '/'
+                c.SCHEMA_REGISTRY = os.path.join(tmp_dir, 'registry.db')
+            json_file = d.type_json_file('account')
+            d.write_type_json(json_file, {'Name': 'String',
+                                          'Site': 'String(80)'})
+            d.write_type_json(json_file, {'Name': 'String',
+                                          'Phone': 'String(40)'})
+            # A file with the columns of the earlier version
+            path_filename = os.path.join(tmp_dir, 'Account.csv')
+            pd.DataFrame.from_dict({
+                'Id': ['0012A00002OVVEGQA5', '0012A00002OVVEGQA6'],
+                'Name': ['One', 'Two'],
+                'Site': ['0012', None],
+            }).to_csv(path_filename, index=False)
+            sqltype_names = d.read_type_json(json_file)
+            self.assertIn('Phone', sqltype_names)
+            contents = next(f.file_chunk_reader(path_filename,
+                                                sqltype_names))
+            # Parsed with the types of the earlier version
+            self.assertEqual(contents.Site.iat[0], '0012')
+            sqltype_dict, is_sql_ready, ambiguous = main.table_sqltypes(
+                'account', contents, sqltype_names, json_file)
+            self.assertTrue(is_sql_ready)
+            self.assertEqual(sqltype_dict['Site'].length, 80)
+            sqltype_dict, is_sql_ready = d.make_sqltype_dict_json(
+                {'Name': ('String', 'One'), 'Site': ('Integer', 12)},
+                json_file)
+            self.assertTrue(is_sql_ready)
+            self.assertEqual(len(d.schema_registry().history('account')), 2)
+            f.schema_registry().close()
+            d.schema_registry().close()
+
+    def test_sqltype_from_name(self):
+        from sqlalchemy import String, Numeric
+        d = dp.DataProc()
+        self.assertIs(d.sqltype_from_name('String'), String)
+        self.assertIsInstance(d.sqltype_from_name('String(18)'), String)
+        self.assertEqual(d.sqltype_from_name('String(18)').length, 18)
+        numeric = d.sqltype_from_name('Numeric(18, 2)')
+        self.assertTupleEqual((numeric.precision, numeric.scale), (18, 2))
+        with self.assertRaises(ValueError):
+            d.sqltype_from_name('Varchar2')
+
+    def test_types_inferred_from_data_sample(self):
+        d = dp.DataProc()
+        f = fp.FileInfo()
+        dict_for_pd = {
+            'Id': ['0032A00002OVVEGQA5', '0032A00002QQ24jQAD'],
+            'AccountId': ['0012A00002OVVEGQA5', None],
+            'Count': [12.0, None],
+            'Dollars': [123.45, 9.5],
+            'IsActive': [0, 1],
+            'IsDeleted': ['false', 'true'],
+            'CloseDate': ['2018-05-09', '2018-05-10'],
+            'SystemModstamp': ['2018-05-09T18:10:39.000Z',
+                               '2018-05-10T08:00:00.000Z'],
+            'Subject': ['Shipments', 'Box'],
+            'Empty': [None, None],
+        }
+        contents = pd.DataFrame.from_dict(dict_for_pd).set_index('Id')
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(
+            contents, f.df_column_profile(contents))
+        self.assertDictEqual({k: v[0] for k, v in sqltype_val_dict.items()}, {
+            'AccountId': 'String(18)',
+            'Count': 'Integer',
+            'Dollars': 'Numeric(18, 2)',
+            'IsActive': 'Integer',
+            'IsDeleted': 'Boolean',
+            'CloseDate': 'Date',
+            'SystemModstamp': 'DateTime',
+            'Subject': 'String(255)',
+            'Empty': 'String',
+        })
+        self.assertSetEqual(ambiguous, {'IsActive', 'Empty'})
+        # Only the first chunk was profiled so strings stay unbounded
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(
+            contents, f.df_column_profile(contents), is_complete=False)
+        self.assertEqual(sqltype_val_dict['Subject'][0], 'String')
+        self.assertEqual(sqltype_val_dict['AccountId'][0], 'String')
+        # and text dates and booleans may not parse in a later chunk
+        self.assertSetEqual(ambiguous, {'Count', 'Dollars', 'IsActive',
+                                        'IsDeleted', 'CloseDate',
+                                        'SystemModstamp', 'Empty'})
+        # Ids are only bounded to their length when no value is longer
+        contents = pd.DataFrame({'Ext': ['0012A00002O{:07d}'.format(i)
+                                         for i in range(20000)]})
+        # Past the rows sampled
+        contents.iat[19994, 0] = 'f47ac10b-58cc-4372-a567-0e02b2c3d479'
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(
+            contents, f.df_column_profile(contents))
+        self.assertEqual(sqltype_val_dict['Ext'][0], 'String(255)')
+        # Float columns are checked on every row, not only the sample
+        contents = pd.DataFrame({'Amount': [float(i) for i in range(50000)]})
+        contents.iat[49999, 0] = 10.55
+        profile = f.df_column_profile(contents)
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(contents,
+                                                             profile)
+        self.assertEqual(sqltype_val_dict['Amount'][0], 'Numeric(18, 2)')
+        self.assertSetEqual(ambiguous, set())
+        # A later chunk may not fit the type of the first
+        sqltype_val_dict, ambiguous = d.pdtype2sqltype_infer(
+            contents, profile, is_complete=False)
+        self.assertSetEqual(ambiguous, {'Amount'})
+
+    def test_coerce_chunk_to_sqltypes(self):
+        from sqlalchemy import Boolean, Integer, DateTime
+        d = dp.DataProc()
+        contents = pd.DataFrame.from_dict({
+            'Id': ['001A', '001B'],
+            'Count': [12.0, None],
+            'IsDeleted': ['false', 'TRUE'],
+            'SystemModstamp': ['2018-05-09T18:10:39.000Z',
+                               '2018-05-10T08:00:00.000Z'],
+        }).set_index('Id')
+        coerced = d.coerce_chunk(contents, {'Count': Integer,
+                                            'IsDeleted': Boolean,
+                                            'SystemModstamp': DateTime})
+        self.assertEqual(coerced.Count.dtype.name, 'Int64')
+        self.assertListEqual(list(coerced.IsDeleted), [False, True])
+        self.assertEqual(coerced.SystemModstamp.iat[0],
+                         pd.Timestamp('2018-05-09 18:10:39'))
+        # The input dataframe is left as it was
+        self.assertEqual(contents.IsDeleted.iat[0], 'false')
+        with self.assertRaises(ValueError):
+            d.coerce_chunk(contents, {'SystemModstamp': Boolean})
+        with self.assertRaises(ValueError):
+            d.coerce_chunk(pd.DataFrame({'Count': [1.5, None]}),
+                           {'Count': Integer})
+        # Python bools with nulls, as read from spreadsheets or generated
+        contents = pd.DataFrame({'IsDeleted': [True, None, False, 'true']})
+        coerced = d.coerce_chunk(contents, {'IsDeleted': Boolean})
+        self.assertEqual(coerced.IsDeleted.dtype.name, 'boolean')
+        self.assertListEqual(coerced.IsDeleted.tolist(),
+                             [True, pd.NA, False, True])
 
 
 if __name__ == '__main__':
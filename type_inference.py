@@ -0,0 +1,134 @@
+'''Sample based inference of sqlalchemy type names for sf.com data
+
+The checks run on a bounded sample of a column with vectorized pandas string
+methods, those of float columns on the whole column.  Each check returns a
+type name as used in the type JSON files, e.g. "Integer", "String(18)" or
+"Numeric(18, 2)", and whether the type is confident or needs confirming in
+DataProc.type_update_interactive.
+'''
+import numpy as np
+import logging
+
+logger = logging.getLogger('main.type_inference')
+
+# 15 or 18 character case sensitive / insensitive sf.com record ids
+SFID_PATTERN = r'[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?'
+DATE_PATTERN = r'\d{4}-\d{2}-\d{2}'
+DATETIME_PATTERN = (r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?'
+                    r'(?:Z|[+-]\d{2}:?\d{2})?')
+BOOLEAN_VALUES = {'true', 'false'}
+INTEGER_PATTERN = r'[+-]?\d+'
+DECIMAL_PATTERN = r'[+-]?\d*\.\d+'
+# sf.com text fields hold at most 255 characters, longer ones are long text
+# areas and are left unbounded.
+MAX_BOUNDED_LENGTH = 255
+# Numeric scale above which a float column is treated as a real Float
+MAX_NUMERIC_SCALE = 8
+MIN_NUMERIC_PRECISION = 18
+
+
+def numeric_type_name(values):
+    '''Returns "Integer" if all the float values are whole numbers that fit
+    64 bits, "Numeric(precision, scale)" for decimals of limited scale and
+    "Float" otherwise.
+
+    The scale is the fewest decimals the values are rounded to without
+    changing them by more than a few units in the last place, so the
+    checks are float arithmetic on the whole array, not text.
+    '''
+    values = np.abs(np.asarray(values, dtype='float64'))
+    if not np.isfinite(values).all():
+        return 'Float'
+    max_value = values.max()
+    if (values % 1 == 0).all():
+        return 'Integer' if max_value < 2 ** 63 else 'Float'
+    tolerance = 4 * np.spacing(values)
+    for scale in range(1, MAX_NUMERIC_SCALE + 1):
+        if (np.abs(np.round(values, scale) - values) <= tolerance).all():
+            break
+    else:
+        return 'Float'
+    precision = max(len(str(int(max_value))) + scale, MIN_NUMERIC_PRECISION)
+    return 'Numeric({}, {})'.format(precision, scale)
+
+
+def infer_column_type(sample, max_length=None, is_complete=True):
+    '''Infers the sqlalchemy type name of a column from a sample of it.
+
+    sample is a pandas series, the whole column for float columns.
+    max_length is the longest string seen in the column, defaulting to the
+    sample's.  Strings are only bounded to String(255) when is_complete is
+    True, i.e. max_length covers every value of the data file, and sf.com
+    ids to String(n) only when max_length is also n.  Likewise Integer and
+    Numeric types of float columns and Boolean, Date and DateTime types of
+    text columns are only confident when the column holds every value of
+    the data file, as a later value may not fit them.
+    Returns a tuple of the type name and True when the type is confident.
+    '''
+    values = sample.dropna()
+    dtype = sample.dtype.name
+    if values.empty:
+        # Nothing to go by, leave it to the user
+        return 'String', False
+    if dtype in ('bool', 'boolean'):
+        return 'Boolean', True
+    if dtype in ('int64', 'Int64'):
+        # 0/1 columns may be checkboxes or counts
+        return 'Integer', not values.isin([0, 1]).all()
+    if dtype == 'float64':
+        type_name = numeric_type_name(values)
+        return type_name, is_complete or type_name == 'Float'
+    if dtype.startswith('datetime64'):
+        return 'DateTime', True
+    if dtype != 'object':
+        return 'String', False
+    values = values.astype(str).str.strip()
+    if values.str.lower().isin(BOOLEAN_VALUES).all():
+        return 'Boolean', is_complete
+    if values.str.fullmatch(DATE_PATTERN).all():
+        return 'Date', is_complete
+    if values.str.fullmatch(DATETIME_PATTERN).all():
+        return 'DateTime', is_complete
+    if values.str.fullmatch(INTEGER_PATTERN).all():
+        # Kept as text by pandas, e.g. leading zeros, so only a guess
+        return 'Integer', False
+    if values.str.fullmatch(DECIMAL_PATTERN).all():
+        return numeric_type_name(values.astype(float)), False
+    lengths = values.str.len()
+    if max_length is None:
+        max_length = int(lengths.max())
+    if (is_complete and values.str.fullmatch(SFID_PATTERN).all() and
+            values.str.contains(r'\d').all() and lengths.nunique() == 1 and
+            lengths.iat[0] == max_length):
+        return 'String({})'.format(max_length), True
+    if is_complete and max_length <= MAX_BOUNDED_LENGTH:
+        return 'String({})'.format(MAX_BOUNDED_LENGTH), True
+    return 'String', True
+
+
+def infer_frame_types(contents, profile, sample_rows, is_complete=True):
+    '''Infers the type names of all columns of the dataframe.
+
+    profile is the dict from FileInfo.df_column_profile, providing the max
+    string length of each column.  At most sample_rows rows, spread over
+    the dataframe, are checked, except for float columns, whose numeric
+    checks are cheap enough to run on every row.
+    Returns a dict of type name by column and the set of ambiguous columns.
+    '''
+    if len(contents) > sample_rows:
+        sample = contents.sample(sample_rows, random_state=0)
+    else:
+        sample = contents
+    type_names = {}
+    ambiguous = set()
+    for c in contents.columns:
+        max_length = getattr(profile.get(c), 'max_length', None)
+        column = contents[c] if contents[c].dtype == 'float64' \
+            else sample[c]
+        type_names[c], is_confident = infer_column_type(
+            column, max_length, is_complete)
+        if not is_confident:
+            ambiguous.add(c)
+    logger.debug('Inferred types %s, ambiguous columns %s', type_names,
+                 ambiguous)
+    return type_names, ambiguous